@@ -0,0 +1,278 @@
+"""
+Local stand-ins for Wavespeed, Grok and R2 so the pipeline can be benchmarked
+without spending API money. All three are served by one aiohttp app:
+
+    /api/v3/bytedance/seedream-v4/edit      Wavespeed submit
+    /api/v3/wavespeed-ai/image-upscaler     Wavespeed upscale submit (same behaviour)
+    /api/v3/predictions/{id}/result         Wavespeed poll
+    /outputs/{id}.jpeg                      generated result download
+    /v1/chat/completions                    OpenAI-compatible Grok endpoint
+    /{bucket}/{key}                         S3 subset used by boto3 (put, multipart, head, get)
+"""
+import asyncio
+import hashlib
+import io
+import random
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Optional
+
+from aiohttp import web
+
+
+@dataclass
+class FakeServiceConfig:
+    # Wavespeed: seconds from submit until "completed", uniformly jittered by +/- generation_jitter
+    generation_latency: float = 2.0
+    generation_jitter: float = 0.5
+    # fraction of predictions that end as "failed"
+    failure_rate: float = 0.0
+    # fraction of submit/poll requests answered with 429 + Retry-After
+    throttle_rate: float = 0.0
+    retry_after: float = 1.0
+    # fraction of submit requests and result downloads answered with 503
+    error_rate: float = 0.0
+    output_bytes: int = 256 * 1024
+    # results are a real JPEG of this size, padded with zeros up to output_bytes
+    output_width: int = 1536
+    output_height: int = 2048
+    # Grok
+    grok_latency: float = 0.5
+    # R2/S3
+    s3_latency: float = 0.01
+
+
+@dataclass
+class _Prediction:
+    created_at: float
+    ready_at: float
+    failed: bool
+
+
+@dataclass
+class _Stats:
+    submits: int = 0
+    polls: int = 0
+    throttled: int = 0
+    errors: int = 0
+    downloads: int = 0
+    grok_calls: int = 0
+    s3_requests: int = 0
+
+
+class FakeServices:
+    def __init__(self, config: Optional[FakeServiceConfig] = None) -> None:
+        self.config = config or FakeServiceConfig()
+        self.predictions: dict[str, _Prediction] = {}
+        # S3 objects are kept as sizes only; GETs return zero bytes of that length
+        self.objects: dict[tuple[str, str], int] = {}
+        self.multipart: dict[str, dict[int, int]] = {}
+        self.stats = _Stats()
+        self.output_body = self._make_output()
+
+    def _make_output(self) -> bytes:
+        from PIL import Image
+
+        buffer = io.BytesIO()
+        Image.linear_gradient("L").resize((self.config.output_width, self.config.output_height)).convert("RGB").save(buffer, format="JPEG", quality=90)
+        body = buffer.getvalue()
+        # decoders stop at the JPEG end marker, so the padding only adds transfer size
+        return body + b"\0" * max(0, self.config.output_bytes - len(body))
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_post("/api/v3/bytedance/seedream-v4/edit", self.submit)
+        app.router.add_post("/api/v3/wavespeed-ai/image-upscaler", self.submit)
+        app.router.add_get("/api/v3/predictions/{id}/result", self.poll)
+        app.router.add_get("/outputs/{id}.jpeg", self.output)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_get("/stats", self.get_stats)
+        app.router.add_route("*", "/{bucket}/{key:.+}", self.s3_object)
+        return app
+
+    def _throttled(self) -> Optional[web.Response]:
+        if self.config.throttle_rate and random.random() < self.config.throttle_rate:
+            self.stats.throttled += 1
+            return web.json_response(
+                {"code": 429, "message": "rate limited"},
+                status=429,
+                headers={"Retry-After": str(self.config.retry_after)},
+            )
+        return None
+
+    def _unavailable(self) -> Optional[web.Response]:
+        if self.config.error_rate and random.random() < self.config.error_rate:
+            self.stats.errors += 1
+            return web.json_response({"code": 503, "message": "service unavailable"}, status=503)
+        return None
+
+    # Wavespeed
+
+    async def submit(self, request: web.Request) -> web.Response:
+        rejected = self._throttled() or self._unavailable()
+        if rejected:
+            return rejected
+        await request.json()
+        self.stats.submits += 1
+        prediction_id = uuid.uuid4().hex
+        now = time.monotonic()
+        latency = self.config.generation_latency + random.uniform(-self.config.generation_jitter, self.config.generation_jitter)
+        self.predictions[prediction_id] = _Prediction(now, now + max(0.0, latency), random.random() < self.config.failure_rate)
+        base = f"{request.scheme}://{request.host}"
+        return web.json_response({"code": 200, "data": {
+            "id": prediction_id,
+            "status": "created",
+            "urls": {"get": f"{base}/api/v3/predictions/{prediction_id}/result"},
+        }})
+
+    async def poll(self, request: web.Request) -> web.Response:
+        throttled = self._throttled()
+        if throttled:
+            return throttled
+        self.stats.polls += 1
+        prediction_id = request.match_info["id"]
+        prediction = self.predictions.get(prediction_id)
+        if prediction is None:
+            return web.json_response({"code": 404, "message": "not found"}, status=404)
+        if time.monotonic() < prediction.ready_at:
+            return web.json_response({"code": 200, "data": {"id": prediction_id, "status": "processing", "outputs": []}})
+        if prediction.failed:
+            return web.json_response({"code": 200, "data": {"id": prediction_id, "status": "failed", "error": "simulated failure", "outputs": []}})
+        base = f"{request.scheme}://{request.host}"
+        return web.json_response({"code": 200, "data": {
+            "id": prediction_id,
+            "status": "completed",
+            "outputs": [f"{base}/outputs/{prediction_id}.jpeg"],
+        }})
+
+    async def output(self, request: web.Request) -> web.StreamResponse:
+        unavailable = self._unavailable()
+        if unavailable:
+            return unavailable
+        self.stats.downloads += 1
+        response = web.StreamResponse(headers={"Content-Type": "image/jpeg", "Content-Length": str(len(self.output_body))})
+        await response.prepare(request)
+        for offset in range(0, len(self.output_body), 65536):
+            await response.write(self.output_body[offset:offset + 65536])
+        await response.write_eof()
+        return response
+
+    # Grok
+
+    async def chat_completions(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.stats.grok_calls += 1
+        await asyncio.sleep(self.config.grok_latency)
+        return web.json_response({
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "benchmark prompt, photorealistic, 8k fashion portrait"},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        })
+
+    # S3
+
+    async def s3_object(self, request: web.Request) -> web.StreamResponse:
+        self.stats.s3_requests += 1
+        if self.config.s3_latency:
+            await asyncio.sleep(self.config.s3_latency)
+        bucket = request.match_info["bucket"]
+        key = request.match_info["key"]
+        query = request.query
+
+        if request.method == "POST" and "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            self.multipart[upload_id] = {}
+            return self._xml(
+                f"<InitiateMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key>"
+                f"<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>"
+            )
+        if request.method == "POST" and "uploadId" in query:
+            await request.read()
+            parts = self.multipart.pop(query["uploadId"], {})
+            self.objects[(bucket, key)] = sum(parts.values())
+            return self._xml(
+                f"<CompleteMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key>"
+                f"<ETag>\"{uuid.uuid4().hex}\"</ETag></CompleteMultipartUploadResult>"
+            )
+        if request.method == "PUT":
+            size = await self._drain(request)
+            if "uploadId" in query:
+                self.multipart.setdefault(query["uploadId"], {})[int(query["partNumber"])] = size
+            else:
+                self.objects[(bucket, key)] = size
+            return web.Response(headers={"ETag": f"\"{hashlib.md5(key.encode()).hexdigest()}\""})
+        if request.method == "DELETE":
+            if "uploadId" in query:
+                self.multipart.pop(query["uploadId"], None)
+            else:
+                self.objects.pop((bucket, key), None)
+            return web.Response(status=204)
+
+        size = self.objects.get((bucket, key))
+        if size is None:
+            if request.method == "HEAD":
+                return web.Response(status=404)
+            return self._xml("<Error><Code>NoSuchKey</Code><Message>not found</Message></Error>", status=404)
+        headers = {"Content-Length": str(size), "ETag": f"\"{hashlib.md5(key.encode()).hexdigest()}\"", "Content-Type": "image/jpeg"}
+        if request.method == "HEAD":
+            return web.Response(headers=headers)
+        return web.Response(body=b"\0" * size, headers=headers)
+
+    @staticmethod
+    async def _drain(request: web.Request) -> int:
+        size = 0
+        async for chunk in request.content.iter_chunked(65536):
+            size += len(chunk)
+        return size
+
+    @staticmethod
+    def _xml(body: str, status: int = 200) -> web.Response:
+        return web.Response(
+            text=f'<?xml version="1.0" encoding="UTF-8"?>{body}',
+            status=status,
+            content_type="application/xml",
+        )
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats.__dict__)
+
+
+def serve(port: int, config: Optional[FakeServiceConfig] = None, ready=None) -> None:
+    """
+    Run the fake services until the process is terminated. `ready` (a multiprocessing Event) is set once listening.
+    """
+    async def main() -> None:
+        runner = web.AppRunner(FakeServices(config).app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        if ready is not None:
+            ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Serve fake Wavespeed, Grok and S3 endpoints")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--generation-latency", type=float, default=2.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    serve(args.port, FakeServiceConfig(
+        generation_latency=args.generation_latency,
+        failure_rate=args.failure_rate,
+        throttle_rate=args.throttle_rate,
+        error_rate=args.error_rate,
+    ))
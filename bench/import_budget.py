@@ -0,0 +1,74 @@
+"""
+Import-time budget check for the entry points.
+
+Each module is imported in a fresh interpreter. The check fails when the
+import is over its budget (the best of --repeat runs, in milliseconds), or
+when it pulls in a heavy dependency that should only load on first use:
+
+    python -m bench.import_budget
+    python -m bench.import_budget --scale 2     # slower machine / CI
+"""
+import json
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+from bench.run_benchmark import ROOT_DIR
+
+# module -> (budget in ms, modules it must not import)
+BUDGETS = {
+    "main": (800, ("boto3", "openai", "gradio", "PIL")),
+    "utils.worker": (800, ("boto3", "openai", "gradio", "PIL")),
+    "utils.image_generator": (700, ("boto3", "openai", "gradio", "PIL")),
+    "gradio_app": (800, ("boto3", "openai", "gradio", "PIL")),
+}
+
+_PROBE = """
+import importlib, json, sys, time
+before = set(sys.modules)
+started = time.perf_counter()
+importlib.import_module({module!r})
+elapsed = time.perf_counter() - started
+print(json.dumps([elapsed * 1000, sorted(set(sys.modules) - before)]))
+"""
+
+
+def measure(module: str) -> tuple[float, list[str]]:
+    """
+    Return (import time in ms, modules loaded) for one cold import of `module`.
+    """
+    result = subprocess.run(
+        [sys.executable, "-c", _PROBE.format(module=module)],
+        cwd=ROOT_DIR, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr[-2000:]}")
+    elapsed_ms, loaded = json.loads(result.stdout.strip().splitlines()[-1])
+    return elapsed_ms, loaded
+
+
+def main(argv=None) -> int:
+    parser = ArgumentParser(description="Fail when an entry point imports too slowly or too much")
+    parser.add_argument("--repeat", type=int, default=3, help="imports per module; the fastest counts")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply every budget, e.g. for slow CI machines")
+    parser.add_argument("modules", nargs="*", default=list(BUDGETS))
+    args = parser.parse_args(argv)
+
+    failures = 0
+    for module in args.modules:
+        budget_ms, forbidden = BUDGETS.get(module, (float("inf"), ()))
+        budget_ms *= args.scale
+        runs = [measure(module) for _ in range(max(1, args.repeat))]
+        best_ms = min(ms for ms, _ in runs)
+        loaded = {name.split(".")[0] for name in runs[0][1]}
+        heavy = [name for name in forbidden if name in loaded]
+        ok = best_ms <= budget_ms and not heavy
+        failures += not ok
+        status = "ok" if ok else "FAIL"
+        note = f", imports {', '.join(heavy)}" if heavy else ""
+        print(f"{status:4} {module}: {best_ms:.0f} ms (budget {budget_ms:.0f} ms){note}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,287 @@
+"""
+Offline throughput benchmark.
+
+Starts the fake Wavespeed/Grok/S3 services from bench/fake_services.py in
+their own process, then runs each (mode, size) scenario in a fresh child
+process so peak RSS and socket counts are not shared between runs:
+
+    python -m bench.run_benchmark --sizes 10,100,1000 --modes pipeline,gradio --output bench.json
+
+Modes:
+    pipeline  ImageProcessorPipeline.stream_images over a generated dataset directory
+    gradio    gradio_app.process_images_pipeline, including Grok prompt generation
+
+Pipeline settings (rate limits, poll intervals, worker counts) come from the
+environment as usual; pass --env KEY=VALUE to override them for a run.
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import urllib.request
+from argparse import ArgumentParser
+from dataclasses import asdict
+from typing import Optional
+
+from bench.fake_services import FakeServiceConfig, serve
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values: list[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def open_sockets() -> Optional[int]:
+    try:
+        fds = os.listdir("/proc/self/fd")
+    except OSError:
+        return None
+    count = 0
+    for fd in fds:
+        try:
+            if os.readlink(f"/proc/self/fd/{fd}").startswith("socket:"):
+                count += 1
+        except OSError:
+            continue
+    return count
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def service_env(port: int, workdir: str) -> dict:
+    base = f"http://127.0.0.1:{port}"
+    return {
+        "WAVESPEED_API_URL": f"{base}/api/v3/bytedance/seedream-v4/edit",
+        "WAVESPEED_UPSCALE_URL": f"{base}/api/v3/wavespeed-ai/image-upscaler",
+        "WAVESPEED_API_KEY": "bench",
+        "GROK_BASE_URL": f"{base}/v1",
+        "OPENAI_API_KEY": "bench",
+        "R2_ENDPOINT_URL": base,
+        "R2_BUCKET_NAME": "bench",
+        "R2_ACCOUNT_ID": "bench",
+        "R2_ACCESS_KEY_ID": "bench",
+        "R2_SECRET_ACCESS_KEY": "bench",
+        # the fake S3 does not implement aws-chunked checksum trailers
+        "AWS_REQUEST_CHECKSUM_CALCULATION": "when_required",
+        "AWS_RESPONSE_CHECKSUM_VALIDATION": "when_required",
+        "DB_PATH": os.path.join(workdir, "jobs.db"),
+        "UPLOAD_CACHE_PATH": os.path.join(workdir, "r2_upload_cache.db"),
+        "PROMPT_CACHE_PATH": os.path.join(workdir, "prompt_cache.db"),
+    }
+
+
+def make_dataset(directory: str, count: int) -> tuple[str, list[str]]:
+    """
+    Write `count` distinct small JPEG targets with .txt descriptions, plus a lia image.
+    Every target has different pixels so content-addressed caching can't collapse them.
+    """
+    from PIL import Image
+
+    os.makedirs(directory, exist_ok=True)
+    lia_path = os.path.join(directory, "lia.jpg")
+    Image.new("RGB", (64, 64), (200, 180, 160)).save(lia_path)
+    targets = []
+    for index in range(count):
+        size = (64, 48) if index % 2 else (48, 64)
+        path = os.path.join(directory, f"target_{index:06d}.jpg")
+        Image.new("RGB", size, (index % 256, (index // 256) % 256, 99)).save(path)
+        with open(os.path.join(directory, f"target_{index:06d}.txt"), "w") as f:
+            f.write(f"benchmark prompt {index}")
+        targets.append(path)
+    return lia_path, targets
+
+
+async def _sample_sockets(peak: list[int], interval: float = 0.05) -> None:
+    while True:
+        count = open_sockets()
+        if count is not None:
+            peak[0] = max(peak[0], count)
+        await asyncio.sleep(interval)
+
+
+async def _drive_pipeline(dataset_dir: str, lia_path: str) -> tuple[list[float], int]:
+    from utils.image_generator import ImageProcessorPipeline
+
+    latencies = []
+    failed = 0
+    started: dict[int, float] = {}
+    async with ImageProcessorPipeline(dataset_dir, lia_path) as pipeline:
+        scan_targets = pipeline.scan_targets
+
+        async def stamped_scan():
+            async for item in scan_targets():
+                started[item.index] = time.monotonic()
+                yield item
+
+        pipeline.scan_targets = stamped_scan
+        async for item in pipeline.stream_images():
+            if item.error is not None:
+                failed += 1
+            else:
+                latencies.append(time.monotonic() - started[item.index])
+    return latencies, failed
+
+
+async def _drive_gradio(lia_path: str, targets: list[str]) -> tuple[list[float], int]:
+    from gradio_app import process_images_pipeline
+
+    latencies = []
+    urls: list = []
+    started = time.monotonic()
+    async for _, urls, _ in process_images_pipeline(lia_path, [(path, None) for path in targets]):
+        # the handler yields the gallery after every finished image
+        latencies.extend([time.monotonic() - started] * (len(urls) - len(latencies)))
+    return latencies, len(targets) - len(urls)
+
+
+def _stdout_to_stderr() -> None:
+    # stdout only carries the JSON report; logs and progress bars of child processes (and their own children) go to stderr
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+
+def _serve(port: int, config: FakeServiceConfig, ready) -> None:
+    _stdout_to_stderr()
+    serve(port, config, ready)
+
+
+def run_scenario(mode: str, count: int, env: dict, workdir: str, results) -> None:
+    _stdout_to_stderr()
+    os.environ.update(env)
+    sys.path.insert(0, ROOT_DIR)
+    os.chdir(workdir)
+    dataset_dir = os.path.join(workdir, "dataset")
+    lia_path, targets = make_dataset(dataset_dir, count)
+    lia_copy = os.path.join(workdir, "lia.jpg")
+    os.replace(lia_path, lia_copy)
+
+    async def main() -> dict:
+        peak_sockets = [0]
+        sampler = asyncio.create_task(_sample_sockets(peak_sockets))
+        started = time.monotonic()
+        try:
+            if mode == "pipeline":
+                latencies, failed = await _drive_pipeline(dataset_dir, lia_copy)
+            else:
+                latencies, failed = await _drive_gradio(lia_copy, targets)
+        finally:
+            sampler.cancel()
+        duration = time.monotonic() - started
+        return {
+            "mode": mode,
+            "images": count,
+            "completed": len(latencies),
+            "failed": failed,
+            "duration_s": round(duration, 3),
+            "images_per_minute": round(len(latencies) / duration * 60, 2) if duration else None,
+            "latency_p50_s": percentile(latencies, 50),
+            "latency_p99_s": percentile(latencies, 99),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "peak_open_sockets": peak_sockets[0],
+        }
+
+    try:
+        results.put(asyncio.run(main()))
+    except ImportError as e:
+        results.put({"mode": mode, "images": count, "skipped": f"missing dependency: {e}"})
+    except Exception as e:
+        results.put({"mode": mode, "images": count, "error": repr(e)})
+    finally:
+        # pool workers would otherwise outlive a terminated scenario process
+        if "utils.preprocess" in sys.modules:
+            sys.modules["utils.preprocess"].shutdown_process_pool()
+
+
+def fetch_stats(port: int) -> dict:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats") as response:
+        return json.load(response)
+
+
+def main(argv=None) -> int:
+    parser = ArgumentParser(description="Benchmark the pipeline against local fake services")
+    parser.add_argument("--sizes", default="10,100,1000", help="comma-separated image counts")
+    parser.add_argument("--modes", default="pipeline,gradio", help="comma-separated: pipeline, gradio")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--output", default=None, help="write JSON results here (default: stdout)")
+    parser.add_argument("--generation-latency", type=float, default=2.0)
+    parser.add_argument("--generation-jitter", type=float, default=0.5)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of submits and downloads answered with 503")
+    parser.add_argument("--output-bytes", type=int, default=256 * 1024)
+    parser.add_argument("--grok-latency", type=float, default=0.5)
+    parser.add_argument("--timeout", type=float, default=3600, help="seconds allowed per scenario")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra pipeline settings")
+    args = parser.parse_args(argv)
+
+    fake_config = FakeServiceConfig(
+        generation_latency=args.generation_latency,
+        generation_jitter=args.generation_jitter,
+        failure_rate=args.failure_rate,
+        throttle_rate=args.throttle_rate,
+        error_rate=args.error_rate,
+        output_bytes=args.output_bytes,
+        grok_latency=args.grok_latency,
+    )
+    context = multiprocessing.get_context("spawn")
+    ready = context.Event()
+    server = context.Process(target=_serve, args=(args.port, fake_config, ready), daemon=True)
+    server.start()
+    if not ready.wait(30):
+        print("fake services did not start", file=sys.stderr)
+        return 1
+
+    extra_env = dict(pair.split("=", 1) for pair in args.env)
+    report = {
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "fake_services": asdict(fake_config),
+        "env": extra_env,
+        "results": [],
+    }
+    try:
+        for mode in [mode.strip() for mode in args.modes.split(",") if mode.strip()]:
+            for size in [int(size) for size in args.sizes.split(",") if size.strip()]:
+                before = fetch_stats(args.port)
+                with tempfile.TemporaryDirectory(prefix="pipeline-bench-") as workdir:
+                    results = context.Queue()
+                    env = {**service_env(args.port, workdir), **extra_env}
+                    child = context.Process(target=run_scenario, args=(mode, size, env, workdir, results))
+                    child.start()
+                    try:
+                        result = results.get(timeout=args.timeout)
+                    except Exception:
+                        result = {"mode": mode, "images": size, "error": "timed out"}
+                    child.join(10)
+                    if child.is_alive():
+                        child.terminate()
+                after = fetch_stats(args.port)
+                result["upstream_requests"] = {key: after[key] - before.get(key, 0) for key in after}
+                report["results"].append(result)
+                print(json.dumps(result), file=sys.stderr)
+    finally:
+        server.terminate()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,7 +4,146 @@ import os
 load_dotenv()
 
 GROK_API_KEY = os.getenv("OPENAI_API_KEY")
+GROK_BASE_URL = os.getenv("GROK_BASE_URL", "https://api.x.ai/v1")
+
+WAVESPEED_API_URL = os.getenv("WAVESPEED_API_URL", "https://api.wavespeed.ai/api/v3/bytedance/seedream-v4/edit")
+
+# Draft mode generates at DRAFT_LONG_SIDE (4:3, e.g. 1536*1152) instead of 4096*3072; chosen drafts
+# are then upscaled to UPSCALE_RESOLUTION by the Wavespeed upscaler at WAVESPEED_UPSCALE_URL
+DRAFT_LONG_SIDE = int(os.getenv("DRAFT_LONG_SIDE", "1536"))
+WAVESPEED_UPSCALE_URL = os.getenv("WAVESPEED_UPSCALE_URL", "https://api.wavespeed.ai/api/v3/wavespeed-ai/image-upscaler")
+UPSCALE_RESOLUTION = os.getenv("UPSCALE_RESOLUTION", "4k")
 
 CACHE_DIR='./cache'
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "database", "database.db")
\ No newline at end of file
+DB_PATH = os.getenv("DB_PATH", os.path.join(os.path.dirname(__file__), "database", "database.db"))
+
+# Shared aiohttp connection pool used for Wavespeed submit/poll and result downloads
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "200"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "64"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+# no limit on a whole request, since result bodies stream into R2 for as long as they take;
+# instead connecting and each read (the gap between two chunks) are bounded
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "15"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "120"))
+
+# Wavespeed result polling: interval grows with job age, bounded by a per-job deadline
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "2"))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "30"))
+POLL_BACKOFF_FACTOR = float(os.getenv("POLL_BACKOFF_FACTOR", "0.15"))
+POLL_DEADLINE = float(os.getenv("POLL_DEADLINE", "1800"))
+POLL_MAX_CONCURRENCY = int(os.getenv("POLL_MAX_CONCURRENCY", "32"))
+POLL_MAX_ERRORS = int(os.getenv("POLL_MAX_ERRORS", "5"))
+
+# Per-upstream rate limits (requests/second, 0 = unlimited), bursts and concurrency caps
+GROK_RATE = float(os.getenv("GROK_RATE", "5"))
+GROK_BURST = int(os.getenv("GROK_BURST", "10"))
+GROK_CONCURRENCY = int(os.getenv("GROK_CONCURRENCY", "8"))
+WAVESPEED_SUBMIT_RATE = float(os.getenv("WAVESPEED_SUBMIT_RATE", "5"))
+WAVESPEED_SUBMIT_BURST = int(os.getenv("WAVESPEED_SUBMIT_BURST", "10"))
+WAVESPEED_SUBMIT_CONCURRENCY = int(os.getenv("WAVESPEED_SUBMIT_CONCURRENCY", "10"))
+WAVESPEED_POLL_RATE = float(os.getenv("WAVESPEED_POLL_RATE", "20"))
+WAVESPEED_POLL_BURST = int(os.getenv("WAVESPEED_POLL_BURST", "40"))
+R2_RATE = float(os.getenv("R2_RATE", "0"))
+R2_BURST = int(os.getenv("R2_BURST", "50"))
+R2_CONCURRENCY = int(os.getenv("R2_CONCURRENCY", "16"))
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "5"))
+
+# Result downloads from Wavespeed's CDN (0 = unlimited rate)
+WAVESPEED_DOWNLOAD_RATE = float(os.getenv("WAVESPEED_DOWNLOAD_RATE", "0"))
+WAVESPEED_DOWNLOAD_CONCURRENCY = int(os.getenv("WAVESPEED_DOWNLOAD_CONCURRENCY", "32"))
+# start a second download when the first has not answered within this many seconds (0 = never)
+DOWNLOAD_HEDGE_AFTER = float(os.getenv("DOWNLOAD_HEDGE_AFTER", "0"))
+
+# Transient failures (5xx, dropped connections) are retried with full-jitter exponential backoff.
+# Process-wide, each call earns RETRY_BUDGET_RATIO retries and RETRY_BUDGET_MIN_PER_SECOND more
+# accrue over time, up to RETRY_BUDGET_MAX; retries beyond that fail fast instead of piling on
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "30"))
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("RETRY_BUDGET_MIN_PER_SECOND", "1"))
+RETRY_BUDGET_MAX = float(os.getenv("RETRY_BUDGET_MAX", "50"))
+# after this many consecutive transient failures a lane stops sending calls for CIRCUIT_RESET_TIMEOUT
+# seconds, then lets one probe call through; the pause doubles while probes keep failing
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "15"))
+CIRCUIT_MAX_RESET_TIMEOUT = float(os.getenv("CIRCUIT_MAX_RESET_TIMEOUT", "300"))
+
+# Streaming pipeline: workers per stage and queue depth between stages
+STAGE_UPLOAD_WORKERS = int(os.getenv("STAGE_UPLOAD_WORKERS", "8"))
+STAGE_PROMPT_WORKERS = int(os.getenv("STAGE_PROMPT_WORKERS", "8"))
+STAGE_SUBMIT_WORKERS = int(os.getenv("STAGE_SUBMIT_WORKERS", "8"))
+STAGE_DOWNLOAD_WORKERS = int(os.getenv("STAGE_DOWNLOAD_WORKERS", "8"))
+STAGE_DB_WORKERS = int(os.getenv("STAGE_DB_WORKERS", "2"))
+STAGE_QUEUE_SIZE = int(os.getenv("STAGE_QUEUE_SIZE", "64"))
+# Wavespeed jobs in flight at once, from submission until polling ends
+PIPELINE_MAX_IN_FLIGHT = int(os.getenv("PIPELINE_MAX_IN_FLIGHT", "100"))
+
+# Graceful shutdown (Ctrl-C, SIGTERM, the Gradio stop button): nothing new is submitted and jobs in flight get
+# SHUTDOWN_GRACE_SECONDS to finish before they are cancelled (their prediction URLs stay in the jobs table for
+# --resume); closing a pipeline (poll loop, pending DB writes, HTTP pool) is bounded by SHUTDOWN_CLOSE_TIMEOUT
+SHUTDOWN_GRACE_SECONDS = float(os.getenv("SHUTDOWN_GRACE_SECONDS", "30"))
+SHUTDOWN_CLOSE_TIMEOUT = float(os.getenv("SHUTDOWN_CLOSE_TIMEOUT", "10"))
+
+# R2 transfers run on a dedicated thread pool; R2_ENDPOINT_URL points at a local S3-compatible store for testing
+R2_ENDPOINT_URL = os.getenv("R2_ENDPOINT_URL")
+R2_IO_THREADS = int(os.getenv("R2_IO_THREADS", "16"))
+R2_MULTIPART_THRESHOLD = int(os.getenv("R2_MULTIPART_THRESHOLD", str(8 * 1024 * 1024)))
+R2_MULTIPART_CHUNKSIZE = int(os.getenv("R2_MULTIPART_CHUNKSIZE", str(8 * 1024 * 1024)))
+R2_MULTIPART_CONCURRENCY = int(os.getenv("R2_MULTIPART_CONCURRENCY", "4"))
+
+# Content-addressed R2 upload cache (SQLite); entries unused for UPLOAD_CACHE_TTL seconds or beyond
+# UPLOAD_CACHE_MAX_ENTRIES (least recently used first) are evicted
+UPLOAD_CACHE_PATH = os.getenv("UPLOAD_CACHE_PATH", os.path.join(CACHE_DIR, "r2_upload_cache.db"))
+UPLOAD_CACHE_MAX_ENTRIES = int(os.getenv("UPLOAD_CACHE_MAX_ENTRIES", "100000"))
+UPLOAD_CACHE_TTL = float(os.getenv("UPLOAD_CACHE_TTL", str(30 * 24 * 3600)))
+# cached uploads older than this are checked with a HEAD request before being reused
+UPLOAD_CACHE_VERIFY_AFTER = float(os.getenv("UPLOAD_CACHE_VERIFY_AFTER", str(24 * 3600)))
+
+# Only object keys are stored; GET URLs are presigned on demand and cached in memory
+# until fewer than R2_URL_MIN_REMAINING seconds of their R2_URL_EXPIRES_IN lifetime are left
+R2_URL_EXPIRES_IN = int(os.getenv("R2_URL_EXPIRES_IN", "72000"))
+R2_URL_MIN_REMAINING = int(os.getenv("R2_URL_MIN_REMAINING", "3600"))
+SIGNED_URL_CACHE_SIZE = int(os.getenv("SIGNED_URL_CACHE_SIZE", "100000"))
+
+# Stream Wavespeed results straight into R2 (multipart, no temp file); parts are buffered one at a time
+RESULT_STREAMING = os.getenv("RESULT_STREAMING", "1") not in ("0", "false", "False")
+R2_STREAM_PART_SIZE = int(os.getenv("R2_STREAM_PART_SIZE", str(5 * 1024 * 1024)))
+
+# WebP thumbnail and preview stored next to every result (results/<job>.thumb.webp, .preview.webp)
+RESULT_DERIVATIVES = os.getenv("RESULT_DERIVATIVES", "1") not in ("0", "false", "False")
+THUMBNAIL_MAX_SIDE = int(os.getenv("THUMBNAIL_MAX_SIDE", "384"))
+PREVIEW_MAX_SIDE = int(os.getenv("PREVIEW_MAX_SIDE", "1536"))
+DERIVATIVE_WEBP_QUALITY = int(os.getenv("DERIVATIVE_WEBP_QUALITY", "80"))
+
+# jobs database: WAL mode, busy timeout and write coalescing
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", "0.05"))
+DB_FLUSH_BATCH_SIZE = int(os.getenv("DB_FLUSH_BATCH_SIZE", "200"))
+
+# Worker mode: queued jobs are claimed from JOB_STORE_URL with expiring leases, renewed by heartbeats
+JOB_STORE_URL = os.getenv("JOB_STORE_URL", f"sqlite:///{DB_PATH}")
+WORKER_CAPACITY = int(os.getenv("WORKER_CAPACITY", "100"))
+WORKER_LEASE_SECONDS = float(os.getenv("WORKER_LEASE_SECONDS", "120"))
+WORKER_CLAIM_INTERVAL = float(os.getenv("WORKER_CLAIM_INTERVAL", "2"))
+WORKER_MAX_ATTEMPTS = int(os.getenv("WORKER_MAX_ATTEMPTS", "3"))
+
+# Persistent Grok prompt cache, bounded to PROMPT_CACHE_MAX_ENTRIES (least recently used evicted)
+PROMPT_CACHE_PATH = os.getenv("PROMPT_CACHE_PATH", os.path.join(CACHE_DIR, "prompt_cache.db"))
+PROMPT_CACHE_MAX_ENTRIES = int(os.getenv("PROMPT_CACHE_MAX_ENTRIES", "50000"))
+
+# Image work (downscaled Grok vision payloads, JPEG conversion, result renditions) runs in a process pool
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", str(min(8, os.cpu_count() or 1))))
+VISION_MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", "1024"))
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "85"))
+# quality used when an in-memory upload has to be converted to JPEG (JPEG, PNG and WebP are uploaded unchanged)
+UPLOAD_JPEG_QUALITY = int(os.getenv("UPLOAD_JPEG_QUALITY", "95"))
+
+# Prometheus-style metrics endpoint (http://METRICS_HOST:METRICS_PORT/metrics); 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Gradio app: batches run concurrently (sharing HTTP session, R2 client and DB), extra clicks wait in the queue
+GRADIO_CONCURRENCY = int(os.getenv("GRADIO_CONCURRENCY", "4"))
+GRADIO_QUEUE_SIZE = int(os.getenv("GRADIO_QUEUE_SIZE", "32"))
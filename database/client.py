@@ -1,5 +1,8 @@
+import asyncio
+import itertools
 import sqlite3
-from config import DB_PATH
+from config import DB_PATH, DB_BUSY_TIMEOUT_MS, DB_FLUSH_INTERVAL, DB_FLUSH_BATCH_SIZE
+from database.migrations import migrate
 from uuid import uuid4
 from termcolor import cprint
 import aiosqlite
@@ -11,45 +14,347 @@ class Job(TypedDict):
     target_image_key: str
     wavespeed_result_url: Optional[str]
     r2_image_key: Optional[str]
-    r2_presigned_url: Optional[str]
+    thumbnail_key: Optional[str]
+    preview_key: Optional[str]
     status: str
+    fingerprint: Optional[str]
+    prompt: Optional[str]
+    size: Optional[str]
+    upload_seconds: Optional[float]
+    prompt_seconds: Optional[float]
+    submit_seconds: Optional[float]
+    queue_wait_seconds: Optional[float]
+    generation_seconds: Optional[float]
+    download_seconds: Optional[float]
+    reupload_seconds: Optional[float]
+    db_write_seconds: Optional[float]
+    # calls retried for this job (throttling and transient failures)
+    retries: Optional[int]
+    # set on rows queued for workers (see database.job_store)
+    target_object_key: Optional[str]
+    lia_object_key: Optional[str]
+    lease_owner: Optional[str]
+    lease_expires_at: Optional[float]
+    attempts: Optional[int]
+    # 'draft' (low-resolution preview) or 'full'; an upscale links to its draft through parent_job_id
+    tier: Optional[str]
+    parent_job_id: Optional[str]
+
+
+# per-stage durations written when a job is recorded (see utils.metrics.SPANS)
+SPAN_COLUMNS = (
+    'upload_seconds',
+    'prompt_seconds',
+    'submit_seconds',
+    'queue_wait_seconds',
+    'generation_seconds',
+    'download_seconds',
+    'reupload_seconds',
+    'db_write_seconds',
+)
+
+# jobs that were submitted to Wavespeed but never reached a terminal state
+INCOMPLETE_STATUSES = ('pending', 'submitted')
+
+# jobs that are queued for workers or on their way to a result
+ACTIVE_STATUSES = ('queued', 'pending', 'submitted')
+
+_INSERT_COLUMNS = (
+    'id',
+    'lia_image_key',
+    'target_image_key',
+    'wavespeed_result_url',
+    'r2_image_key',
+    'thumbnail_key',
+    'preview_key',
+    'status',
+    'fingerprint',
+    'prompt',
+    'size',
+    'target_object_key',
+    'lia_object_key',
+    'tier',
+    'parent_job_id',
+)
+
+# columns update_job() and JobStore implementations may write; anything else in a Job is ignored
+UPDATABLE_COLUMNS = (
+    'wavespeed_result_url',
+    'r2_image_key',
+    'thumbnail_key',
+    'preview_key',
+    'status',
+    'fingerprint',
+    'prompt',
+    'size',
+    'retries',
+    'attempts',
+    *SPAN_COLUMNS,
+)
+
+_migrated_paths: set[str] = set()
 
 
 class DatabaseClient:
+    """
+    Jobs table access over one long-lived WAL-mode connection.
+
+    Writes are queued and committed together by a background flusher, either
+    after `flush_interval` seconds or once `batch_size` writes are waiting.
+    Callers still await their own write, so create_job returns only after
+    the row is committed.
+    """
+
+    def __init__(self, db_path: str = DB_PATH, flush_interval: float = DB_FLUSH_INTERVAL, batch_size: int = DB_FLUSH_BATCH_SIZE) -> None:
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._connect_lock = asyncio.Lock()
+        self._write_lock = asyncio.Lock()
+        self._pending: list[tuple[str, tuple, asyncio.Future]] = []
+        self._batch_full = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def _connection(self) -> aiosqlite.Connection:
+        if self._conn is not None:
+            return self._conn
+        async with self._connect_lock:
+            if self._conn is None:
+                if self.db_path not in _migrated_paths:
+                    await asyncio.to_thread(migrate, self.db_path)
+                    _migrated_paths.add(self.db_path)
+                conn = await aiosqlite.connect(self.db_path, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+                conn.row_factory = aiosqlite.Row
+                await conn.execute("PRAGMA journal_mode=WAL")
+                await conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+                await conn.execute("PRAGMA synchronous=NORMAL")
+                self._conn = conn
+        return self._conn
+
+    async def close(self) -> None:
+        await self.flush()
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    async def _write(self, sql: str, params: tuple) -> None:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((sql, params, future))
+        if len(self._pending) >= self.batch_size:
+            self._batch_full.set()
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+        await future
+
+    async def _flush_later(self) -> None:
+        try:
+            await asyncio.wait_for(self._batch_full.wait(), self.flush_interval)
+        except asyncio.TimeoutError:
+            pass
+        self._batch_full.clear()
+        try:
+            await self.flush()
+        except BaseException as e:
+            # nobody awaits this task; hand the error to the writes still queued behind the failed batch
+            pending, self._pending = self._pending, []
+            self._fail(pending, e)
+            if not isinstance(e, Exception):
+                raise
+
+    async def flush(self) -> None:
+        """
+        Commit every queued write now.
+        """
+        async with self._write_lock:
+            while self._pending:
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+                try:
+                    await self._commit_batch(batch)
+                except BaseException as e:
+                    self._fail(batch, e)
+                    raise
+
+    @staticmethod
+    def _fail(batch: list[tuple[str, tuple, asyncio.Future]], error: BaseException) -> None:
+        for _, _, future in batch:
+            if future.done():
+                continue
+            if isinstance(error, Exception):
+                future.set_exception(error)
+            else:
+                future.cancel()
+
+    async def _commit_batch(self, batch: list[tuple[str, tuple, asyncio.Future]]) -> None:
+        try:
+            conn = await self._connection()
+        except Exception as e:
+            # e.g. an unwritable DB_PATH or a failed migration
+            self._fail(batch, e)
+            return
+        try:
+            # consecutive writes with the same statement go out as one executemany
+            for sql, writes in itertools.groupby(batch, key=lambda write: write[0]):
+                await conn.executemany(sql, [params for _, params, _ in writes])
+            await conn.commit()
+        except Exception as e:
+            await conn.rollback()
+            if len(batch) > 1:
+                # retry one by one so a single bad row doesn't fail its neighbours
+                for write in batch:
+                    await self._commit_batch([write])
+                return
+            self._fail(batch, e)
+            return
+        for _, _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    @staticmethod
+    def _insert_params(job_id: str, job: Job) -> tuple:
+        row = {'status': 'pending', 'tier': 'full', **job, 'id': job_id}
+        return tuple(row.get(column) for column in _INSERT_COLUMNS)
+
     async def create_job(self, job: Job) -> str:
+        job_ids = await self.create_jobs([job])
+        return job_ids[0] if job_ids else None
+
+    async def create_jobs(self, jobs: list[Job]) -> list[str]:
         try:
-            job_id = str(uuid4())
-            async with aiosqlite.connect(DB_PATH) as conn:
-                await conn.execute('''
-                    INSERT INTO jobs (id, lia_image_key, target_image_key, wavespeed_result_url, r2_image_key, r2_presigned_url, status)
-                    VALUES (?, ?, ?, ?, ?, ?, 'pending')
-                ''', (job_id, job.get('lia_image_key'), job.get('target_image_key'), job.get('wavespeed_result_url'), job.get('r2_image_key'), job.get('r2_presigned_url')))
-                await conn.commit()
-            return job_id
+            job_ids = [str(uuid4()) for _ in jobs]
+            sql = f'''
+                INSERT INTO jobs ({', '.join(_INSERT_COLUMNS)})
+                VALUES ({', '.join('?' for _ in _INSERT_COLUMNS)})
+            '''
+            await asyncio.gather(*[self._write(sql, self._insert_params(job_id, job)) for job_id, job in zip(job_ids, jobs)])
+            return job_ids
         except Exception as e:
             cprint(f"Error creating job: {e}", "red")
             return None
-    
+
     async def update_job(self, job_id: str, job: Job) -> bool:
+        """
+        Update only the columns present in `job`.
+        """
+        return await self.update_jobs([(job_id, job)])
+
+    async def update_jobs(self, updates: list[tuple[str, Job]]) -> bool:
         try:
-            async with aiosqlite.connect(DB_PATH) as conn:
-                await conn.execute('''
-                    UPDATE jobs SET wavespeed_result_url = ?, r2_image_key = ?, r2_presigned_url = ?, status = ? WHERE id = ?
-                ''', (job.get('wavespeed_result_url'), job.get('r2_image_key'), job.get('r2_presigned_url'), job.get('status'), job_id))
-                await conn.commit()
+            writes = []
+            for job_id, job in updates:
+                columns = [column for column in UPDATABLE_COLUMNS if column in job]
+                if not columns:
+                    continue
+                sql = f"UPDATE jobs SET {', '.join(f'{column} = ?' for column in columns)} WHERE id = ?"
+                writes.append(self._write(sql, (*[job[column] for column in columns], job_id)))
+            await asyncio.gather(*writes)
             return True
         except Exception as e:
             cprint(f"Error updating job: {e}", "red")
             return False
 
+    async def mark_submitted(self, job_id: str, prediction_url: str) -> bool:
+        """
+        Persist the Wavespeed prediction URL as soon as it exists so the job can be resumed.
+        """
+        return await self.update_job(job_id, {
+            "wavespeed_result_url": prediction_url,
+            "status": "submitted"
+        })
+
+    async def execute_now(self, sql: str, params: tuple = ()) -> list[Job]:
+        """
+        Run one statement and commit it immediately, outside the write batches.
+        For writes whose result the caller needs at once, like lease claims; returns any RETURNING rows.
+        """
+        async with self._write_lock:
+            conn = await self._connection()
+            try:
+                cursor = await conn.execute(sql, params)
+                rows = await cursor.fetchall()
+                await cursor.close()
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+        return [dict(row) for row in rows]
+
+    async def _fetchone(self, sql: str, params: tuple) -> Optional[Job]:
+        conn = await self._connection()
+        cursor = await conn.execute(sql, params)
+        row = await cursor.fetchone()
+        await cursor.close()
+        return dict(row) if row else None
+
+    async def _fetchall(self, sql: str, params: tuple) -> list[Job]:
+        conn = await self._connection()
+        cursor = await conn.execute(sql, params)
+        rows = await cursor.fetchall()
+        await cursor.close()
+        return [dict(row) for row in rows]
+
     async def get_job(self, job_id: str) -> Optional[Job]:
         try:
-            async with aiosqlite.connect(DB_PATH) as conn:
-                result = await conn.execute('''
-                    SELECT * FROM jobs WHERE id = ?
-                ''', (job_id,))
-                row = await result.fetchone()
-                return row    
+            return await self._fetchone('''
+                SELECT * FROM jobs WHERE id = ?
+            ''', (job_id,))
         except Exception as e:
             cprint(f"Error getting job: {e}", "red")
             return None
+
+    async def find_completed_job(self, fingerprint: str) -> Optional[Job]:
+        try:
+            return await self._fetchone('''
+                SELECT * FROM jobs WHERE fingerprint = ? AND status = 'completed'
+                ORDER BY created_at DESC LIMIT 1
+            ''', (fingerprint,))
+        except Exception as e:
+            cprint(f"Error finding completed job: {e}", "red")
+            return None
+
+    async def find_active_job(self, fingerprint: str) -> Optional[Job]:
+        """
+        Oldest job with this fingerprint that is queued, being submitted or submitted.
+        """
+        try:
+            return await self._fetchone(f'''
+                SELECT * FROM jobs
+                WHERE fingerprint = ? AND status IN ({', '.join('?' for _ in ACTIVE_STATUSES)})
+                ORDER BY created_at ASC LIMIT 1
+            ''', (fingerprint, *ACTIVE_STATUSES))
+        except Exception as e:
+            cprint(f"Error finding active job: {e}", "red")
+            return None
+
+    async def get_recent_completed_jobs(self, limit: int = 100) -> list[Job]:
+        """
+        Newest completed jobs with a result in R2, for history views.
+        """
+        try:
+            return await self._fetchall('''
+                SELECT * FROM jobs
+                WHERE status = 'completed' AND r2_image_key IS NOT NULL
+                ORDER BY created_at DESC LIMIT ?
+            ''', (limit,))
+        except Exception as e:
+            cprint(f"Error getting recent jobs: {e}", "red")
+            return []
+
+    async def get_incomplete_jobs(self) -> list[Job]:
+        """
+        Jobs that have a prediction URL but never finished, oldest first.
+        """
+        try:
+            return await self._fetchall(f'''
+                SELECT * FROM jobs
+                WHERE status IN ({', '.join('?' for _ in INCOMPLETE_STATUSES)}) AND wavespeed_result_url IS NOT NULL
+                ORDER BY created_at ASC
+            ''', INCOMPLETE_STATUSES)
+        except Exception as e:
+            cprint(f"Error getting incomplete jobs: {e}", "red")
+            return []
@@ -0,0 +1,163 @@
+import time
+from abc import ABC, abstractmethod
+from typing import Iterable, Optional
+from urllib.parse import urlparse
+
+from config import DB_PATH, JOB_STORE_URL, WORKER_MAX_ATTEMPTS
+from database.client import DatabaseClient, Job, UPDATABLE_COLUMNS
+
+# queued rows have not been submitted yet; submitted rows resume polling when reclaimed
+CLAIMABLE_STATUSES = ('queued', 'submitted')
+
+
+class JobStore(ABC):
+    """
+    Queue of jobs shared by worker processes, possibly on different hosts.
+
+    Workers claim rows with a lease that expires unless renewed by heartbeat(),
+    so the rows of a worker that dies are claimed again by the others.
+    Implement this class to put the queue in another database.
+    """
+
+    # claims per job before a worker gives up on it
+    max_attempts: int = WORKER_MAX_ATTEMPTS
+
+    @abstractmethod
+    async def enqueue(self, jobs: list[Job]) -> list[str]:
+        """
+        Add jobs with status 'queued' and return their ids.
+        """
+
+    @abstractmethod
+    async def find_active(self, fingerprint: str) -> Optional[Job]:
+        """
+        A job with this fingerprint that is queued, leased or submitted, if any.
+        """
+
+    @abstractmethod
+    async def claim(self, worker_id: str, limit: int, lease_seconds: float) -> list[Job]:
+        """
+        Lease up to `limit` claimable jobs (queued, or submitted with an expired lease), oldest first.
+        """
+
+    @abstractmethod
+    async def heartbeat(self, worker_id: str, job_ids: Iterable[str], lease_seconds: float) -> set[str]:
+        """
+        Extend the worker's leases and return the ids it still holds.
+        """
+
+    @abstractmethod
+    async def update(self, worker_id: str, job_id: str, job: Job) -> bool:
+        """
+        Write columns of a job the worker holds, keeping the lease. False if the lease was lost.
+        """
+
+    @abstractmethod
+    async def release(self, worker_id: str, job_id: str, job: Job) -> bool:
+        """
+        Write columns and give the lease up so another worker can claim the job right away.
+        """
+
+    @abstractmethod
+    async def complete(self, job_id: str, job: Job) -> None:
+        """
+        Record a finished job and drop its lease, even if the lease has expired meanwhile.
+        """
+
+    async def close(self) -> None:
+        pass
+
+
+class SqliteJobStore(JobStore):
+    """
+    JobStore in the jobs table of the SQLite database. Claims are a single
+    UPDATE ... RETURNING, so concurrent workers never lease the same row.
+
+    Every worker must open the same database file, so all of them run on one
+    host (or share a filesystem with working locks).
+    """
+
+    def __init__(self, database_client: Optional[DatabaseClient] = None, db_path: str = DB_PATH, max_attempts: int = WORKER_MAX_ATTEMPTS) -> None:
+        self.database_client = database_client or DatabaseClient(db_path)
+        self._owns_database_client = database_client is None
+        self.max_attempts = max_attempts
+
+    async def enqueue(self, jobs: list[Job]) -> list[str]:
+        return await self.database_client.create_jobs([{**job, 'status': 'queued'} for job in jobs])
+
+    async def find_active(self, fingerprint: str) -> Optional[Job]:
+        return await self.database_client.find_active_job(fingerprint)
+
+    async def claim(self, worker_id: str, limit: int, lease_seconds: float) -> list[Job]:
+        now = time.time()
+        statuses = ', '.join('?' for _ in CLAIMABLE_STATUSES)
+        return await self.database_client.execute_now(f'''
+            UPDATE jobs
+            SET lease_owner = ?, lease_expires_at = ?, attempts = COALESCE(attempts, 0) + 1
+            WHERE id IN (
+                SELECT id FROM jobs
+                WHERE status IN ({statuses})
+                  AND COALESCE(attempts, 0) < ?
+                  AND (lease_expires_at < ? OR (lease_expires_at IS NULL AND status = 'queued'))
+                ORDER BY created_at ASC
+                LIMIT ?
+            )
+            RETURNING *
+        ''', (worker_id, now + lease_seconds, *CLAIMABLE_STATUSES, self.max_attempts, now, limit))
+
+    async def heartbeat(self, worker_id: str, job_ids: Iterable[str], lease_seconds: float) -> set[str]:
+        job_ids = list(job_ids)
+        if not job_ids:
+            return set()
+        rows = await self.database_client.execute_now(f'''
+            UPDATE jobs SET lease_expires_at = ?
+            WHERE lease_owner = ? AND id IN ({', '.join('?' for _ in job_ids)})
+            RETURNING id
+        ''', (time.time() + lease_seconds, worker_id, *job_ids))
+        return {row['id'] for row in rows}
+
+    @staticmethod
+    def _assignments(job: Job) -> tuple[list[str], list]:
+        columns = [column for column in UPDATABLE_COLUMNS if column in job]
+        return [f'{column} = ?' for column in columns], [job[column] for column in columns]
+
+    async def update(self, worker_id: str, job_id: str, job: Job) -> bool:
+        assignments, values = self._assignments(job)
+        if not assignments:
+            return True
+        rows = await self.database_client.execute_now(f'''
+            UPDATE jobs SET {', '.join(assignments)} WHERE id = ? AND lease_owner = ? RETURNING id
+        ''', (*values, job_id, worker_id))
+        return bool(rows)
+
+    async def release(self, worker_id: str, job_id: str, job: Job) -> bool:
+        assignments, values = self._assignments(job)
+        rows = await self.database_client.execute_now(f'''
+            UPDATE jobs SET {', '.join([*assignments, 'lease_owner = NULL', 'lease_expires_at = 0'])}
+            WHERE id = ? AND lease_owner = ? RETURNING id
+        ''', (*values, job_id, worker_id))
+        return bool(rows)
+
+    async def complete(self, job_id: str, job: Job) -> None:
+        assignments, values = self._assignments(job)
+        await self.database_client.execute_now(f'''
+            UPDATE jobs SET {', '.join([*assignments, 'lease_owner = NULL', 'lease_expires_at = NULL'])}
+            WHERE id = ?
+        ''', (*values, job_id))
+
+    async def close(self) -> None:
+        if self._owns_database_client:
+            await self.database_client.close()
+
+
+def open_job_store(url: str = JOB_STORE_URL, database_client: Optional[DatabaseClient] = None) -> JobStore:
+    """
+    JobStore for a URL: sqlite:///relative.db or sqlite:////absolute/path.db. A bare path means SQLite too.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme in ('', 'sqlite'):
+        path = parsed.path[1:] if parsed.scheme else url
+        if database_client is not None and database_client.db_path != path:
+            raise ValueError(f"database client is for {database_client.db_path}, not {path}")
+        return SqliteJobStore(database_client, db_path=path)
+    raise ValueError(f"Unsupported job store {url!r}; only sqlite:// is implemented")
@@ -1,22 +1,6 @@
-import sqlite3
 from config import DB_PATH
+from database.migrations import migrate
 
-conn = sqlite3.connect(DB_PATH)
-cursor = conn.cursor()
-
-cursor.execute('''
-  CREATE TABLE jobs (
-      id TEXT PRIMARY KEY,
-      lia_image_key TEXT NOT NULL,
-      target_image_key TEXT NOT NULL,
-      wavespeed_result_url TEXT,
-      r2_image_key TEXT,
-      r2_presigned_url TEXT,
-      url_expires_at TIMESTAMP,
-      status TEXT DEFAULT 'pending',
-      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-  );
-  ''')
-
-conn.commit()
-conn.close()
\ No newline at end of file
+if __name__ == "__main__":
+    version = migrate(DB_PATH)
+    print(f"Database at {DB_PATH} is at schema version {version}")
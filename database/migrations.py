@@ -0,0 +1,99 @@
+import sqlite3
+from typing import Callable
+
+from termcolor import cprint
+
+
+def _create_jobs(conn: sqlite3.Connection) -> None:
+    conn.execute('''
+      CREATE TABLE IF NOT EXISTS jobs (
+          id TEXT PRIMARY KEY,
+          lia_image_key TEXT NOT NULL,
+          target_image_key TEXT NOT NULL,
+          wavespeed_result_url TEXT,
+          r2_image_key TEXT,
+          r2_presigned_url TEXT,
+          url_expires_at TIMESTAMP,
+          status TEXT DEFAULT 'pending',
+          created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+      )
+    ''')
+
+
+def _add_columns(table: str, columns: dict[str, str]) -> Callable[[sqlite3.Connection], None]:
+    def migration(conn: sqlite3.Connection) -> None:
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for column, column_type in columns.items():
+            if column not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+    return migration
+
+
+def _clear_presigned_urls(conn: sqlite3.Connection) -> None:
+    # URLs are signed on demand from r2_image_key now; stored ones only ever expire
+    conn.execute("UPDATE jobs SET r2_presigned_url = NULL, url_expires_at = NULL")
+
+
+def _add_job_indexes(conn: sqlite3.Connection) -> None:
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_created_at ON jobs (created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_target_image_key ON jobs (target_image_key)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_fingerprint ON jobs (fingerprint)")
+
+
+def _add_lease_index(conn: sqlite3.Connection) -> None:
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_lease ON jobs (status, lease_expires_at)")
+
+
+# Append only. Each migration runs once, in order, and PRAGMA user_version records the last one applied.
+MIGRATIONS: list[tuple[str, Callable[[sqlite3.Connection], None]]] = [
+    ("create jobs table", _create_jobs),
+    ("add resume columns", _add_columns("jobs", {"fingerprint": "TEXT", "prompt": "TEXT", "size": "TEXT"})),
+    ("index jobs by status, created_at, target and fingerprint", _add_job_indexes),
+    ("add per-stage timing columns", _add_columns("jobs", {
+        "upload_seconds": "REAL",
+        "prompt_seconds": "REAL",
+        "submit_seconds": "REAL",
+        "queue_wait_seconds": "REAL",
+        "generation_seconds": "REAL",
+        "download_seconds": "REAL",
+        "reupload_seconds": "REAL",
+        "db_write_seconds": "REAL",
+    })),
+    ("stop storing presigned URLs", _clear_presigned_urls),
+    ("add result rendition keys", _add_columns("jobs", {"thumbnail_key": "TEXT", "preview_key": "TEXT"})),
+    ("add worker queue and lease columns", _add_columns("jobs", {
+        "target_object_key": "TEXT",
+        "lia_object_key": "TEXT",
+        "lease_owner": "TEXT",
+        "lease_expires_at": "REAL",
+        "attempts": "INTEGER DEFAULT 0",
+    })),
+    ("index jobs by status and lease expiry", _add_lease_index),
+    ("add retry count", _add_columns("jobs", {"retries": "INTEGER DEFAULT 0"})),
+    ("add generation tier and parent job", _add_columns("jobs", {"tier": "TEXT DEFAULT 'full'", "parent_job_id": "TEXT"})),
+]
+
+
+def migrate(db_path: str) -> int:
+    """
+    Bring the database at `db_path` up to the latest schema version and return it.
+    Safe to call from several processes: migrations run inside an exclusive transaction.
+    """
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("BEGIN EXCLUSIVE")
+        try:
+            (version,) = conn.execute("PRAGMA user_version").fetchone()
+            for number, (name, migration) in enumerate(MIGRATIONS[version:], start=version + 1):
+                cprint(f"Applying migration {number}: {name}", "yellow")
+                migration(conn)
+                conn.execute(f"PRAGMA user_version = {number}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return len(MIGRATIONS)
+    finally:
+        conn.close()
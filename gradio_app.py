@@ -1,146 +1,422 @@
-import gradio as gr
-import tempfile
 import asyncio
+from contextlib import contextmanager
 from pathlib import Path
-from PIL import Image
-from utils.image_generator import ImageProcessorPipeline
+from utils.image_generator import ImageProcessorPipeline, TargetInput
+from utils.cancellation import BatchCancelled, CancellationToken
 from dotenv import load_dotenv
-from utils.grok import generate_seedream_prompt
-from termcolor import cprint
+from utils.grok import PromptGenerator
+from utils.http_client import create_http_session
+from utils.r2_client import get_r2_client
+from utils.rate_limit import ExecutionLimits
+from database.client import DatabaseClient
+from config import GRADIO_CONCURRENCY, GRADIO_QUEUE_SIZE, SHUTDOWN_GRACE_SECONDS
+from typing import Iterator, Optional
 from uuid import uuid4
 
 load_dotenv()
 
-async def generate_descriptions_with_grok(lia_image_path: str, target_image_paths: list[str]):
+
+class SharedResources:
     """
-    Generate descriptions for target images using Grok API
+    HTTP session, R2 client, jobs database and rate-limit lanes shared by every
+    Gradio request, so concurrent batches reuse one connection pool and share
+    the upstream rate limits. Created lazily inside Gradio's event loop.
     """
-    tasks = [generate_seedream_prompt(target_path, lia_image_path) for target_path in target_image_paths]
-    descriptions = await asyncio.gather(*tasks)
-    for description in descriptions:
-        cprint(f"Description: {description}", "yellow")
-    return descriptions
 
-async def process_images_pipeline(lia_image, target_images):
+    def __init__(self) -> None:
+        self.session = None
+        self.r2_client = None
+        self.database_client = None
+        self.limits = None
+
+    def get(self) -> "SharedResources":
+        if self.session is None or self.session.closed:
+            self.session = create_http_session()
+        if self.r2_client is None:
+            self.r2_client = get_r2_client()
+        if self.database_client is None:
+            self.database_client = DatabaseClient()
+        if self.limits is None:
+            self.limits = ExecutionLimits.from_config()
+        return self
+
+
+shared_resources = SharedResources()
+
+# Gradio session -> tokens of the batches it is running, for the stop button
+_running_batches: dict[str, set[CancellationToken]] = {}
+
+
+@contextmanager
+def batch_token(session: Optional[str]) -> Iterator[CancellationToken]:
+    token = CancellationToken()
+    if session is None:
+        yield token
+        return
+    _running_batches.setdefault(session, set()).add(token)
+    try:
+        yield token
+    finally:
+        tokens = _running_batches.get(session, set())
+        tokens.discard(token)
+        if not tokens:
+            _running_batches.pop(session, None)
+
+
+def stop_batches(session: Optional[str]) -> str:
+    """
+    Stop the session's running batches: nothing new is submitted, and jobs in
+    flight get SHUTDOWN_GRACE_SECONDS to finish before they are cancelled.
+    """
+    tokens = _running_batches.get(session) if session is not None else None
+    if not tokens:
+        return "Nothing is running."
+    for token in tokens:
+        token.stop(SHUTDOWN_GRACE_SECONDS, "stopped from the UI")
+    return f"Stopping: no new images will be submitted; jobs in flight get {SHUTDOWN_GRACE_SECONDS:.0f}s to finish."
+
+
+def read_targets(target_images) -> list[TargetInput]:
     """
-    Main pipeline function that processes images
+    Original bytes of every gallery upload; a gallery caption, if any, is used as the prompt.
+    """
+    batch_name = f"{uuid4()}"
+    return [
+        TargetInput(data=Path(path).read_bytes(), prompt=caption or None, name=f"{batch_name}_target_{i:03d}")
+        for i, (path, caption) in enumerate(target_images)
+    ]
+
+
+def result_links(urls: dict[str, str], full_url: str, preview_key: str = None, job_id: str = None, tier: str = None) -> dict:
+    return {"full": full_url, "preview": urls.get(preview_key), "job_id": job_id, "tier": tier}
+
+
+def show_full_resolution(links: list[dict], index: Optional[int]):
+    """
+    The gallery only shows thumbnails; link the selected result's preview and full-resolution image.
+    """
+    if index is None or index >= len(links):
+        return ""
+    link = links[index]
+    parts = [f"[Open preview]({link['preview']})"] if link.get("preview") else []
+    parts.append(f"[Open draft]({link['full']})" if link.get("tier") == "draft" else f"[Open full resolution]({link['full']})")
+    return " · ".join(parts)
+
+
+async def process_images_pipeline(lia_image, target_images, draft: bool = False, session: Optional[str] = None):
+    """
+    Main pipeline handler. Yields (status, gallery, links) after every finished image,
+    so results show up in the gallery while the rest of the batch is still running.
+    The gallery gets WebP thumbnails; `links` holds the preview and full-resolution URLs.
+    With `draft`, results are low-resolution drafts to pick from for upscale_drafts().
+    `session` registers the batch with stop_batches(). Closing the tab cancels it;
+    submitted jobs keep their prediction URLs in the jobs table for a later resume.
+
+    Uploads are passed to the pipeline in memory as their original bytes, so
+    nothing is decoded, re-encoded or staged in a temporary directory.
     """
     if not lia_image or not target_images:
-        return "Error: Please upload both lia image and target images."
-    
-    try:
-        # Create temporary directory for processing
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Create temporary path for processing
-            temp_path = Path(temp_dir)
-            # Save lia image
-            lia_path = temp_path / "lia.jpg"
-            lia_image.save(lia_path)
-            file_name = f"{uuid4()}"
-            # Save target images (convert from file uploads to PIL Images)
-            for i, target_file in enumerate(target_images):
-                target_img = target_file[0]
-                target_img = Image.open(target_img)
-                img_name = f"{file_name}_target_{i:03d}"
-                img_path = temp_path / f"{img_name}.jpg"
-                target_img.save(img_path)
-
-            # Generate all descriptions at once
-            target_paths = [str(temp_path / f"{file_name}_target_{i:03d}.jpg") for i in range(len(target_images))]
-            descriptions = await generate_descriptions_with_grok(str(lia_path), target_paths)
-            
-            # Write description files
-            for i, description in enumerate(descriptions):
-                img_name = f"{file_name}_target_{i:03d}"
-                desc_path = temp_path / f"{img_name}.txt"
-               
-                with open(desc_path, 'w') as f:
-                    f.write(description)
-            
-            # Initialize and run the pipeline
-            pipeline = ImageProcessorPipeline(
-                source_dir=str(temp_path),
-                lia_image_path=str(lia_path)
-            )
-            
-            result_urls = await pipeline.process_images()
-            
-            return f"Successfully processed {len(target_images)} images!", result_urls
-            
-    except Exception as e:
-        return f"Error processing images: {str(e)}", []
+        yield "Error: Please upload both lia image and target images.", [], []
+        return
+
+    resources = shared_resources.get()
+    total = len(target_images)
+    thumbnails = []
+    links = []
+    failed = 0
+    not_started = 0
+    with batch_token(session) as cancel_token:
+        try:
+            targets = await asyncio.to_thread(read_targets, target_images)
+            yield f"Processing 0/{total} images...", thumbnails, links
 
-def run_pipeline(lia_image, target_images):
+            # Initialize and run the pipeline; descriptions are generated with Grok
+            # in the pipeline's prompt stage while other targets upload and process
+            async with ImageProcessorPipeline(
+                source_dir=None,
+                lia_image_path=lia_image,
+                session=resources.session,
+                limits=resources.limits,
+                prompt_generator=PromptGenerator(lia_image),
+                r2_client=resources.r2_client,
+                database_client=resources.database_client,
+                targets=targets,
+                draft=draft,
+                cancel_token=cancel_token,
+            ) as pipeline:
+                async for item in pipeline.stream_images():
+                    if item.error is None and item.r2_url:
+                        urls = resources.r2_client.sign_many([item.thumbnail_key, item.preview_key])
+                        thumbnails.append(urls.get(item.thumbnail_key) or item.r2_url)
+                        links.append(result_links(urls, item.r2_url, item.preview_key, item.job_id, item.tier))
+                    elif isinstance(item.error, BatchCancelled):
+                        not_started += 1
+                    else:
+                        failed += 1
+                    done = len(thumbnails) + failed + not_started
+                    yield f"Processing {done}/{total} images ({failed} failed)...", list(thumbnails), list(links)
+
+            if cancel_token.stopping:
+                yield f"Stopped: processed {len(thumbnails)} of {total} images, {not_started} not started.", thumbnails, links
+            else:
+                yield f"Successfully processed {len(thumbnails)} of {total} images!", thumbnails, links
+
+        except Exception as e:
+            yield f"Error processing images: {str(e)}", thumbnails, links
+
+
+async def upscale_drafts(links: list[dict], session: Optional[str] = None):
     """
-    Wrapper function to run async pipeline in Gradio
+    Upscale the drafts among `links` to full size. Yields (status, gallery, links)
+    like process_images_pipeline; an upscale that already exists is reused.
     """
-    return asyncio.run(process_images_pipeline(lia_image, target_images))
+    job_ids = [link["job_id"] for link in links if link.get("tier") == "draft" and link.get("job_id")]
+    if not job_ids:
+        yield "No draft results to upscale. Process images with 'Draft first' enabled.", [], []
+        return
+
+    resources = shared_resources.get()
+    total = len(job_ids)
+    thumbnails = []
+    upscaled_links = []
+    failed = 0
+    with batch_token(session) as cancel_token:
+        try:
+            yield f"Upscaling 0/{total} drafts...", thumbnails, upscaled_links
+            async with ImageProcessorPipeline(
+                source_dir=None,
+                lia_image_path=None,
+                session=resources.session,
+                limits=resources.limits,
+                r2_client=resources.r2_client,
+                database_client=resources.database_client,
+                cancel_token=cancel_token,
+            ) as pipeline:
+                async for item in pipeline.upscale_jobs(job_ids):
+                    if item.error is None and item.r2_url:
+                        urls = resources.r2_client.sign_many([item.thumbnail_key, item.preview_key])
+                        thumbnails.append(urls.get(item.thumbnail_key) or item.r2_url)
+                        upscaled_links.append(result_links(urls, item.r2_url, item.preview_key, item.job_id, item.tier))
+                    else:
+                        failed += 1
+                    done = len(thumbnails) + failed
+                    yield f"Upscaling {done}/{total} drafts ({failed} failed)...", list(thumbnails), list(upscaled_links)
+
+            if cancel_token.stopping:
+                yield f"Stopped: upscaled {len(thumbnails)} of {total} drafts.", thumbnails, upscaled_links
+            else:
+                yield f"Upscaled {len(thumbnails)} of {total} drafts!", thumbnails, upscaled_links
+
+        except Exception as e:
+            yield f"Error upscaling drafts: {str(e)}", thumbnails, upscaled_links
+
+
+async def upscale_selected(links: list[dict], index: Optional[int], session: Optional[str] = None):
+    if index is None or index >= len(links):
+        yield "Select a draft in the results gallery first.", [], []
+        return
+    async for update in upscale_drafts([links[index]], session):
+        yield update
+
+
+async def load_recent_results(limit: int = 100):
+    """
+    Recent results from the jobs table as (thumbnails, links). Only keys are
+    stored, so the URLs are signed here in one batch.
+    """
+    resources = shared_resources.get()
+    jobs = await resources.database_client.get_recent_completed_jobs(limit)
+    urls = resources.r2_client.sign_many(
+        key for job in jobs for key in (job["r2_image_key"], job.get("thumbnail_key"), job.get("preview_key"))
+    )
+    thumbnails = [
+        # results from before renditions existed fall back to the full image
+        (urls.get(job.get("thumbnail_key")) or urls[job["r2_image_key"]], job["target_image_key"])
+        for job in jobs
+    ]
+    links = [result_links(urls, urls[job["r2_image_key"]], job.get("preview_key"), job["id"], job.get("tier")) for job in jobs]
+    return thumbnails, links
+
+
+_demo = None
+
 
-# Create Gradio interface
-with gr.Blocks(title="AI Image Processing Pipeline") as demo:
-    gr.Markdown("""
-    # 🎨 AI Image Processing Pipeline
+def build_demo():
+    """
+    Build the Gradio interface. gradio is imported here rather than at module
+    level, so the handlers above can be imported without paying for it.
+    """
+    import gradio as gr
+
+    def on_select(links: list[dict], evt: gr.SelectData):
+        return show_full_resolution(links, evt.index)
+
+    def on_select_result(links: list[dict], evt: gr.SelectData):
+        # remember the selection for "Upscale selected"
+        return show_full_resolution(links, evt.index), evt.index
+
+    # batches are registered per browser session so the stop button only stops the caller's own
+    async def on_process(lia_image, target_images, draft: bool, request: gr.Request):
+        async for update in process_images_pipeline(lia_image, target_images, draft, request.session_hash):
+            yield update
+
+    async def on_upscale_selected(links: list[dict], index: Optional[int], request: gr.Request):
+        async for update in upscale_selected(links, index, request.session_hash):
+            yield update
+
+    async def on_upscale_all(links: list[dict], request: gr.Request):
+        async for update in upscale_drafts(links, request.session_hash):
+            yield update
+
+    def on_stop(request: gr.Request):
+        return stop_batches(request.session_hash)
+
+    with gr.Blocks(title="AI Image Processing Pipeline") as demo:
+        gr.Markdown("""
+        # 🎨 AI Image Processing Pipeline
     
-    Upload a lia image and multiple target images to generate face-swapped results using AI.
+        Upload a lia image and multiple target images to generate face-swapped results using AI.
     
-    ## How it works:
-    1. **Upload Lia Image**: The face from this image will be swapped into target images
-    2. **Upload Target Images**: Multiple images that will receive the lia face
-    3. **Generate Descriptions**: Use Grok AI to generate descriptions automatically
-    4. **Process**: Run the Wavespeed AI pipeline to generate results
-    """)
+        ## How it works:
+        1. **Upload Lia Image**: The face from this image will be swapped into target images
+        2. **Upload Target Images**: Multiple images that will receive the lia face
+        3. **Generate Descriptions**: Use Grok AI to generate descriptions automatically
+        4. **Process**: Run the Wavespeed AI pipeline to generate results
+        5. **Upscale** (draft mode): Pick the drafts you like and upscale them to full size
+        """)
     
-    with gr.Row():
-        with gr.Column():
-            lia_input = gr.Image(
-                label="Lia Image", 
-                type="pil",
-                height=300
-            )
+        with gr.Row():
+            with gr.Column():
+                # filepath without image_mode hands over the uploaded file untouched
+                lia_input = gr.Image(
+                    label="Lia Image", 
+                    type="filepath",
+                    image_mode=None,
+                    height=300
+                )
             
-            target_inputs = gr.Gallery(
-                label="Target Images",
-                allow_preview=True,
-                preview=True,
-                object_fit="contain",
-            )
+                target_inputs = gr.Gallery(
+                    label="Target Images",
+                    allow_preview=True,
+                    preview=True,
+                    object_fit="contain",
+                )
             
             
-            process_btn = gr.Button("🚀 Start Processing", variant="primary", size="lg")
+                draft_input = gr.Checkbox(
+                    label="Draft first (fast low-resolution results; upscale the ones you like)",
+                    value=False,
+                )
+                with gr.Row():
+                    process_btn = gr.Button("🚀 Start Processing", variant="primary", size="lg")
+                    stop_btn = gr.Button("⏹ Stop", variant="stop", size="lg")
         
-        with gr.Column():
-            output_text = gr.Textbox(
-                label="Processing Results",
-                lines=5,
-                max_lines=10
-            )
+            with gr.Column():
+                output_text = gr.Textbox(
+                    label="Processing Results",
+                    lines=5,
+                    max_lines=10
+                )
             
-            output_gallery = gr.Gallery(
-                label="Generated Images",
-                show_label=True,
-                columns=2,
-                height="auto"
-            )
+                output_gallery = gr.Gallery(
+                    label="Generated Images",
+                    show_label=True,
+                    columns=2,
+                    height="auto"
+                )
+                output_links = gr.State([])
+                output_link = gr.Markdown()
+                selected_index = gr.State(None)
+
+                with gr.Row():
+                    upscale_selected_btn = gr.Button("⬆️ Upscale selected")
+                    upscale_all_btn = gr.Button("⬆️ Upscale all drafts")
+                upscale_text = gr.Textbox(label="Upscale status", lines=1)
+                upscaled_gallery = gr.Gallery(
+                    label="Upscaled Images",
+                    columns=2,
+                    height="auto"
+                )
+                upscaled_links = gr.State([])
+                upscaled_link = gr.Markdown()
+
+                with gr.Accordion("Recent results", open=False):
+                    history_btn = gr.Button("🔄 Load recent results")
+                    history_gallery = gr.Gallery(
+                        label="Recent results",
+                        columns=4,
+                        height="auto"
+                    )
+                    history_links = gr.State([])
+                    history_link = gr.Markdown()
     
-    # Event handlers
-    process_btn.click(
-        fn=run_pipeline,
-        inputs=[lia_input, target_inputs],
-        outputs=[output_text, output_gallery]
-    )
+        # Event handlers
+        process_btn.click(
+            fn=on_process,
+            inputs=[lia_input, target_inputs, draft_input],
+            outputs=[output_text, output_gallery, output_links]
+        )
+        output_gallery.select(
+            fn=on_select_result,
+            inputs=output_links,
+            outputs=[output_link, selected_index]
+        )
+        stop_btn.click(
+            fn=on_stop,
+            outputs=output_link
+        )
+        upscale_selected_btn.click(
+            fn=on_upscale_selected,
+            inputs=[output_links, selected_index],
+            outputs=[upscale_text, upscaled_gallery, upscaled_links]
+        )
+        upscale_all_btn.click(
+            fn=on_upscale_all,
+            inputs=output_links,
+            outputs=[upscale_text, upscaled_gallery, upscaled_links]
+        )
+        upscaled_gallery.select(
+            fn=on_select,
+            inputs=upscaled_links,
+            outputs=upscaled_link
+        )
+        history_btn.click(
+            fn=load_recent_results,
+            outputs=[history_gallery, history_links]
+        )
+        history_gallery.select(
+            fn=on_select,
+            inputs=history_links,
+            outputs=history_link
+        )
     
-    # Example section
-    gr.Markdown("""
-    ## 💡 Tips:
-    - Use high-quality lia images for better results
-    - Target images should be portraits for best face swapping results
-    - Descriptions are automatically generated using Grok AI
-    - Processing time depends on number of images and Wavespeed API response
-    - Results will be processed through the Wavespeed AI service
-    """)
+        # Example section
+        gr.Markdown("""
+        ## 💡 Tips:
+        - Use high-quality lia images for better results
+        - Target images should be portraits for best face swapping results
+        - Descriptions are automatically generated using Grok AI
+        - Processing time depends on number of images and Wavespeed API response
+        - Results will be processed through the Wavespeed AI service
+        """)
+
+    # several users can run batches at once; they share the connection pool and rate limits
+    demo.queue(default_concurrency_limit=GRADIO_CONCURRENCY, max_size=GRADIO_QUEUE_SIZE)
+    return demo
+
+
+def __getattr__(name: str):
+    # `from gradio_app import demo` builds the interface on first access
+    global _demo
+    if name == "demo":
+        if _demo is None:
+            _demo = build_demo()
+        return _demo
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 if __name__ == "__main__":
-    demo.launch(
+    build_demo().launch(
         server_name="0.0.0.0",  # Allow external access
         server_port=7860,
         share=False, # Set to True for public sharing
@@ -1,11 +1,307 @@
-from utils.image_generator import ImageGenerator
+from utils.image_generator import ImageProcessorPipeline, TargetItem
+from utils.cancellation import BatchCancelled, CancellationToken, install_signal_handlers
+from database.job_store import open_job_store
+from utils.rate_limit import ExecutionLimits, Lane
+from utils.metrics import start_metrics_server
+from utils.profiling import PROFILERS, profile_run
+import config
 import asyncio
+import csv
+import json
+import multiprocessing
+import os
+import signal
+import sys
 from pathlib import Path
 from argparse import ArgumentParser
+from termcolor import cprint
+from tqdm import tqdm
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+MANIFEST_FIELDS = [
+    "index",
+    "file_name",
+    "image_path",
+    "status",
+    "job_id",
+    "r2_image_key",
+    "r2_url",
+    "thumbnail_key",
+    "preview_key",
+    "size",
+    "tier",
+    "draft_job_id",
+    "prompt",
+    "error",
+]
+
+
+def parse_args(argv=None):
+    parser = ArgumentParser(description="Run a face-swap batch over a dataset directory without the Gradio UI")
+    parser.add_argument("--source_dir", type=str, default=None, help="directory of target images and their .txt descriptions")
+    parser.add_argument("--lia", type=str, default=None, help="lia (face donor) image")
+    parser.add_argument("--recursive", action="store_true", help="also scan subdirectories of --source_dir")
+    parser.add_argument("--include", action="append", default=None, metavar="GLOB", help="only process images whose relative path matches (repeatable)")
+    parser.add_argument("--exclude", action="append", default=None, metavar="GLOB", help="skip images and directories whose relative path matches (repeatable)")
+    parser.add_argument("--generate-prompts", action="store_true", help="generate a Grok prompt for targets without a .txt description")
+    parser.add_argument("--resume", action="store_true", help="reuse completed jobs and resume interrupted ones instead of resubmitting")
+    parser.add_argument("--manifest", type=str, default=None, help="write one row per target to this .jsonl or .csv file")
+    parser.add_argument("--max-in-flight", type=int, default=config.PIPELINE_MAX_IN_FLIGHT, help="Wavespeed jobs in flight (submitted, not yet polled to the end) at once")
+    parser.add_argument("--metrics-port", type=int, default=config.METRICS_PORT, help="serve Prometheus metrics on this port (0 = off)")
+    parser.add_argument("--profile", type=str, default=None, metavar="PATH", help="profile the run and write pstats output to PATH")
+    parser.add_argument("--profiler", choices=PROFILERS, default="cprofile", help="profiler used with --profile")
+    parser.add_argument("--shutdown-grace", type=float, default=config.SHUTDOWN_GRACE_SECONDS, help="seconds jobs in flight get to finish after Ctrl-C or SIGTERM")
+
+    drafts = parser.add_argument_group("draft mode")
+    drafts.add_argument("--draft", action="store_true", help="generate at the low DRAFT_LONG_SIDE size instead of full size")
+    drafts.add_argument("--upscale-all", action="store_true", help="with --draft, upscale every draft as soon as it finishes")
+    drafts.add_argument("--upscale", action="append", default=[], metavar="JOB_ID", help="upscale this completed draft job (repeatable); --source_dir and --lia are not needed")
+    drafts.add_argument("--upscale-file", type=str, default=None, metavar="PATH", help="upscale the draft job ids listed in PATH, one per line")
+
+    workers = parser.add_argument_group("worker mode")
+    workers.add_argument("--job-store", type=str, default=config.JOB_STORE_URL, help="job queue shared by workers")
+    workers.add_argument("--enqueue", action="store_true", help="upload targets and queue their jobs for workers instead of running them")
+    workers.add_argument("--worker", action="store_true", help="claim and run queued jobs; --source_dir and --lia are not needed")
+    workers.add_argument("--processes", type=int, default=1, help="worker processes to start on this host")
+    workers.add_argument("--capacity", type=int, default=config.WORKER_CAPACITY, help="jobs each worker runs at once")
+    workers.add_argument("--lease-seconds", type=float, default=config.WORKER_LEASE_SECONDS)
+    workers.add_argument("--exit-when-idle", action="store_true", help="stop once there is nothing left to claim")
+
+    limits = parser.add_argument_group("rate limits (requests/second, 0 = unlimited)")
+    limits.add_argument("--grok-rate", type=float, default=config.GROK_RATE)
+    limits.add_argument("--grok-concurrency", type=int, default=config.GROK_CONCURRENCY)
+    limits.add_argument("--submit-rate", type=float, default=config.WAVESPEED_SUBMIT_RATE)
+    limits.add_argument("--submit-concurrency", type=int, default=config.WAVESPEED_SUBMIT_CONCURRENCY)
+    limits.add_argument("--poll-rate", type=float, default=config.WAVESPEED_POLL_RATE)
+    limits.add_argument("--poll-concurrency", type=int, default=config.POLL_MAX_CONCURRENCY)
+    limits.add_argument("--r2-rate", type=float, default=config.R2_RATE)
+    limits.add_argument("--r2-concurrency", type=int, default=config.R2_CONCURRENCY)
+    return parser.parse_args(argv)
+
+
+def upscale_ids(args) -> list[str]:
+    job_ids = list(args.upscale)
+    if args.upscale_file:
+        with open(args.upscale_file) as f:
+            job_ids += [line.strip() for line in f if line.strip()]
+    return job_ids
+
+
+def build_limits(args) -> ExecutionLimits:
+    return ExecutionLimits(
+        grok=Lane("grok", args.grok_rate, config.GROK_BURST, args.grok_concurrency),
+        wavespeed_submit=Lane("wavespeed_submit", args.submit_rate, config.WAVESPEED_SUBMIT_BURST, args.submit_concurrency),
+        wavespeed_poll=Lane("wavespeed_poll", args.poll_rate, config.WAVESPEED_POLL_BURST, args.poll_concurrency),
+        r2=Lane("r2", args.r2_rate, config.R2_BURST, args.r2_concurrency),
+    )
+
+
+class ManifestWriter:
+    """
+    Appends one row per finished target, flushed as it goes so a killed run keeps its manifest.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.is_csv = path.lower().endswith(".csv")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, "w", newline="")
+        self._csv = None
+        if self.is_csv:
+            self._csv = csv.DictWriter(self._file, fieldnames=MANIFEST_FIELDS)
+            self._csv.writeheader()
+
+    def write(self, row: dict) -> None:
+        if self._csv is not None:
+            self._csv.writerow(row)
+        else:
+            self._file.write(json.dumps(row) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def manifest_row(item: TargetItem, done_status: str = "completed") -> dict:
+    if isinstance(item.error, BatchCancelled):
+        status = "cancelled"
+    elif item.error is not None:
+        status = "failed"
+    elif item.reused:
+        status = "reused"
+    else:
+        status = done_status
+    return {
+        "index": item.index,
+        "file_name": item.file_name,
+        "image_path": item.image_path,
+        "status": status,
+        "job_id": item.job_id,
+        "r2_image_key": item.r2_image_key,
+        "r2_url": item.r2_url,
+        "thumbnail_key": item.thumbnail_key,
+        "preview_key": item.preview_key,
+        "size": item.size,
+        "tier": item.tier,
+        "draft_job_id": item.parent_job_id,
+        "prompt": item.description,
+        "error": str(item.error) if item.error is not None else None,
+    }
+
+
+async def run(args) -> int:
+    prompt_generator = None
+    if args.generate_prompts:
+        from utils.grok import PromptGenerator
+        prompt_generator = PromptGenerator(args.lia)
+
+    if args.worker:
+        return await run_worker(args)
+    metrics_server = await start_metrics_server(args.metrics_port, config.METRICS_HOST) if args.metrics_port else None
+    manifest = ManifestWriter(args.manifest) if args.manifest else None
+    done_status = "queued" if args.enqueue else "completed"
+    counts = {done_status: 0, "reused": 0, "failed": 0, "cancelled": 0}
+    progress = tqdm(desc="images", unit="img")
+    store = open_job_store(args.job_store) if args.enqueue else None
+    draft_ids = upscale_ids(args)
+    cancel_token = CancellationToken()
+    install_signal_handlers(cancel_token, args.shutdown_grace)
+    try:
+        async with ImageProcessorPipeline(
+            source_dir=args.source_dir,
+            lia_image_path=args.lia,
+            limits=build_limits(args),
+            max_in_flight=args.max_in_flight,
+            prompt_generator=prompt_generator,
+            recursive=args.recursive,
+            include=args.include,
+            exclude=args.exclude,
+            draft=args.draft,
+            cancel_token=cancel_token,
+        ) as pipeline:
+            if draft_ids:
+                items = pipeline.upscale_jobs(draft_ids, resume=args.resume)
+            elif store is not None:
+                items = pipeline.enqueue_images(store, resume=args.resume)
+            else:
+                items = pipeline.stream_images(resume=args.resume, upscale=(lambda item: True) if args.upscale_all else None)
+            async for item in items:
+                row = manifest_row(item, done_status)
+                counts[row["status"]] += 1
+                if manifest is not None:
+                    manifest.write(row)
+                progress.update(1)
+                progress.set_postfix(counts)
+    finally:
+        progress.close()
+        if manifest is not None:
+            manifest.close()
+        if store is not None:
+            await store.close()
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+
+    if cancel_token.stopping:
+        cprint(f"Stopped ({cancel_token.reason}): {counts[done_status]} {done_status}, {counts['reused']} reused, {counts['failed']} failed, "
+               f"{counts['cancelled']} not started. Run again with --resume to finish the batch.", "yellow")
+        return 130
+    cprint(f"Done: {counts[done_status]} {done_status}, {counts['reused']} reused, {counts['failed']} failed", "green" if not counts["failed"] else "yellow")
+    return 1 if counts["failed"] else 0
+
+
+async def run_worker(args) -> int:
+    from utils.worker import JobWorker
+
+    metrics_server = await start_metrics_server(args.metrics_port, config.METRICS_HOST) if args.metrics_port else None
+    store = open_job_store(args.job_store)
+    cancel_token = CancellationToken()
+    install_signal_handlers(cancel_token, args.shutdown_grace)
+    try:
+        async with ImageProcessorPipeline(
+            source_dir=None,
+            lia_image_path=None,
+            limits=build_limits(args),
+            max_in_flight=args.capacity,
+            # the SQLite store and the poll scheduler's failure writes share one connection
+            database_client=getattr(store, "database_client", None),
+            cancel_token=cancel_token,
+        ) as pipeline:
+            worker = JobWorker(store, pipeline, capacity=args.capacity, lease_seconds=args.lease_seconds)
+            counts = await worker.run(exit_when_idle=args.exit_when_idle)
+    finally:
+        await store.close()
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+
+    cprint(f"Worker done: {', '.join(f'{count} {status}' for status, count in counts.items())}", "green" if not counts["failed"] else "yellow")
+    return 1 if counts["failed"] else 0
+
+
+def _worker_process(argv) -> None:
+    from utils.preprocess import shutdown_process_pool
+
+    try:
+        exit_code = main(argv)
+    finally:
+        # multiprocessing children skip atexit, which would otherwise stop the pool's workers
+        shutdown_process_pool()
+    sys.exit(exit_code)
+
+
+def run_worker_processes(args, argv) -> int:
+    """
+    Start --processes workers on this host, each in its own process with its own event loop.
+    """
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for index in range(args.processes):
+        child_argv = [*argv, "--processes", "1"]
+        if args.metrics_port:
+            child_argv += ["--metrics-port", str(args.metrics_port + index)]
+        process = context.Process(target=_worker_process, args=(child_argv,), name=f"worker-{index}")
+        process.start()
+        processes.append(process)
+
+    def forward(signum, frame) -> None:
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    # Ctrl-C reaches the workers through the terminal's process group; SIGTERM is passed on.
+    # Either way this process stays up until they have shut down.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, forward)
+    exit_code = 0
+    for process in processes:
+        process.join()
+        exit_code = max(exit_code, process.exitcode or 0)
+    return exit_code
+
+
+def main(argv=None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    if args.worker and args.processes > 1:
+        return run_worker_processes(args, argv)
+    if args.upscale_all and not args.draft:
+        cprint("--upscale-all only applies with --draft", "red")
+        return 2
+    if not args.worker and not (args.upscale or args.upscale_file):
+        if not args.source_dir or not args.lia:
+            cprint("--source_dir and --lia are required unless running with --worker or --upscale", "red")
+            return 2
+        if not os.path.isdir(args.source_dir):
+            cprint(f"Source directory {args.source_dir} does not exist", "red")
+            return 2
+        if not os.path.isfile(args.lia):
+            cprint(f"Lia image {args.lia} does not exist", "red")
+            return 2
+    if args.profile:
+        with profile_run(args.profile, args.profiler):
+            return asyncio.run(run(args))
+    return asyncio.run(run(args))
+
 
 if __name__ == "__main__":
-    parser = ArgumentParser()
-    parser.add_argument("--source_dir", type=str, required=True)
+    sys.exit(main())
@@ -0,0 +1,39 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from database.client import DatabaseClient
+
+
+class DatabaseClientTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    async def test_writes_fail_when_the_database_cannot_be_opened(self):
+        # a path under a file can never be created
+        blocker = os.path.join(self.tmp.name, "not-a-dir")
+        open(blocker, "w").close()
+        db = DatabaseClient(os.path.join(blocker, "jobs.db"), flush_interval=0.01)
+
+        job_ids = await asyncio.wait_for(db.create_jobs([{"lia_image_key": "lia", "target_image_key": "a.jpg"}]), 2)
+        updated = await asyncio.wait_for(db.update_job("missing", {"status": "failed"}), 2)
+
+        self.assertIsNone(job_ids)
+        self.assertFalse(updated)
+        await db.close()
+
+    async def test_batched_writes_are_committed(self):
+        db = DatabaseClient(os.path.join(self.tmp.name, "jobs.db"), flush_interval=0.01)
+        job_ids = await db.create_jobs([{"lia_image_key": "lia", "target_image_key": f"{i}.jpg"} for i in range(3)])
+        self.assertTrue(await db.update_job(job_ids[0], {"status": "completed"}))
+
+        job = await db.get_job(job_ids[0])
+        self.assertEqual(job["status"], "completed")
+        self.assertEqual(job["tier"], "full")
+        await db.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,16 @@
+import unittest
+
+from bench.import_budget import BUDGETS, measure
+
+
+class ImportBudgetTest(unittest.TestCase):
+    def test_entry_points_defer_heavy_imports(self):
+        for module, (_, forbidden) in BUDGETS.items():
+            with self.subTest(module=module):
+                _, loaded = measure(module)
+                top_level = {name.split(".")[0] for name in loaded}
+                self.assertFalse(top_level & set(forbidden), f"{module} imports {sorted(top_level & set(forbidden))} eagerly")
+
+
+if __name__ == "__main__":
+    unittest.main()
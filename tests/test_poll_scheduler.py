@@ -0,0 +1,104 @@
+import asyncio
+import unittest
+
+from utils.poll_scheduler import PollFailed, PollScheduler, PollTimeout, _PollJob
+
+
+class FakeResponse:
+    def __init__(self, status: int, data: dict = None) -> None:
+        self.status = status
+        self.data = data or {}
+        self.headers = {}
+
+    async def json(self):
+        return self.data
+
+    async def text(self):
+        return str(self.data)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeSession:
+    """
+    Answers every poll with the next of `statuses` (the last one repeats).
+    """
+
+    def __init__(self, *statuses) -> None:
+        self.statuses = list(statuses)
+        self.calls = 0
+
+    def get(self, url, headers=None):
+        status = self.statuses[min(self.calls, len(self.statuses) - 1)]
+        self.calls += 1
+        if isinstance(status, int):
+            return FakeResponse(status)
+        return FakeResponse(200, {"data": {"status": status, "error": "nsfw", "outputs": ["https://cdn/out.jpeg"]}})
+
+
+class FakeDatabase:
+    def __init__(self) -> None:
+        self.updates = []
+
+    async def update_job(self, job_id, job):
+        self.updates.append((job_id, job))
+        return True
+
+
+class PollSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    def scheduler(self, session, database=None, **kwargs) -> PollScheduler:
+        settings = {"min_interval": 0.01, "max_interval": 0.05, "backoff_factor": 0.5, "deadline": 5, "max_errors": 3, **kwargs}
+        scheduler = PollScheduler(session, {}, database, **settings)
+        self.addAsyncCleanup(scheduler.stop)
+        return scheduler
+
+    def test_interval_grows_with_age_and_errors(self):
+        scheduler = PollScheduler(None, {}, min_interval=2, max_interval=30, backoff_factor=0.15)
+        job = _PollJob(url="u", job_id="j", started_at=0, deadline=1000, future=None)
+        self.assertAlmostEqual(scheduler._next_interval(job, 1), 2, delta=0.2)
+        self.assertAlmostEqual(scheduler._next_interval(job, 100), 15, delta=1.5)
+        self.assertLessEqual(scheduler._next_interval(job, 1000), 33)
+        job.errors = 2
+        self.assertAlmostEqual(scheduler._next_interval(job, 20), 12, delta=1.2)
+
+    async def test_returns_the_completed_payload(self):
+        session = FakeSession("created", "processing", "completed")
+        timings = {}
+        data = await asyncio.wait_for(self.scheduler(session).wait("https://ws/p/1", "job-1", timings=timings), 2)
+        self.assertEqual(data["data"]["status"], "completed")
+        self.assertEqual(session.calls, 3)
+        self.assertIn("generation", timings)
+
+    async def test_deadline_expiry_records_timeout(self):
+        database = FakeDatabase()
+        with self.assertRaises(PollTimeout):
+            await asyncio.wait_for(self.scheduler(FakeSession("processing"), database).wait("https://ws/p/1", "job-1", deadline=0.1), 2)
+        self.assertEqual(database.updates, [("job-1", {"wavespeed_result_url": "https://ws/p/1", "r2_image_key": None, "status": "timeout"})])
+
+    async def test_failed_prediction_records_failed(self):
+        database = FakeDatabase()
+        with self.assertRaises(PollFailed):
+            await asyncio.wait_for(self.scheduler(FakeSession("processing", "failed"), database).wait("https://ws/p/2", "job-2"), 2)
+        self.assertEqual(database.updates[-1][1]["status"], "failed")
+
+    async def test_client_errors_fail_at_once(self):
+        database = FakeDatabase()
+        session = FakeSession(404)
+        with self.assertRaises(PollFailed):
+            await asyncio.wait_for(self.scheduler(session, database).wait("https://ws/p/3", "job-3"), 2)
+        self.assertEqual(session.calls, 1)
+        self.assertEqual(database.updates[-1][1]["status"], "failed")
+
+    async def test_server_errors_fail_after_max_errors(self):
+        session = FakeSession(500)
+        with self.assertRaises(PollFailed):
+            await asyncio.wait_for(self.scheduler(session, FakeDatabase()).wait("https://ws/p/4", "job-4"), 5)
+        self.assertEqual(session.calls, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import time
+import unittest
+from email.utils import formatdate
+
+from utils.metrics import RETRIES_TOTAL, THROTTLED_TOTAL
+from utils.rate_limit import Lane, RetryAfter, TokenBucket, retry_after_seconds
+
+
+class RetryAfterSecondsTest(unittest.TestCase):
+    def test_parses_seconds_and_http_dates(self):
+        self.assertEqual(retry_after_seconds({"Retry-After": "3"}), 3.0)
+        self.assertAlmostEqual(retry_after_seconds({"Retry-After": formatdate(time.time() + 30, usegmt=True)}), 30, delta=2)
+        self.assertEqual(retry_after_seconds({"Retry-After": "soon"}, default=5), 5)
+        self.assertEqual(retry_after_seconds(None, default=2), 2)
+
+
+class TokenBucketTest(unittest.IsolatedAsyncioTestCase):
+    async def test_allows_a_burst_then_the_rate(self):
+        bucket = TokenBucket(rate=20, burst=2)
+        started = time.monotonic()
+        await bucket.acquire()
+        await bucket.acquire()
+        self.assertLess(time.monotonic() - started, 0.02)
+        await bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.04)
+
+    async def test_pause_holds_back_tokens(self):
+        bucket = TokenBucket(rate=0, burst=1)
+        bucket.pause(0.05)
+        started = time.monotonic()
+        await bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.045)
+
+
+class LaneRetryAfterTest(unittest.IsolatedAsyncioTestCase):
+    async def test_429_pauses_the_lane_and_retries(self):
+        lane = Lane("test_429", 0, 1, concurrency=1, max_retries=2)
+        calls = []
+
+        async def throttled_once():
+            calls.append(time.monotonic())
+            if len(calls) == 1:
+                raise RetryAfter(0.05)
+            return "ok"
+
+        throttled = THROTTLED_TOTAL.value("test_429")
+        retries = RETRIES_TOTAL.value("test_429", "throttled")
+        self.assertEqual(await lane.run(throttled_once), "ok")
+        self.assertGreaterEqual(calls[1] - calls[0], 0.045)
+        self.assertEqual(THROTTLED_TOTAL.value("test_429"), throttled + 1)
+        self.assertEqual(RETRIES_TOTAL.value("test_429", "throttled"), retries + 1)
+        # a 429 means the upstream is up, so it never opens the circuit
+        self.assertFalse(lane.breaker.is_open)
+
+    async def test_gives_up_after_max_retries(self):
+        lane = Lane("test_429_limit", 0, 1, concurrency=1, max_retries=1)
+        calls = []
+
+        async def always_throttled():
+            calls.append(1)
+            raise RetryAfter(0.01)
+
+        with self.assertRaises(RetryAfter):
+            await lane.run(always_throttled)
+        self.assertEqual(len(calls), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+import asyncio
+import time
+import unittest
+
+from utils.rate_limit import Lane
+from utils.resilience import CircuitBreaker, RetryBudget, TransientError
+
+
+class RetryBudgetTest(unittest.TestCase):
+    def test_spends_tokens_and_earns_them_back_per_call(self):
+        budget = RetryBudget(ratio=0.5, min_per_second=0, max_tokens=2)
+        self.assertTrue(budget.try_spend())
+        self.assertTrue(budget.try_spend())
+        self.assertFalse(budget.try_spend())
+
+        budget.record_call()
+        self.assertFalse(budget.try_spend())
+        budget.record_call()
+        self.assertTrue(budget.try_spend())
+
+    def test_never_holds_more_than_max_tokens(self):
+        budget = RetryBudget(ratio=1, min_per_second=0, max_tokens=1)
+        for _ in range(5):
+            budget.record_call()
+        self.assertTrue(budget.try_spend())
+        self.assertFalse(budget.try_spend())
+
+
+class CircuitBreakerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_opens_probes_backs_off_and_closes(self):
+        breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=0.05, max_reset_timeout=0.08)
+        self.assertFalse(await breaker.wait())
+
+        breaker.record_failure()
+        self.assertFalse(breaker.is_open)
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+
+        started = time.monotonic()
+        self.assertTrue(await breaker.wait())
+        self.assertGreaterEqual(time.monotonic() - started, 0.04)
+
+        # a failed probe reopens the circuit for twice as long, capped at max_reset_timeout
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+        started = time.monotonic()
+        self.assertTrue(await breaker.wait())
+        self.assertGreaterEqual(time.monotonic() - started, 0.07)
+
+        breaker.record_success()
+        self.assertFalse(breaker.is_open)
+        self.assertFalse(await breaker.wait())
+
+    async def test_only_one_probe_at_a_time(self):
+        breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0.05)
+        breaker.record_failure()
+        self.assertTrue(await breaker.wait())
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(breaker.wait(), 0.02)
+
+
+class LaneProbeTest(unittest.IsolatedAsyncioTestCase):
+    async def test_failing_call_that_is_not_the_probe_keeps_the_probe_slot(self):
+        lane = Lane("test", 0, 1, concurrency=10, max_retries=0)
+        lane.breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0.1)
+        release_early, release_probe = asyncio.Event(), asyncio.Event()
+
+        async def early_call():
+            # let through while the circuit was still closed
+            await release_early.wait()
+            raise ValueError("bad request")
+
+        async def transient():
+            raise TransientError("503")
+
+        async def probe_call():
+            await release_probe.wait()
+            return "ok"
+
+        early = asyncio.create_task(lane.run(early_call))
+        await asyncio.sleep(0)
+        with self.assertRaises(TransientError):
+            await lane.run(transient)
+        self.assertTrue(lane.breaker.is_open)
+
+        probe = asyncio.create_task(lane.run(probe_call))
+        await asyncio.sleep(0.12)
+        release_early.set()
+        with self.assertRaises(ValueError):
+            await early
+
+        # the probe is still out, so nobody else may go through yet
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(lane.breaker.wait(), 0.04)
+
+        release_probe.set()
+        self.assertEqual(await probe, "ok")
+        self.assertFalse(lane.breaker.is_open)
+
+
+if __name__ == "__main__":
+    unittest.main()
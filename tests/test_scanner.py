@@ -0,0 +1,55 @@
+import asyncio
+import fnmatch
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from utils.scanner import scan_dataset
+
+
+class ScanDatasetTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+        for name in ("a", "b", "c"):
+            open(os.path.join(self.root, f"{name}.jpg"), "wb").close()
+        with open(os.path.join(self.root, "a.txt"), "w") as f:
+            f.write("prompt a")
+
+    async def test_yields_images_with_descriptions(self):
+        items = [item async for item in scan_dataset(self.root, batch_size=2)]
+        self.assertEqual(sorted(item[0] for item in items), ["a.jpg", "b.jpg", "c.jpg"])
+        self.assertEqual({item[0]: item[2] for item in items}["a.jpg"], "prompt a")
+
+    async def test_cancelling_mid_batch_raises_cancelled_error(self):
+        entered, release = threading.Event(), threading.Event()
+        calls = []
+
+        def slow_fnmatch(name, pattern):
+            # block the scanning thread inside the directory iterator on the second entry
+            calls.append(name)
+            if len(calls) == 2:
+                entered.set()
+                release.wait(5)
+            return fnmatch.fnmatch(name, pattern)
+
+        async def consume():
+            async for _ in scan_dataset(self.root, include=["*"], batch_size=1):
+                pass
+
+        with mock.patch("utils.scanner.fnmatch", slow_fnmatch):
+            task = asyncio.create_task(consume())
+            await asyncio.to_thread(entered.wait, 5)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            release.set()
+            # the thread finishes its batch and closes the iterator itself
+            await asyncio.sleep(0.05)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import asyncio
+import unittest
+
+from utils.singleflight import SingleFlight
+
+
+class SingleFlightTest(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_calls_share_one_result(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "result"
+
+        results = await asyncio.gather(*[flight.do("key", work) for _ in range(5)])
+        self.assertEqual(results, ["result"] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertFalse(flight.in_flight("key"))
+
+    async def test_errors_reach_every_waiter_and_are_not_kept(self):
+        flight = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+
+        results = await asyncio.gather(flight.do("key", fail), flight.do("key", fail), return_exceptions=True)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+        async def succeed():
+            return "ok"
+
+        self.assertEqual(await flight.do("key", succeed), "ok")
+
+    async def test_cancelled_waiter_leaves_the_shared_call_running_for_the_others(self):
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def work():
+            await release.wait()
+            return "result"
+
+        first = asyncio.create_task(flight.do("key", work))
+        second = asyncio.create_task(flight.do("key", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        self.assertTrue(flight.in_flight("key"))
+
+        release.set()
+        self.assertEqual(await second, "result")
+        with self.assertRaises(asyncio.CancelledError):
+            await first
+
+    async def test_call_is_cancelled_once_all_waiters_are(self):
+        flight = SingleFlight()
+        started, cancelled = asyncio.Event(), asyncio.Event()
+
+        async def work():
+            started.set()
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiters = [asyncio.create_task(flight.do("key", work)) for _ in range(2)]
+        await started.wait()
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0)
+        self.assertFalse(flight.in_flight("key"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import asyncio
+import unittest
+
+from utils.cancellation import CancellationToken
+from utils.stages import Stage, run_stages
+
+
+class Item:
+    def __init__(self, index: int) -> None:
+        self.index = index
+        self.error = None
+
+
+async def _slow_source(count: int):
+    for index in range(count):
+        yield Item(index)
+    # keep the stages waiting on their queues
+    await asyncio.Event().wait()
+
+
+async def _passthrough(item):
+    return item
+
+
+class RunStagesCancelTest(unittest.IsolatedAsyncioTestCase):
+    async def test_cancel_while_blocked_on_queue_ends_iteration(self):
+        token = CancellationToken()
+        seen = []
+
+        async def consume():
+            async for item in run_stages(_slow_source(2), [Stage("a", _passthrough), Stage("b", _passthrough, workers=2)], cancel_token=token):
+                seen.append(item.index)
+
+        consumer = asyncio.create_task(consume())
+        while len(seen) < 2:
+            await asyncio.sleep(0)
+        token.cancel()
+        await asyncio.wait_for(consumer, 1)
+        self.assertEqual(seen, [0, 1])
+
+    async def test_stop_grace_expiry_cancels(self):
+        token = CancellationToken()
+        seen = []
+
+        async def consume():
+            async for item in run_stages(_slow_source(1), [Stage("a", _passthrough)], cancel_token=token):
+                seen.append(item.index)
+
+        consumer = asyncio.create_task(consume())
+        while not seen:
+            await asyncio.sleep(0)
+        token.stop(grace=0.01)
+        await asyncio.wait_for(consumer, 1)
+        self.assertTrue(token.cancelled)
+
+
+if __name__ == "__main__":
+    unittest.main()
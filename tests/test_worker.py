@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from database.client import DatabaseClient
+from database.job_store import SqliteJobStore
+from utils.cancellation import CancellationToken
+from utils.image_generator import SubmitRejected
+from utils.poll_scheduler import PollTimeout
+from utils.worker import JobWorker
+
+
+class TimingOutPipeline:
+    """
+    Stands in for ImageProcessorPipeline: every poll passes its deadline, which the
+    PollScheduler records as status 'timeout' before raising.
+    """
+
+    def __init__(self, database_client: DatabaseClient) -> None:
+        self.database_client = database_client
+        self.cancel_token = CancellationToken()
+        self.runs = 0
+
+    async def run_job(self, item, lia_image=None, on_submitted=None):
+        self.runs += 1
+        await self.database_client.update_job(item.job_id, {"wavespeed_result_url": item.prediction_url, "status": "timeout"})
+        raise PollTimeout(f"Polling {item.prediction_url} exceeded its deadline")
+
+
+class RejectingPipeline:
+    """
+    Stands in for ImageProcessorPipeline: Wavespeed refuses every submission.
+    """
+
+    def __init__(self) -> None:
+        self.cancel_token = CancellationToken()
+        self.r2_client = SimpleNamespace(signer=SimpleNamespace(sign=lambda key: f"https://r2.example/{key}"))
+        self.runs = 0
+
+    async def run_job(self, item, lia_image=None, on_submitted=None):
+        self.runs += 1
+        raise SubmitRejected(f"Wavespeed did not accept {item.file_name}")
+
+
+class JobWorkerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.database_client = DatabaseClient(os.path.join(tmp.name, "jobs.db"), flush_interval=0.01)
+        self.store = SqliteJobStore(self.database_client, max_attempts=2)
+        [self.job_id] = await self.store.enqueue([{"lia_image_key": "lia", "target_image_key": "a.jpg"}])
+        # submitted by a worker whose lease has expired
+        await self.database_client.execute_now(
+            "UPDATE jobs SET status = 'submitted', wavespeed_result_url = ?, lease_expires_at = 0 WHERE id = ?",
+            ("http://wavespeed/predictions/1", self.job_id),
+        )
+
+    async def asyncTearDown(self):
+        await self.database_client.close()
+
+    async def test_timed_out_poll_is_retried_then_recorded_as_timeout(self):
+        pipeline = TimingOutPipeline(self.database_client)
+        worker = JobWorker(self.store, pipeline, worker_id="w1", claim_interval=0.01)
+
+        counts = await worker.run(exit_when_idle=True)
+
+        self.assertEqual(pipeline.runs, 2)
+        self.assertEqual(counts["released"], 1)
+        self.assertEqual(counts["failed"], 1)
+        job = await self.database_client.get_job(self.job_id)
+        self.assertEqual(job["status"], "timeout")
+        self.assertIsNone(job["lease_owner"])
+
+    async def test_rejected_submission_fails_without_retrying(self):
+        [job_id] = await self.store.enqueue([{
+            "lia_image_key": "lia", "target_image_key": "b.jpg",
+            "target_object_key": "targets/b.jpg", "lia_object_key": "lia.jpg",
+        }])
+        pipeline = RejectingPipeline()
+        worker = JobWorker(self.store, pipeline, worker_id="w1", claim_interval=0.01)
+
+        counts = await worker.run(exit_when_idle=True)
+
+        job = await self.database_client.get_job(job_id)
+        self.assertEqual(job["status"], "failed")
+        self.assertEqual(job["attempts"], 1)
+        self.assertEqual(counts["released"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import asyncio
+import signal
+from typing import Optional
+
+from termcolor import cprint
+
+
+class BatchCancelled(Exception):
+    """
+    Set as an item's error when its batch stopped before the item was submitted.
+    """
+
+
+class CancellationToken:
+    """
+    Stops one batch in two steps.
+
+    stop() lets jobs that are already submitted finish but starts nothing new:
+    no more targets are scanned, uploaded, prompted or submitted. cancel()
+    also abandons the jobs in flight. Their prediction URLs are already in the
+    jobs table, so a later `--resume` picks them up without paying again.
+    """
+
+    def __init__(self) -> None:
+        self.reason: Optional[str] = None
+        self._stopping = False
+        self._cancelled = asyncio.Event()
+        self._grace_timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def stopping(self) -> bool:
+        """
+        True once stop() or cancel() was called.
+        """
+        return self._stopping
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def stop(self, grace: Optional[float] = None, reason: str = "batch stopped") -> None:
+        """
+        Start no new work. With `grace`, cancel whatever is still running after that many seconds.
+        """
+        if not self._stopping:
+            self._stopping = True
+            self.reason = reason
+        if grace is not None and self._grace_timer is None and not self.cancelled:
+            self._grace_timer = asyncio.get_running_loop().call_later(grace, self.cancel, f"{reason}; grace period over")
+
+    def cancel(self, reason: str = "batch cancelled") -> None:
+        self._stopping = True
+        self.reason = self.reason or reason
+        if self._grace_timer is not None:
+            self._grace_timer.cancel()
+        self._cancelled.set()
+
+    def raise_if_stopping(self) -> None:
+        if self._stopping:
+            raise BatchCancelled(self.reason)
+
+    async def wait_cancelled(self) -> None:
+        await self._cancelled.wait()
+
+
+def install_signal_handlers(token: CancellationToken, grace: float) -> None:
+    """
+    First Ctrl-C or SIGTERM stops the batch and gives in-flight jobs `grace`
+    seconds to finish. A second one cancels them right away.
+    """
+    def on_signal(signum: int) -> None:
+        name = signal.Signals(signum).name
+        if token.stopping:
+            cprint(f"{name}: cancelling in-flight jobs; they can be resumed with --resume", "red")
+            token.cancel(f"{name} received twice")
+            return
+        cprint(f"{name}: submitting nothing new, waiting up to {grace:.0f}s for jobs in flight (again to cancel them)", "yellow")
+        token.stop(grace, f"{name} received")
+
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, on_signal, signum)
+        except (NotImplementedError, RuntimeError):
+            # not supported on this platform, or not on the main thread
+            pass
@@ -1,28 +1,24 @@
-from openai import AsyncOpenAI
-from config import GROK_API_KEY
+from config import GROK_API_KEY, GROK_BASE_URL, PROMPT_CACHE_PATH, VISION_MAX_SIDE
 from termcolor import cprint
+from .rate_limit import RetryAfter, retry_after_seconds
+from .resilience import TransientError
+from .prompt_cache import PromptCache, prompt_cache_key
+from .singleflight import SingleFlight
+from .preprocess import file_sha256, run_in_process_pool, vision_payload
+from dataclasses import dataclass
+from typing import Optional, Union
+import asyncio
 import base64
+import threading
 
-client = AsyncOpenAI(
-    api_key=GROK_API_KEY,
-    base_url="https://api.x.ai/v1"
-)
+MODEL = "grok-4-1-fast-non-reasoning"
 
-def encode_image(path):
-    with open(path, "rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
+# Bump whenever SYSTEM_PROMPT or USER_PROMPT change so cached prompts are regenerated
+PROMPT_VERSION = "1"
 
-async def generate_seedream_prompt(reference_image_path: str, lia_target_path: str) -> str:
-    reference_b64 = encode_image(reference_image_path)  # ← POSE donor
-    lia_b64       = encode_image(lia_target_path)      # ← FACE donor
+SYSTEM_PROMPT = "You are a strict Seedream 4.0 img2img prompt writer. FIRST image = REFERENCE (keep 100% pose, exact clothing, lighting, background). SECOND image = LIA TARGET (only swap face + traits that are actually visible in the reference). NEVER invent or force hidden features."
 
-    response = await client.chat.completions.create(
-        model="grok-4-1-fast-non-reasoning",
-        temperature=0.1,
-        messages=[
-            {"role": "system", "content": "You are a strict Seedream 4.0 img2img prompt writer. FIRST image = REFERENCE (keep 100% pose, exact clothing, lighting, background). SECOND image = LIA TARGET (only swap face + traits that are actually visible in the reference). NEVER invent or force hidden features."},
-            {"role": "user", "content": [
-                {"type": "text", "text": """
+USER_PROMPT = """
 Image 1 = REFERENCE → keep 100% pose, exact clothing, lighting, background, body proportions.
 Image 2 = LIA TARGET → ONLY apply these traits IF they are visible in the reference image:
 • 21 year old woman
@@ -40,11 +36,142 @@ Image 2 = LIA TARGET → ONLY apply these traits IF they are visible in the refe
 
 If any tattoo/jewelry area is covered by clothing, DO NOT mention it at all.
 Output ONLY the final Seedream img2img prompt. End with: photorealistic, ultra-detailed skin and tattoo texture, 8k fashion portrait
-"""},
+"""
+
+_prompt_cache: Optional[PromptCache] = None
+_prompt_cache_lock = threading.Lock()
+_prompt_flight = SingleFlight()
+_client = None
+
+
+def get_client():
+    """
+    Process-wide Grok (OpenAI-compatible) client, built on first use so importing this module stays cheap.
+    """
+    global _client
+    with _prompt_cache_lock:
+        if _client is None:
+            from openai import AsyncOpenAI
+
+            _client = AsyncOpenAI(
+                api_key=GROK_API_KEY,
+                base_url=GROK_BASE_URL
+            )
+        return _client
+
+
+def get_prompt_cache() -> PromptCache:
+    global _prompt_cache
+    with _prompt_cache_lock:
+        if _prompt_cache is None:
+            _prompt_cache = PromptCache(PROMPT_CACHE_PATH)
+        return _prompt_cache
+
+
+@dataclass
+class EncodedImage:
+    b64: str
+    sha256: str
+
+
+def encode_image(path):
+    with open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode("utf-8")
+
+
+async def encode_vision_image(source: Union[str, bytes]) -> EncodedImage:
+    """
+    Downscaled, EXIF-upright JPEG payload built in the pre-processing process pool.
+    `source` is a path or the image's bytes.
+    """
+    b64, sha256 = await run_in_process_pool(vision_payload, source)
+    return EncodedImage(b64, sha256)
+
+
+class PromptGenerator:
+    """
+    Generates Seedream prompts against one lia image.
+
+    Images are sent downscaled to VISION_MAX_SIDE. The lia payload is built
+    once per generator (i.e. once per batch). Prompts are cached by (reference hash, lia hash, model, prompt
+    version), hashes of the original files, so a cache hit encodes nothing.
+    Concurrent requests for the same key share one Grok call.
+    Instances are callable as prompt_generator(target, lia_path), where the
+    target is a path or the image's bytes.
+    """
+
+    def __init__(self, lia_image_path: str, cache: Optional[PromptCache] = None) -> None:
+        self.lia_image_path = lia_image_path
+        self.cache = cache or get_prompt_cache()
+        self._lia: Optional[asyncio.Future] = None
+        self._lia_sha256: Optional[asyncio.Future] = None
+
+    async def _lia_payload(self) -> EncodedImage:
+        if self._lia is None:
+            self._lia = asyncio.ensure_future(encode_vision_image(self.lia_image_path))
+        return await asyncio.shield(self._lia)
+
+    async def _lia_hash(self) -> str:
+        if self._lia_sha256 is None:
+            self._lia_sha256 = asyncio.ensure_future(asyncio.to_thread(file_sha256, self.lia_image_path))
+        return await asyncio.shield(self._lia_sha256)
+
+    async def __call__(self, reference_image: Union[str, bytes], lia_image_path: Optional[str] = None) -> str:
+        if lia_image_path is not None and lia_image_path != self.lia_image_path:
+            return await PromptGenerator(lia_image_path, self.cache)(reference_image)
+        return await self.generate(reference_image)
+
+    async def generate(self, reference_image: Union[str, bytes]) -> str:
+        # the key only needs hashes of the originals; images are downscaled and encoded on a miss
+        reference_sha256 = await asyncio.to_thread(file_sha256, reference_image)
+        lia_sha256 = await self._lia_hash()
+        # payload resolution is part of the version: a different size can produce a different prompt
+        key = prompt_cache_key(reference_sha256, lia_sha256, MODEL, f"{PROMPT_VERSION}:{VISION_MAX_SIDE}")
+        cached = await asyncio.to_thread(self.cache.get, key)
+        if cached is not None:
+            return cached
+
+        async def generate_uncached() -> str:
+            reference = await encode_vision_image(reference_image)  # ← POSE donor
+            lia = await self._lia_payload()                              # ← FACE donor
+            return await self._generate_uncached(key, reference.b64, lia.b64)
+
+        return await _prompt_flight.do(key, generate_uncached)
+
+    async def _generate_uncached(self, key: str, reference_b64: str, lia_b64: str) -> str:
+        from openai import APIConnectionError, InternalServerError, RateLimitError
+
+        try:
+            response = await _create_completion(reference_b64, lia_b64)
+        except RateLimitError as e:
+            # surface throttling to the caller's Lane so it can back off and retry
+            raise RetryAfter(retry_after_seconds(getattr(e.response, "headers", None)), "Grok rate limited")
+        except (APIConnectionError, InternalServerError) as e:
+            # prompts are idempotent, so timeouts and 5xx are safe to retry too
+            raise TransientError(f"Grok call failed: {e}") from e
+        prompt = response.choices[0].message.content.strip()
+        await asyncio.to_thread(self.cache.put, key, prompt)
+        return prompt
+
+
+async def generate_seedream_prompt(reference_image_path: str, lia_target_path: str) -> str:
+    """
+    One-off prompt generation. For batches, reuse a PromptGenerator so the lia image is encoded once.
+    """
+    return await PromptGenerator(lia_target_path).generate(reference_image_path)
+
+
+async def _create_completion(reference_b64: str, lia_b64: str):
+    return await get_client().chat.completions.create(
+        model=MODEL,
+        temperature=0.1,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": [
+                {"type": "text", "text": USER_PROMPT},
                 {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{reference_b64}"}},
                 {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{lia_b64}"}},
             ]}
         ],
         max_tokens=500
     )
-    return response.choices[0].message.content.strip()
\ No newline at end of file
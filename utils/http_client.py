@@ -0,0 +1,36 @@
+import aiohttp
+from config import (
+    HTTP_POOL_LIMIT,
+    HTTP_POOL_LIMIT_PER_HOST,
+    HTTP_KEEPALIVE_TIMEOUT,
+    HTTP_DNS_CACHE_TTL,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+)
+
+
+def create_http_session(
+    limit: int = HTTP_POOL_LIMIT,
+    limit_per_host: int = HTTP_POOL_LIMIT_PER_HOST,
+    keepalive_timeout: float = HTTP_KEEPALIVE_TIMEOUT,
+    dns_cache_ttl: int = HTTP_DNS_CACHE_TTL,
+    connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+    read_timeout: float = HTTP_READ_TIMEOUT,
+) -> aiohttp.ClientSession:
+    """
+    Create a pooled session with keep-alive and DNS caching.
+    Requests have no total timeout, so large result downloads aren't cut off on slow links;
+    a stalled connection still fails after `read_timeout` seconds without data.
+    Must be called from inside a running event loop.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        keepalive_timeout=keepalive_timeout,
+        ttl_dns_cache=dns_cache_ttl,
+        use_dns_cache=True,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=None, connect=connect_timeout, sock_read=read_timeout),
+    )
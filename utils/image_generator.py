@@ -5,65 +5,292 @@ from dotenv import load_dotenv
 import aiohttp
 from termcolor import cprint
 load_dotenv()
-from .r2_client import R2Client
+from .r2_client import R2Client, get_r2_client
+from .http_client import create_http_session
+from .poll_scheduler import PollScheduler
+from .rate_limit import ExecutionLimits, RetryAfter, retry_after_seconds
+from .stages import Stage, run_stages
+from .preprocess import convert_to_jpeg, make_derivatives, probe_image, run_in_process_pool, upload_content_type
+from .scanner import scan_dataset
+from .singleflight import SingleFlight
+from .metrics import HEDGED_TOTAL, JOBS_IN_FLIGHT, JOBS_TOTAL, record_span, timed
+from .resilience import TransientError
+from .cancellation import BatchCancelled, CancellationToken
+from config import (
+    PIPELINE_MAX_IN_FLIGHT,
+    RESULT_STREAMING,
+    RESULT_DERIVATIVES,
+    THUMBNAIL_MAX_SIDE,
+    PREVIEW_MAX_SIDE,
+    DOWNLOAD_HEDGE_AFTER,
+    WAVESPEED_API_URL,
+    WAVESPEED_UPSCALE_URL,
+    DRAFT_LONG_SIDE,
+    UPSCALE_RESOLUTION,
+    STAGE_UPLOAD_WORKERS,
+    STAGE_PROMPT_WORKERS,
+    STAGE_SUBMIT_WORKERS,
+    STAGE_DOWNLOAD_WORKERS,
+    STAGE_DB_WORKERS,
+    STAGE_QUEUE_SIZE,
+    SHUTDOWN_CLOSE_TIMEOUT,
+)
 from database.client import DatabaseClient, Job
+from database.job_store import JobStore
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Optional, Union
+import hashlib
+import mimetypes
 import tempfile
 import aiofiles
 import asyncio
+import time
+
+# Process-wide, so concurrent pipelines (e.g. Gradio sessions) that ask for an
+# identical job share one paid generation: submissions are keyed by
+# (database, fingerprint), polls and result downloads by prediction URL.
+_submit_flight = SingleFlight()
+_poll_flight = SingleFlight()
+_download_flight = SingleFlight()
+
+
+class SubmitRejected(Exception):
+    """
+    Wavespeed did not accept a submission. Sending the same payload again won't help,
+    and after a 504 the job may even exist already, so it is not retried.
+    """
+
+
+@dataclass
+class TargetInput:
+    """
+    An in-memory target: the uploaded file's original bytes and an optional prompt.
+    """
+    data: bytes
+    prompt: Optional[str] = None
+    name: Optional[str] = None
+
+
+@dataclass
+class TargetItem:
+    """
+    One target image as it moves through the pipeline stages.
+    """
+    index: int
+    file_name: str
+    image_path: Optional[str]
+    description: Optional[str] = None
+    # in-memory targets carry their bytes instead of a path until they are submitted
+    data: Optional[bytes] = None
+    image_url: Optional[str] = None
+    image_key: Optional[str] = None
+    size: Optional[str] = None
+    # "draft" items are generated at DRAFT_LONG_SIDE; an upscale is "full" and points at its draft
+    tier: str = "full"
+    parent_job_id: Optional[str] = None
+    fingerprint: Optional[str] = None
+    # True when the result came from an earlier completed job with the same fingerprint
+    reused: bool = False
+    job_id: Optional[str] = None
+    prediction_url: Optional[str] = None
+    result: Optional[dict] = None
+    r2_image_key: Optional[str] = None
+    r2_url: Optional[str] = None
+    # WebP renditions of the result, stored under derivative_key(r2_image_key, ...)
+    thumbnail_key: Optional[str] = None
+    preview_key: Optional[str] = None
+    error: Optional[Exception] = None
+    # calls retried on this item's behalf (throttling and transient failures)
+    retries: int = 0
+    # span name -> seconds, see utils.metrics.SPANS
+    timings: dict = field(default_factory=dict)
 
 
 class ImageProcessorPipeline:
     """
     Class for swapping face of lia into target image
+
+    Use as an async context manager so submit, poll and download traffic
+    share one pooled HTTP session:
+
+        async with ImageProcessorPipeline(source_dir, lia_image_path) as pipeline:
+            await pipeline.process_images()
+
+    Targets come from `source_dir` (images plus .txt descriptions) or, with
+    `targets`, from an in-memory list of TargetInput that is never written to disk.
+
+    An existing session, R2 client or database client can be passed in to share
+    them between pipelines (e.g. across Gradio requests); they are then left open on exit.
+    Calls to Wavespeed and R2 go through the rate-limited lanes in `limits`.
+    Targets stream through upload, submit, poll and download stages, so the
+    first results arrive while later images are still being uploaded.
+
+    With `draft`, targets are generated at a low draft size; upscale_jobs()
+    (or the `upscale` filter of stream_images) then upscales the chosen drafts.
+
+    `cancel_token` stops the pipeline's batches: see CancellationToken.
     """
 
-    def __init__(self, source_dir: str, lia_image_path: str) -> None:
+    def __init__(
+        self,
+        source_dir: Optional[str],
+        lia_image_path: str,
+        session: Optional[aiohttp.ClientSession] = None,
+        limits: Optional[ExecutionLimits] = None,
+        max_in_flight: int = PIPELINE_MAX_IN_FLIGHT,
+        prompt_generator: Optional[Callable[[str, str], Awaitable[str]]] = None,
+        recursive: bool = False,
+        include: Optional[list[str]] = None,
+        exclude: Optional[list[str]] = None,
+        r2_client: Optional[R2Client] = None,
+        database_client: Optional[DatabaseClient] = None,
+        targets: Optional[Iterable[TargetInput]] = None,
+        draft: bool = False,
+        cancel_token: Optional[CancellationToken] = None,
+    ) -> None:
         self.api_key = os.getenv("WAVESPEED_API_KEY")
-        self.url = "https://api.wavespeed.ai/api/v3/bytedance/seedream-v4/edit"
+        self.url = WAVESPEED_API_URL
+        self.upscale_url = WAVESPEED_UPSCALE_URL
+        self.upscale_resolution = UPSCALE_RESOLUTION
+        self.tier = "draft" if draft else "full"
+        self.cancel_token = cancel_token or CancellationToken()
+        self.close_timeout = SHUTDOWN_CLOSE_TIMEOUT
         self.source_dir = source_dir
-        self.r2_client = R2Client()
+        self.targets = targets
+        self.r2_client = r2_client or get_r2_client()
         self.lia_image_path = lia_image_path
-        self.database_client = DatabaseClient()
-        
+        self.database_client = database_client or DatabaseClient()
+        self._owns_database_client = database_client is None
+        self.session = session
+        self._owns_session = session is None
+        self.poll_scheduler: Optional[PollScheduler] = None
+        self.limits = limits or ExecutionLimits.from_config()
+        self.max_in_flight = max_in_flight
+        # called as prompt_generator(target_path_or_bytes, lia_path) for targets without a description
+        self.prompt_generator = prompt_generator
+        # source directory scanning: descend into subdirectories, glob filters on relative paths
+        self.recursive = recursive
+        self.include = include
+        self.exclude = exclude
+        # pipe results into R2 instead of buffering them through a temp file
+        self.stream_results = RESULT_STREAMING
+        # WebP renditions stored next to each result, by variant name -> max side
+        self.result_derivatives = RESULT_DERIVATIVES
+        self.derivative_sizes = {"thumb": THUMBNAIL_MAX_SIDE, "preview": PREVIEW_MAX_SIDE}
+        # seconds before a slow result download gets a second, competing request (0 = off)
+        self.hedge_after = DOWNLOAD_HEDGE_AFTER
+        # fingerprint -> incomplete job row, loaded when resuming
+        self._incomplete_jobs: dict[str, Job] = {}
+
+    async def __aenter__(self) -> "ImageProcessorPipeline":
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.close()
+
+    async def open(self) -> None:
+        if self.session is None or self.session.closed:
+            self.session = create_http_session()
+            self._owns_session = True
+        if self.poll_scheduler is None:
+            self.poll_scheduler = PollScheduler(
+                self.session,
+                self.headers,
+                self.database_client,
+                lane=self.limits.wavespeed_poll,
+            )
+            self.poll_scheduler.start()
+
+    async def close(self) -> None:
+        """
+        Stop polling, commit pending DB writes and close owned connections,
+        giving up after `close_timeout` seconds so shutdown never hangs.
+        """
+        try:
+            await asyncio.wait_for(self._close(), self.close_timeout)
+        except asyncio.TimeoutError:
+            cprint(f"Pipeline did not close within {self.close_timeout:.0f}s; unflushed job updates may be lost", "red")
+
+    async def _close(self) -> None:
+        if self.poll_scheduler is not None:
+            await self.poll_scheduler.stop()
+            self.poll_scheduler = None
+        if self._owns_database_client:
+            await self.database_client.close()
+        else:
+            # a shared client stays open, but this batch's writes should be committed
+            await self.database_client.flush()
+        if self._owns_session and self.session is not None and not self.session.closed:
+            await self.session.close()
+        if self._owns_session:
+            self.session = None
+
+    @property
+    def headers(self) -> dict:
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}",
+        }
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            raise RuntimeError("ImageProcessorPipeline session is not open; use 'async with ImageProcessorPipeline(...)'")
+        return self.session
 
 
     async def upload_file(self, file_path: str) -> str:
         try:
-            return await self.r2_client.upload_image(file_path)
+            return await self.limits.r2.run(self.r2_client.upload_image, file_path)
         except Exception as e:
             print(str(e))
             raise Exception(str(e))
             
 
-    async def get_files(self) -> list[str]:
-        dataset = sorted(os.listdir(self.source_dir))
-        txt_files = set(f for f in dataset if f.endswith(".txt"))
-        image_files = set(f for f in dataset if f.endswith((".jpg", ".jpeg", ".png")))
-        
-        # Get lia image filename to exclude it from target processing
-        lia_filename = os.path.basename(self.lia_image_path)
-        
-        dataset_list = []
-        for image_file in image_files:
-            # Skip the lia image - it's not a target image
-            if image_file == lia_filename:
-                continue
-                
-            file_name = image_file.split(".")[0]
-            description_file = f"{file_name}.txt"
-            if description_file not in txt_files:
-                cprint(f"Skipping {image_file} because it does not have a description file", "red")
+    async def scan_targets(self) -> AsyncIterator[TargetItem]:
+        """
+        Lazily yield target images paired with their description, without uploading anything.
+        Images without a .txt description are skipped unless a prompt generator is set.
+        """
+        if self.targets is not None:
+            async for item in self._memory_targets():
+                yield item
+            return
+        index = 0
+        async for relative_path, image_path, description, has_description in scan_dataset(
+            self.source_dir,
+            recursive=self.recursive,
+            include=self.include,
+            exclude=self.exclude,
+            # the lia image is not a target
+            skip_paths=[self.lia_image_path],
+        ):
+            if not has_description and self.prompt_generator is None:
+                cprint(f"Skipping {relative_path} because it does not have a description file", "red")
                 continue
-            image_path = os.path.join(self.source_dir, image_file)
-            dataset_list.append((
-                file_name,
-                await self.upload_file(image_path),
-                open(os.path.join(self.source_dir, description_file), "r").read(),
-                image_path
-            ))
-        return dataset_list
-
+            yield TargetItem(
+                index=index,
+                file_name=os.path.splitext(relative_path)[0],
+                image_path=image_path,
+                description=description,
+            )
+            index += 1
 
+    async def _memory_targets(self) -> AsyncIterator[TargetItem]:
+        index = 0
+        for position, target in enumerate(self.targets):
+            name = target.name or f"target_{position:03d}"
+            if not target.prompt and self.prompt_generator is None:
+                cprint(f"Skipping {name} because it does not have a prompt", "red")
+                continue
+            yield TargetItem(
+                index=index,
+                file_name=name,
+                image_path=None,
+                description=target.prompt or None,
+                data=target.data,
+            )
+            index += 1
 
     async def create_job(self, job: Job) -> str:
         try:
@@ -72,33 +299,153 @@ class ImageProcessorPipeline:
             print(f"Error creating job: {e}")
             return None
 
-    async def download_and_upload_result(self, completed_data: dict) -> str:
+    async def download_and_upload_result(
+        self,
+        completed_data: dict,
+        job_id: Optional[str] = None,
+        timings: Optional[dict] = None,
+        derivatives: Optional[dict] = None,
+    ) -> tuple[str, str]:
+        """
+        Copy a finished prediction's output into R2 and return its (key, url).
+        When a `derivatives` dict is passed, WebP renditions are stored next to
+        the result and their keys are added to it by variant name.
+
+        Raises TransientError for failures worth retrying (5xx, dropped connections);
+        the copy is idempotent since the result key is derived from the job id.
+        """
+        rendering = derivatives is not None and self.result_derivatives
+        outputs = completed_data.get("data", {}).get("outputs", [])
+        if not outputs:
+            raise Exception(f"Job {job_id} completed without outputs")
+        output = outputs[0]
         try:
-            outputs = completed_data.get("data", {}).get("outputs", [])
-            if not outputs:
-                cprint(f"No outputs found", "red")
-                return None, None
-            output = outputs[0]
-
-
-            async with aiohttp.ClientSession() as session:
-                async with session.get(output) as response:
-                    if response.status == 200:
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpeg") as temp_file:
-                            temp_path = temp_file.name
-                            async with aiofiles.open(temp_path, "wb") as f:
-                                await f.write(await response.read())
-                        r2_url = await self.r2_client.upload_image(temp_path)
-                        r2_key = os.path.basename(temp_path)
-                        os.unlink(temp_path)
+            started = time.monotonic()
+            async with await self._open_result(output) as response:
+                if response.status == 200:
+                    if self.stream_results and job_id:
+                        # the body is piped straight into R2, so download only covers time to first byte
+                        record_span(timings, "download", time.monotonic() - started)
+                        # renditions are made from a copy spooled to disk, so memory stays bounded by the chunk size
+                        spool_path = self._temp_path() if rendering else None
+                        try:
+                            with timed(timings, "reupload"):
+                                r2_key, r2_url = await self._stream_result(response, job_id, output, spool_path)
+                                await self._store_derivatives(r2_key, spool_path, derivatives)
+                            return r2_key, r2_url
+                        finally:
+                            if spool_path is not None:
+                                os.unlink(spool_path)
+                    data = await response.read()
+                    temp_path = self._temp_path()
+                    try:
+                        async with aiofiles.open(temp_path, "wb") as f:
+                            await f.write(data)
+                        record_span(timings, "download", time.monotonic() - started)
+                        with timed(timings, "reupload"):
+                            r2_key, r2_url = await self.limits.r2.run(self.r2_client.upload_image_with_key, temp_path)
+                            if rendering:
+                                await self._store_derivatives(r2_key, temp_path, derivatives)
                         return r2_key, r2_url
-                    else:
-                        print(f"Error downloading result: {response.status}")
-                        return None
+                    finally:
+                        # also on failure or cancellation, so aborted batches leave nothing behind
+                        os.unlink(temp_path)
+                if response.status >= 500 or response.status == 429:
+                    raise TransientError(f"result download answered {response.status}")
+                raise Exception(f"Error downloading result: {response.status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise TransientError(f"result download failed: {e!r}") from e
+
+    async def _open_result(self, url: str) -> aiohttp.ClientResponse:
+        """
+        GET a result. With hedging on, a request that has not answered within
+        `hedge_after` seconds gets a second one, and whichever answers first wins.
+        """
+        session = self._get_session()
+        first = asyncio.ensure_future(session.get(url))
+        if not self.hedge_after:
+            return await first
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_after)
+        if done:
+            return first.result()
+        HEDGED_TOTAL.inc()
+        pending = {first, asyncio.ensure_future(session.get(url))}
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task.result()
+                        for other in done - {task}:
+                            if other.exception() is None:
+                                other.result().close()
+                        return winner
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    @staticmethod
+    def result_key(job_id: str, content_type: str) -> str:
+        """
+        Deterministic R2 key for a job's result, so a retried upload overwrites instead of duplicating.
+        """
+        extension = mimetypes.guess_extension(content_type or "") or ".jpeg"
+        if extension in (".jpg", ".jpe"):
+            extension = ".jpeg"
+        return f"results/{job_id}{extension}"
+
+    @staticmethod
+    def derivative_key(r2_key: str, variant: str) -> str:
+        """
+        Key of a WebP rendition stored next to a result, e.g. results/<job>.thumb.webp.
+        """
+        return f"{os.path.splitext(r2_key)[0]}.{variant}.webp"
+
+    @staticmethod
+    def _temp_path() -> str:
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpeg") as temp_file:
+            return temp_file.name
+
+    async def _stream_result(self, response: aiohttp.ClientResponse, job_id: str, output_url: str, spool_path: Optional[str] = None) -> tuple[str, str]:
+        content_type = response.content_type
+        if not content_type or not content_type.startswith("image/"):
+            # CDNs sometimes answer with application/octet-stream
+            content_type = mimetypes.guess_type(output_url.split("?")[0])[0] or "image/jpeg"
+        r2_key = self.result_key(job_id, content_type)
+
+        async def chunks() -> AsyncIterator[bytes]:
+            if spool_path is None:
+                async for chunk in response.content.iter_chunked(256 * 1024):
+                    yield chunk
+                return
+            # tee the body to disk for the renditions
+            async with aiofiles.open(spool_path, "wb") as spool:
+                async for chunk in response.content.iter_chunked(256 * 1024):
+                    await spool.write(chunk)
+                    yield chunk
+
+        r2_url = await self.limits.r2.run(self.r2_client.upload_stream, chunks(), r2_key, content_type)
+        return r2_key, r2_url
 
+    async def _store_derivatives(self, r2_key: str, path: Optional[str], derivatives: Optional[dict]) -> None:
+        """
+        Render the thumbnail and preview of the result saved at `path` in the process pool and upload them.
+        The worker reads the file itself, so the full image is never pickled across.
+        A failure here leaves the job without renditions rather than failing it.
+        """
+        if path is None or derivatives is None:
+            return
+        try:
+            renditions = await run_in_process_pool(make_derivatives, path, self.derivative_sizes)
+            for variant, rendition in renditions.items():
+                key = self.derivative_key(r2_key, variant)
+                await self.limits.r2.run(self.r2_client.put_object, key, rendition, "image/webp")
+                derivatives[variant] = key
         except Exception as e:
-            print(f"Error downloading and uploading result: {e}")
-            return None
+            cprint(f"Error creating renditions for {r2_key}: {e}", "red")
 
     async def update_job(self, job_id: str, job: Job) -> bool:
         try:
@@ -109,92 +456,434 @@ class ImageProcessorPipeline:
             return False
 
 
-    async def poll_result(self, url: str, job_id: str) -> str:
-        while True:
-            await asyncio.sleep(3)
-            async with aiohttp.ClientSession() as poll_session:
-                async with poll_session.get(url, headers = {
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {self.api_key}"
-                }) as poll_response:
-                    if poll_response.status == 200:
-                        data = await poll_response.json()
-                        status = data.get("data", {}).get("status", None)
-                        cprint(f"Status: {status}", "yellow")
-                        if status == "completed":
-                            cprint(f"Result completed", "green")
-                            r2_key, r2_url = await self.download_and_upload_result(data)
-                            await self.update_job(job_id, {
-                                "wavespeed_result_url": url,
-                                "r2_image_key": r2_key,
-                                "r2_presigned_url": r2_url,
-                                "status": "completed"
-                            })
-                            return r2_url
-                    else:
-                        text = await poll_response.text()
-                        print(f"Error: {poll_response.status} {text}")
-
-
-
-    async def process_single_image(self, file_name: str, image: str, description: str, lia_image: str, lia_image_key: str, target_image_path: str) -> str:
+    async def submit_prediction(self, payload: dict, url: Optional[str] = None) -> Optional[str]:
+        """
+        Submit a prediction to `url` (the Seedream model by default) and return its
+        poll URL, or None if Wavespeed rejected it.
+        Raises RetryAfter on 429, and TransientError only where the job cannot have
+        been created (no connection, 502 or 503), so a retry never pays twice. A 504
+        or a read timeout may come after Wavespeed created the job, so those are not retried.
+        Raises BatchCancelled instead of submitting once the batch is stopping.
+        """
+        # checked here, after any wait for the rate limit, so a stop also catches queued submissions
+        self.cancel_token.raise_if_stopping()
         try:
-            # Determine size based on target image orientation
-            from PIL import Image as PILImage
-            with PILImage.open(target_image_path) as img:
-                width, height = img.size
-                if width > height:  # Landscape
-                    size = "4096*3072"
-                else:  # Portrait or square
-                    size = "3072*4096"
-            
-            payload = {
-                    "enable_base64_output": False,
-                    "enable_sync_mode": False,
-                    "images": [
-                        image,
-                        lia_image
-                    ],
-                    "prompt": description,
-                    "size": size
-                }
-            job_id = await self.create_job({
+            async with self._get_session().post(url or self.url, json=payload, headers=self.headers) as response:
+                if response.status == 200:
+                    resp_data = await response.json()
+                    return resp_data.get("data", {}).get("urls", {}).get("get", None)
+                if response.status == 429:
+                    raise RetryAfter(retry_after_seconds(response.headers), "Wavespeed submit rate limited")
+                text = await response.text()
+                if response.status in (502, 503):
+                    raise TransientError(f"Wavespeed submit answered {response.status}")
+                cprint(f"Error submitting prediction: {response.status} {text}", "red")
+                return None
+        except (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError) as e:
+            # the request never reached Wavespeed
+            raise TransientError(f"could not reach Wavespeed: {e}") from e
+
+    async def _image_size(self, target_image: Union[str, bytes]) -> str:
+        # Determine size based on target image orientation, read from the header only;
+        # drafts keep the 4:3 shape at a smaller long side
+        if isinstance(target_image, bytes):
+            width, height = probe_image(target_image)
+        else:
+            # a header read is too cheap to be worth a round trip to the process pool
+            width, height = await asyncio.to_thread(probe_image, target_image)
+        long_side = DRAFT_LONG_SIDE if self.tier == "draft" else 4096
+        short_side = long_side * 3 // 4
+        if width > height:  # Landscape
+            return f"{long_side}*{short_side}"
+        # Portrait or square
+        return f"{short_side}*{long_side}"
+
+    async def _upload_item(self, item: TargetItem) -> TargetItem:
+        with timed(item.timings, "upload"):
+            if item.data is not None:
+                content_type = upload_content_type(item.data)
+                if content_type is None:
+                    item.data = await run_in_process_pool(convert_to_jpeg, item.data)
+                    content_type = "image/jpeg"
+                item.image_key, item.image_url = await self.limits.r2.run(self.r2_client.upload_bytes_with_key, item.data, content_type)
+            else:
+                item.image_key, item.image_url = await self.limits.r2.run(self.r2_client.upload_image_with_key, item.image_path)
+        return item
+
+    @staticmethod
+    def _target_source(item: TargetItem) -> Union[str, bytes]:
+        return item.data if item.data is not None else item.image_path
+
+    @staticmethod
+    def job_fingerprint(target_key: str, lia_key: str, prompt: str, size: str) -> str:
+        """
+        Identifies one generation request; equal fingerprints would produce (and pay for) the same job.
+        """
+        return hashlib.sha256("\x1f".join([target_key, lia_key, prompt or "", size]).encode("utf-8")).hexdigest()
+
+    async def _reuse_existing_job(self, item: TargetItem) -> bool:
+        """
+        Attach the item to an earlier job with the same fingerprint, if any.
+        Returns True when nothing needs to be submitted.
+        """
+        completed = await self.database_client.find_completed_job(item.fingerprint)
+        if completed:
+            cprint(f"Skipping {item.file_name}: already completed as job {completed['id']}", "green")
+            item.job_id = completed["id"]
+            item.prediction_url = completed["wavespeed_result_url"]
+            item.r2_image_key = completed["r2_image_key"]
+            item.thumbnail_key = completed.get("thumbnail_key")
+            item.preview_key = completed.get("preview_key")
+            # URLs are never stored; sign the result key now
+            item.r2_url = self.r2_client.signer.sign(completed["r2_image_key"])
+            item.reused = True
+            return True
+        incomplete = self._incomplete_jobs.pop(item.fingerprint, None)
+        if incomplete:
+            cprint(f"Resuming {item.file_name}: polling job {incomplete['id']}", "yellow")
+            item.job_id = incomplete["id"]
+            item.prediction_url = incomplete["wavespeed_result_url"]
+            return True
+        return False
+
+    async def _prompt_item(self, item: TargetItem) -> TargetItem:
+        with timed(item.timings, "prompt"):
+            item.description = await self.limits.grok.run(self.prompt_generator, self._target_source(item), self.lia_image_path)
+        cprint(f"Description: {item.description}", "yellow")
+        return item
+
+    async def _submit_item(self, item: TargetItem, lia_image: str, lia_image_key: str, lia_object_key: Optional[str] = None, resume: bool = False) -> TargetItem:
+        item.tier = self.tier
+        item.size = await self._image_size(self._target_source(item))
+        # in-memory bytes are only needed for the size probe and the prompt from here on
+        item.data = None
+        item.fingerprint = self.job_fingerprint(
+            item.image_key or item.image_url,
+            lia_object_key or lia_image_key,
+            item.description,
+            item.size,
+        )
+        if resume and await self._reuse_existing_job(item):
+            return item
+        flight_key = (self.database_client.db_path, item.fingerprint)
+        if _submit_flight.in_flight(flight_key):
+            cprint(f"{item.file_name}: an identical job is being submitted, sharing it", "green")
+        item.job_id, item.prediction_url = await _submit_flight.do(
+            flight_key, lambda: self._submit_job(item, self._prediction_payload(item, lia_image), lia_image_key)
+        )
+        return item
+
+    @staticmethod
+    def _prediction_payload(item: TargetItem, lia_image: str) -> dict:
+        return {
+                "enable_base64_output": False,
+                "enable_sync_mode": False,
+                "images": [
+                    item.image_url,
+                    lia_image
+                ],
+                "prompt": item.description,
+                "size": item.size
+            }
+
+    def _upscale_payload(self, image: str) -> dict:
+        return {
+            "enable_base64_output": False,
+            "enable_sync_mode": False,
+            "image": image,
+            "output_format": "jpeg",
+            "target_resolution": self.upscale_resolution,
+        }
+
+    async def _submit_job(self, item: TargetItem, payload: dict, lia_image_key: str, url: Optional[str] = None) -> tuple[Optional[str], str]:
+        with timed(item.timings, "db_write"):
+            item.job_id = await self.create_job({
                     "lia_image_key": lia_image_key,
-                    "target_image_key": file_name,
+                    "target_image_key": item.file_name,
                     "wavespeed_result_url": None,
                     "r2_image_key": None,
-                    "r2_presigned_url": None,
-                    "status": "pending"
+                    "status": "pending",
+                    "fingerprint": item.fingerprint,
+                    "prompt": item.description,
+                    "size": item.size,
+                    "tier": item.tier,
+                    "parent_job_id": item.parent_job_id,
                 })
-            async with aiohttp.ClientSession() as session:
-                async with session.post(self.url, json=payload, headers = {
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {self.api_key}",
-                }) as response:
-                    if response.status == 200:
-                        resp_data = await response.json()
-                        url = resp_data.get("data", {}).get("urls", {}).get("get", None)
-                        r2_url = await self.poll_result(url, job_id)
-                        return r2_url
-        except Exception as e:
-            print(f"Error processing single image: {e}")
-            return None
+        if item.job_id is None:
+            # without a row there is nothing to checkpoint, and a resume would pay for it again
+            raise Exception(f"Could not record a job for {item.file_name}; not submitting it")
+        try:
+            with timed(item.timings, "submit"):
+                item.prediction_url = await self.limits.wavespeed_submit.run(self.submit_prediction, payload, url)
+        except (asyncio.CancelledError, BatchCancelled):
+            # without a prediction URL there is nothing to resume; don't leave the row 'pending'
+            await self.update_job(item.job_id, {"status": "cancelled"})
+            raise
+        if not item.prediction_url:
+            await self.update_job(item.job_id, {"status": "failed"})
+            raise SubmitRejected(f"Wavespeed did not accept {item.file_name}")
+        # checkpoint right away: if we die while polling, a restart can pick this job up
+        with timed(item.timings, "db_write"):
+            await self.database_client.mark_submitted(item.job_id, item.prediction_url)
+        return item.job_id, item.prediction_url
+
+    async def _poll_item(self, item: TargetItem) -> TargetItem:
+        if self.poll_scheduler is None:
+            raise RuntimeError("ImageProcessorPipeline is not open; use 'async with ImageProcessorPipeline(...)'")
+        poll_scheduler = self.poll_scheduler
+
+        async def wait() -> dict:
+            JOBS_IN_FLIGHT.inc()
+            try:
+                return await poll_scheduler.wait(item.prediction_url, item.job_id, timings=item.timings)
+            finally:
+                JOBS_IN_FLIGHT.dec()
+
+        item.result = await _poll_flight.do(item.prediction_url, wait)
+        cprint(f"Result completed", "green")
+        return item
+
+    async def _download_item(self, item: TargetItem) -> TargetItem:
+        # upscales keep their draft's renditions, which would look the same
+        with_renditions = item.thumbnail_key is None
 
-    async def process_images(self) -> list[str]:
-        lia_image = await self.upload_file(self.lia_image_path)
+        async def download() -> tuple[str, str, dict[str, str]]:
+            derivatives: Optional[dict[str, str]] = {} if with_renditions else None
+            r2_key, r2_url = await self.limits.wavespeed_download.run(
+                self.download_and_upload_result, item.result, item.job_id, item.timings, derivatives
+            )
+            return r2_key, r2_url, derivatives
+
+        item.r2_image_key, item.r2_url, derivatives = await _download_flight.do(item.prediction_url, download)
+        if derivatives is not None:
+            item.thumbnail_key = derivatives.get("thumb")
+            item.preview_key = derivatives.get("preview")
+        # the full payload is no longer needed once the result is in R2
+        item.result = None
+        return item
+
+    async def _record_item(self, item: TargetItem) -> TargetItem:
+        # the spans are stored with this write, so db_write excludes the write itself
+        spans = {f"{span}_seconds": seconds for span, seconds in item.timings.items()}
+        with timed(item.timings, "db_write"):
+            await self.update_job(item.job_id, {
+                "wavespeed_result_url": item.prediction_url,
+                "r2_image_key": item.r2_image_key,
+                "thumbnail_key": item.thumbnail_key,
+                "preview_key": item.preview_key,
+                "status": "completed",
+                "retries": item.retries,
+                **spans,
+            })
+        return item
+
+    async def stream_images(self, resume: bool = False, upscale: Optional[Callable[[TargetItem], bool]] = None) -> AsyncIterator[TargetItem]:
+        """
+        Run scan -> upload -> (prompt) -> submit -> poll -> download -> DB update
+        as overlapping stages and yield each item as soon as it finishes.
+        Failed items are yielded too, with `error` set.
+
+        With `resume`, targets whose fingerprint already completed are returned
+        from the jobs table, and targets with an interrupted job resume polling
+        that job's prediction URL instead of being submitted (and paid for) again.
+
+        In draft mode, finished drafts that `upscale` approves are upscaled in
+        further stages and yielded as the upscale job, linked by parent_job_id.
+        """
+        lia_object_key, lia_image = await self.limits.r2.run(self.r2_client.upload_image_with_key, self.lia_image_path)
         lia_image_key = os.path.basename(self.lia_image_path)
-        tasks = []
-        files = await self.get_files()
-        for file_name, image, description, image_path in files:
-            cprint(f"Processing {file_name}...", "yellow")
+        if resume:
+            self._incomplete_jobs = {
+                job["fingerprint"]: job
+                for job in await self.database_client.get_incomplete_jobs()
+                if job.get("fingerprint")
+            }
+        not_reused = lambda item: not item.reused
+        submit, poll = self._in_flight_bound(lambda item: self._submit_item(item, lia_image, lia_image_key, lia_object_key, resume))
+
+        stages = [
+            Stage("upload", self._upload_item, STAGE_UPLOAD_WORKERS, starts_work=True),
+            Stage("prompt", self._prompt_item, STAGE_PROMPT_WORKERS, when=lambda item: item.description is None, starts_work=True),
+            Stage("submit", submit, STAGE_SUBMIT_WORKERS, starts_work=True),
+            Stage("poll", poll, self.max_in_flight, when=not_reused),
+            Stage("download", self._download_item, STAGE_DOWNLOAD_WORKERS, when=not_reused),
+            Stage("record", self._record_item, STAGE_DB_WORKERS, when=not_reused),
+        ]
+        if upscale is not None and self.tier == "draft":
+            stages += self._upscale_stages(when=upscale)
+        async for item in run_stages(self.scan_targets(), stages, STAGE_QUEUE_SIZE, self.cancel_token):
+            if item.error is None:
+                cprint(f"Finished {item.file_name}", "green")
+            JOBS_TOTAL.inc(self._outcome(item))
+            yield item
+
+    @staticmethod
+    def _outcome(item: TargetItem) -> str:
+        if isinstance(item.error, BatchCancelled):
+            return "cancelled"
+        return "failed" if item.error is not None else "reused" if item.reused else "completed"
+
+    def _in_flight_bound(self, submit: Callable[[TargetItem], Awaitable[TargetItem]]) -> tuple[Callable, Callable]:
+        """
+        Wrap a submit step and _poll_item so at most max_in_flight jobs are between
+        submission and the end of polling, including jobs waiting in the queue between
+        the two stages. Items that won't be polled (reused) give their slot back at once.
+        """
+        slots = asyncio.Semaphore(self.max_in_flight)
+
+        async def submit_bounded(item: TargetItem) -> TargetItem:
+            await slots.acquire()
             try:
-                tasks.append(self.process_single_image(file_name, image, description, lia_image, lia_image_key, image_path))
-            except Exception as e:
-                print(f"Error processing image: {e}")
-        results = await asyncio.gather(*tasks)
-        return results
+                item = await submit(item)
+            except BaseException:
+                slots.release()
+                raise
+            if item.reused:
+                slots.release()
+            return item
 
+        async def poll_bounded(item: TargetItem) -> TargetItem:
+            try:
+                return await self._poll_item(item)
+            finally:
+                slots.release()
+
+        return submit_bounded, poll_bounded
+
+    def _upscale_stages(self, when: Optional[Callable[[TargetItem], bool]] = None) -> list[Stage]:
+        upscaling = lambda item: item.parent_job_id is not None and not item.reused
+        submit, poll = self._in_flight_bound(self._upscale_item)
+        return [
+            Stage("upscale", submit, STAGE_SUBMIT_WORKERS, when=when, starts_work=True),
+            Stage("upscale_poll", poll, self.max_in_flight, when=upscaling),
+            Stage("upscale_download", self._download_item, STAGE_DOWNLOAD_WORKERS, when=upscaling),
+            Stage("upscale_record", self._record_item, STAGE_DB_WORKERS, when=upscaling),
+        ]
+
+    async def _upscale_item(self, item: TargetItem) -> TargetItem:
+        """
+        Submit the upscale of a completed draft (item.parent_job_id, or item.job_id for a
+        draft that just finished). From here on the item stands for the upscale job.
+        An upscale of the same draft that already completed is reused.
+        """
+        draft_id = item.parent_job_id or item.job_id
+        draft = await self.database_client.get_job(draft_id)
+        if draft is None or draft["status"] != "completed" or not draft.get("r2_image_key"):
+            raise Exception(f"Job {draft_id} has no completed result to upscale")
+        if draft.get("tier") != "draft":
+            raise Exception(f"Job {draft_id} is already full size")
+        item.parent_job_id = draft_id
+        item.file_name = draft["target_image_key"]
+        item.description = draft.get("prompt")
+        item.tier = "full"
+        item.size = self.upscale_resolution
+        item.job_id = item.prediction_url = item.r2_image_key = item.r2_url = None
+        item.thumbnail_key = draft.get("thumbnail_key")
+        item.preview_key = draft.get("preview_key")
+        item.reused = False
+        item.retries = 0
+        item.timings = {}
+        item.fingerprint = self.job_fingerprint(draft["r2_image_key"], "", "upscale", item.size)
+        if await self._reuse_existing_job(item):
+            return item
+        payload = self._upscale_payload(self.r2_client.signer.sign(draft["r2_image_key"]))
+        flight_key = (self.database_client.db_path, item.fingerprint)
+        item.job_id, item.prediction_url = await _submit_flight.do(
+            flight_key, lambda: self._submit_job(item, payload, draft["lia_image_key"], self.upscale_url)
+        )
+        return item
+
+    async def upscale_jobs(self, job_ids: Iterable[str], resume: bool = False) -> AsyncIterator[TargetItem]:
+        """
+        Upscale completed draft jobs and yield one item per job id as it finishes,
+        with `parent_job_id` set to the draft. With `resume`, interrupted upscales
+        resume polling instead of being submitted again.
+        """
+        if resume:
+            self._incomplete_jobs = {
+                job["fingerprint"]: job
+                for job in await self.database_client.get_incomplete_jobs()
+                if job.get("fingerprint")
+            }
 
+        async def drafts() -> AsyncIterator[TargetItem]:
+            for index, job_id in enumerate(job_ids):
+                yield TargetItem(index=index, file_name=job_id, image_path=None, parent_job_id=job_id)
 
+        async for item in run_stages(drafts(), self._upscale_stages(), STAGE_QUEUE_SIZE, self.cancel_token):
+            if item.error is None:
+                cprint(f"Upscaled {item.file_name}", "green")
+            JOBS_TOTAL.inc(self._outcome(item))
+            yield item
 
-                
\ No newline at end of file
+    async def enqueue_images(self, store: JobStore, resume: bool = False) -> AsyncIterator[TargetItem]:
+        """
+        Upload targets and generate missing prompts like stream_images, but queue each
+        job in `store` for workers (utils.worker) instead of submitting it. Yields items once queued.
+        With `resume`, targets whose fingerprint already completed, or is still queued or
+        in progress, are not queued again.
+        """
+        lia_object_key, _ = await self.limits.r2.run(self.r2_client.upload_image_with_key, self.lia_image_path)
+        lia_image_key = os.path.basename(self.lia_image_path)
+        stages = [
+            Stage("upload", self._upload_item, STAGE_UPLOAD_WORKERS, starts_work=True),
+            Stage("prompt", self._prompt_item, STAGE_PROMPT_WORKERS, when=lambda item: item.description is None, starts_work=True),
+            Stage("enqueue", lambda item: self._enqueue_item(item, store, lia_image_key, lia_object_key, resume), STAGE_SUBMIT_WORKERS, starts_work=True),
+        ]
+        async for item in run_stages(self.scan_targets(), stages, STAGE_QUEUE_SIZE, self.cancel_token):
+            if item.error is None:
+                cprint(f"Queued {item.file_name}", "green")
+            yield item
+
+    async def _enqueue_item(self, item: TargetItem, store: JobStore, lia_image_key: str, lia_object_key: str, resume: bool) -> TargetItem:
+        item.tier = self.tier
+        item.size = await self._image_size(self._target_source(item))
+        item.data = None
+        item.fingerprint = self.job_fingerprint(item.image_key, lia_object_key, item.description, item.size)
+        if resume:
+            if await self._reuse_existing_job(item):
+                return item
+            active = await store.find_active(item.fingerprint)
+            if active:
+                cprint(f"Skipping {item.file_name}: already queued as job {active['id']}", "green")
+                item.job_id = active["id"]
+                item.reused = True
+                return item
+        with timed(item.timings, "db_write"):
+            job_ids = await store.enqueue([{
+                "lia_image_key": lia_image_key,
+                "target_image_key": item.file_name,
+                "fingerprint": item.fingerprint,
+                "prompt": item.description,
+                "size": item.size,
+                "tier": item.tier,
+                "target_object_key": item.image_key,
+                "lia_object_key": lia_object_key,
+            }])
+        if not job_ids:
+            raise Exception(f"Could not queue {item.file_name}")
+        item.job_id = job_ids[0]
+        return item
+
+    async def run_job(self, item: TargetItem, lia_image: Optional[str] = None, on_submitted: Optional[Callable[[TargetItem], Awaitable[None]]] = None) -> TargetItem:
+        """
+        Take one job that already has a row to its stored result: submit it unless it
+        has a prediction URL, then poll and download. Used by workers, which record the
+        outcome themselves; `on_submitted` lets them checkpoint the prediction URL.
+        """
+        if item.prediction_url is None:
+            with timed(item.timings, "submit"):
+                item.prediction_url = await self.limits.wavespeed_submit.run(self.submit_prediction, self._prediction_payload(item, lia_image))
+            if not item.prediction_url:
+                raise SubmitRejected(f"Wavespeed did not accept {item.file_name}")
+            if on_submitted is not None:
+                await on_submitted(item)
+        await self._poll_item(item)
+        return await self._download_item(item)
+
+    async def process_images(self, resume: bool = False) -> list[str]:
+        results: list[Optional[str]] = []
+        async for item in self.stream_images(resume=resume):
+            results.extend([None] * (item.index + 1 - len(results)))
+            results[item.index] = item.r2_url if item.error is None else None
+        return results
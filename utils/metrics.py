@@ -0,0 +1,196 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from termcolor import cprint
+
+# Per-job spans, in pipeline order. Each one has a <span>_seconds column in the jobs table.
+SPANS = (
+    "upload",
+    "prompt",
+    "submit",
+    "queue_wait",
+    "generation",
+    "download",
+    "reupload",
+    "db_write",
+)
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: tuple) -> tuple[str, ...]:
+        if len(labels) != len(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {labels}")
+        return tuple(str(label) for label in labels)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels, amount: float = 1.0) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount: float = 1.0) -> None:
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> (per-bucket counts, sum, count); the last bucket is +Inf
+        self._values: dict[tuple[str, ...], tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0, 0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip((*self.buckets, math.inf), counts):
+                    cumulative += bucket_count
+                    le = f'le="{_format_value(bound)}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Process-wide metrics rendered in the Prometheus text exposition format.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS: Histogram = REGISTRY.register(Histogram(
+    "pipeline_stage_seconds", "Time spent in each per-job span", ("stage",)
+))
+JOBS_IN_FLIGHT: Gauge = REGISTRY.register(Gauge(
+    "pipeline_jobs_in_flight", "Wavespeed jobs submitted and not yet finished"
+))
+JOBS_TOTAL: Counter = REGISTRY.register(Counter(
+    "pipeline_jobs_total", "Targets that left the pipeline, by outcome", ("status",)
+))
+RETRIES_TOTAL: Counter = REGISTRY.register(Counter(
+    "pipeline_retries_total", "Calls retried, by reason: throttled (429) or transient (timeout, 5xx, dropped connection)", ("lane", "reason")
+))
+THROTTLED_TOTAL: Counter = REGISTRY.register(Counter(
+    "pipeline_throttled_total", "HTTP 429 responses received", ("lane",)
+))
+CIRCUIT_OPEN: Gauge = REGISTRY.register(Gauge(
+    "pipeline_circuit_open", "1 while a lane's circuit breaker is pausing calls", ("lane",)
+))
+HEDGED_TOTAL: Counter = REGISTRY.register(Counter(
+    "pipeline_hedged_downloads_total", "Result downloads that started a second, hedged request"
+))
+
+
+def record_span(timings: Optional[dict], span: str, seconds: float) -> None:
+    """
+    Add `seconds` to a job's span (spans can be entered more than once) and observe it.
+    """
+    STAGE_SECONDS.observe(seconds, span)
+    if timings is not None:
+        timings[span] = timings.get(span, 0.0) + seconds
+
+
+@contextmanager
+def timed(timings: Optional[dict], span: str) -> Iterator[None]:
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        record_span(timings, span, time.monotonic() - started)
+
+
+async def start_metrics_server(port: int, host: str = "127.0.0.1", registry: MetricsRegistry = REGISTRY):
+    """
+    Serve `registry` at http://host:port/metrics. Returns the aiohttp AppRunner; call cleanup() to stop it.
+    """
+    from aiohttp import web
+
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(
+            body=registry.render().encode("utf-8"),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    cprint(f"Serving metrics on http://{host}:{port}/metrics", "green")
+    return runner
@@ -0,0 +1,232 @@
+import asyncio
+import heapq
+import itertools
+import random
+from dataclasses import dataclass
+from typing import Optional
+
+import aiohttp
+from termcolor import cprint
+
+from config import (
+    POLL_MIN_INTERVAL,
+    POLL_MAX_INTERVAL,
+    POLL_BACKOFF_FACTOR,
+    POLL_DEADLINE,
+    POLL_MAX_CONCURRENCY,
+    POLL_MAX_ERRORS,
+)
+from .rate_limit import Lane, retry_after_seconds
+from .metrics import THROTTLED_TOTAL, record_span
+
+
+class PollFailed(Exception):
+    pass
+
+
+class PollTimeout(Exception):
+    pass
+
+
+@dataclass
+class _PollJob:
+    url: str
+    job_id: str
+    started_at: float
+    deadline: float
+    future: asyncio.Future
+    errors: int = 0
+    checks: int = 0
+    # span dict to fill with queue_wait / generation, and when "processing" was first seen
+    timings: Optional[dict] = None
+    processing_at: Optional[float] = None
+
+
+class PollScheduler:
+    """
+    Multiplexes every outstanding Wavespeed prediction URL onto one loop.
+
+    Jobs sit in a heap keyed by their next check time. The interval between
+    checks grows with the job's age, so young jobs are checked often and
+    long-running ones back off. Jobs that report "failed", keep erroring or
+    pass their deadline are written to the jobs table and resolved with
+    PollFailed / PollTimeout instead of spinning forever.
+    """
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        headers: dict,
+        database_client=None,
+        min_interval: float = POLL_MIN_INTERVAL,
+        max_interval: float = POLL_MAX_INTERVAL,
+        backoff_factor: float = POLL_BACKOFF_FACTOR,
+        deadline: float = POLL_DEADLINE,
+        max_concurrency: int = POLL_MAX_CONCURRENCY,
+        max_errors: int = POLL_MAX_ERRORS,
+        lane: Optional[Lane] = None,
+    ) -> None:
+        self.session = session
+        self.headers = headers
+        self.database_client = database_client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.deadline = deadline
+        self.max_errors = max_errors
+        # rate limit and concurrency cap shared by all poll requests
+        self.lane = lane or Lane("wavespeed_poll", 0, 1, max_concurrency)
+        self._heap: list[tuple[float, int, _PollJob]] = []
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._runner: Optional[asyncio.Task] = None
+        self._checks: set[asyncio.Task] = set()
+
+    @property
+    def pending(self) -> int:
+        return sum(1 for _, _, job in self._heap if not job.future.done()) + len(self._checks)
+
+    def start(self) -> None:
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            self._runner.cancel()
+            await asyncio.gather(self._runner, return_exceptions=True)
+            self._runner = None
+        for task in list(self._checks):
+            task.cancel()
+        await asyncio.gather(*self._checks, return_exceptions=True)
+        for _, _, job in self._heap:
+            if not job.future.done():
+                job.future.cancel()
+        self._heap.clear()
+
+    async def wait(self, url: str, job_id: str, deadline: Optional[float] = None, timings: Optional[dict] = None) -> dict:
+        """
+        Wait for a prediction to complete and return its final payload.
+        `timings` receives the queue_wait and generation spans as observed by polling.
+        """
+        self.start()
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        job = _PollJob(
+            url=url,
+            job_id=job_id,
+            started_at=now,
+            deadline=now + (deadline if deadline is not None else self.deadline),
+            future=loop.create_future(),
+            timings=timings,
+        )
+        self._schedule(job, now + self.min_interval)
+        return await job.future
+
+    def _next_interval(self, job: _PollJob, now: float) -> float:
+        age = now - job.started_at
+        interval = min(self.max_interval, max(self.min_interval, age * self.backoff_factor))
+        if job.errors:
+            interval = min(self.max_interval, interval * (2 ** job.errors))
+        # jitter so jobs submitted together don't poll in lockstep
+        return interval * random.uniform(0.9, 1.1)
+
+    def _schedule(self, job: _PollJob, at: float) -> None:
+        at = min(at, job.deadline)
+        heapq.heappush(self._heap, (at, next(self._counter), job))
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            at, _, job = self._heap[0]
+            delay = at - loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            heapq.heappop(self._heap)
+            if job.future.done():
+                # caller went away
+                continue
+            task = asyncio.create_task(self._check(job))
+            self._checks.add(task)
+            task.add_done_callback(self._checks.discard)
+
+    async def _check(self, job: _PollJob) -> None:
+        loop = asyncio.get_running_loop()
+        if loop.time() >= job.deadline:
+            await self._finish(job, "timeout", PollTimeout(f"Polling {job.url} exceeded its deadline"))
+            return
+        job.checks += 1
+        try:
+            async with self.lane.slot():
+                async with self.session.get(job.url, headers=self.headers) as response:
+                    if response.status == 200:
+                        data = await response.json()
+                    elif response.status == 429:
+                        # throttled: slow the whole lane down, not just this job
+                        data = None
+                        THROTTLED_TOTAL.inc(self.lane.name)
+                        self.lane.pause(retry_after_seconds(response.headers, self.min_interval))
+                    else:
+                        text = await response.text()
+                        data = None
+                        cprint(f"Error polling {job.job_id}: {response.status} {text}", "red")
+                        # 4xx will not fix itself
+                        if 400 <= response.status < 500:
+                            job.errors = self.max_errors
+                        else:
+                            job.errors += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            cprint(f"Error polling {job.job_id}: {e}", "red")
+            data = None
+            job.errors += 1
+
+        if data is None:
+            if job.errors >= self.max_errors:
+                await self._finish(job, "failed", PollFailed(f"Polling {job.url} failed {job.errors} times"))
+            else:
+                self._schedule(job, loop.time() + self._next_interval(job, loop.time()))
+            return
+
+        job.errors = 0
+        status = data.get("data", {}).get("status", None)
+        cprint(f"Status: {status}", "yellow")
+        if status == "processing" and job.processing_at is None:
+            job.processing_at = loop.time()
+        if status == "completed":
+            self._record_spans(job, loop.time())
+            if not job.future.done():
+                job.future.set_result(data)
+        elif status == "failed":
+            error = data.get("data", {}).get("error") or "prediction failed"
+            await self._finish(job, "failed", PollFailed(f"Job {job.job_id} failed: {error}"))
+        else:
+            self._schedule(job, loop.time() + self._next_interval(job, loop.time()))
+
+    @staticmethod
+    def _record_spans(job: _PollJob, now: float) -> None:
+        # a job that finished between two checks was never seen processing; count it all as generation
+        processing_at = job.processing_at if job.processing_at is not None else job.started_at
+        record_span(job.timings, "queue_wait", processing_at - job.started_at)
+        record_span(job.timings, "generation", now - processing_at)
+
+    async def _finish(self, job: _PollJob, status: str, error: Exception) -> None:
+        cprint(str(error), "red")
+        if self.database_client is not None:
+            await self.database_client.update_job(job.job_id, {
+                "wavespeed_result_url": job.url,
+                "r2_image_key": None,
+                "status": status,
+            })
+        if not job.future.done():
+            job.future.set_exception(error)
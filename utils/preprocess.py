@@ -0,0 +1,163 @@
+import asyncio
+import base64
+import hashlib
+import io
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Optional, Union
+
+from config import PREPROCESS_WORKERS, VISION_MAX_SIDE, VISION_JPEG_QUALITY, UPLOAD_JPEG_QUALITY, DERIVATIVE_WEBP_QUALITY
+
+# EXIF orientations that rotate the image by 90/270 degrees
+_TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+_EXIF_ORIENTATION = 0x0112
+
+# formats Wavespeed accepts as-is; anything else is converted to JPEG before upload
+UPLOAD_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _mp_context():
+    # forkserver where the platform has it (not on Windows, which only spawns)
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # not fork: the parent already runs an event loop and boto3/aiosqlite threads whose locks a forked child would inherit
+            _pool = ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS, mp_context=_mp_context())
+        return _pool
+
+
+def shutdown_process_pool(wait: bool = True) -> None:
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=wait, cancel_futures=True)
+
+
+async def run_in_process_pool(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_process_pool(), partial(fn, *args, **kwargs))
+
+
+def _open_source(source: Union[str, bytes]):
+    return io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source
+
+
+def probe_image(source: Union[str, bytes]) -> tuple[int, int]:
+    """
+    Return the displayed (width, height) from the image header only; pixel data is never decoded.
+    Dimensions are swapped when EXIF orientation rotates the image. `source` is a path or the file's bytes.
+    """
+    from PIL import Image
+
+    with Image.open(_open_source(source)) as img:
+        width, height = img.size
+        try:
+            orientation = img.getexif().get(_EXIF_ORIENTATION)
+        except Exception:
+            orientation = None
+    if orientation in _TRANSPOSED_ORIENTATIONS:
+        return height, width
+    return width, height
+
+
+def upload_content_type(data: bytes) -> Optional[str]:
+    """
+    MIME type of `data` if it can be uploaded unchanged, from the header only; None otherwise.
+    """
+    from PIL import Image
+
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            return UPLOAD_FORMATS.get(img.format)
+    except Exception:
+        return None
+
+
+def convert_to_jpeg(data: bytes, quality: int = UPLOAD_JPEG_QUALITY) -> bytes:
+    """
+    Re-encode an image in a format Wavespeed won't take (HEIC, TIFF, BMP, ...) as an upright JPEG.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def make_derivatives(source: Union[str, bytes], sizes: dict[str, int], quality: int = DERIVATIVE_WEBP_QUALITY) -> dict[str, bytes]:
+    """
+    WebP renditions of an image, one per name in `sizes` (name -> max side), upright per EXIF.
+    The image is decoded once, at reduced scale where the decoder allows, and shrunk largest first.
+    `source` is a path or the file's bytes.
+    """
+    from PIL import Image, ImageOps
+
+    renditions = {}
+    with Image.open(_open_source(source)) as img:
+        largest = max(sizes.values())
+        img.draft("RGB", (largest, largest))
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGB")
+        for name, max_side in sorted(sizes.items(), key=lambda size: size[1], reverse=True):
+            img.thumbnail((max_side, max_side))
+            buffer = io.BytesIO()
+            img.save(buffer, format="WEBP", quality=quality)
+            renditions[name] = buffer.getvalue()
+    return renditions
+
+
+def file_sha256(source: Union[str, bytes]) -> str:
+    """
+    sha256 of an image's original bytes; `source` is a path or the file's bytes. Matches vision_payload's hash.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        return hashlib.sha256(source).hexdigest()
+    digest = hashlib.sha256()
+    with open(source, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def vision_payload(source: Union[str, bytes], max_side: int = VISION_MAX_SIDE, quality: int = VISION_JPEG_QUALITY) -> tuple[str, str]:
+    """
+    Return (base64 JPEG, sha256 of the original file) for a vision model call.
+    `source` is a path or the file's bytes.
+
+    The image is upright per EXIF and fits in max_side x max_side. The hash is
+    of the untouched original, so cache keys don't depend on resize settings.
+    """
+    from PIL import Image, ImageOps
+
+    if isinstance(source, (bytes, bytearray)):
+        data = bytes(source)
+    else:
+        with open(source, "rb") as f:
+            data = f.read()
+    content_hash = hashlib.sha256(data).hexdigest()
+    with Image.open(io.BytesIO(data)) as img:
+        # let the JPEG decoder downscale by powers of two instead of decoding full size
+        img.draft("RGB", (max_side, max_side))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_side, max_side))
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return base64.b64encode(buffer.getvalue()).decode("utf-8"), content_hash
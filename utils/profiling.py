@@ -0,0 +1,45 @@
+import cProfile
+import pstats
+from contextlib import contextmanager
+from typing import Iterator
+
+from termcolor import cprint
+
+PROFILERS = ("cprofile", "yappi")
+
+
+@contextmanager
+def profile_run(path: str, profiler: str = "cprofile", top: int = 25) -> Iterator[None]:
+    """
+    Profile everything run inside the block and write pstats-format output to `path`.
+
+    cProfile only sees the thread that enters the block (the event loop).
+    yappi (optional, `pip install yappi`) also covers the R2 and DB threads and
+    measures wall time, which is what matters for an I/O-bound run.
+    """
+    if profiler == "yappi":
+        try:
+            import yappi
+        except ImportError:
+            raise RuntimeError("yappi is not installed; run 'pip install yappi' or use the cprofile profiler")
+        yappi.set_clock_type("wall")
+        yappi.start(builtins=False)
+        try:
+            yield
+        finally:
+            yappi.stop()
+            yappi.get_func_stats().save(path, type="pstat")
+            yappi.clear_stats()
+    elif profiler == "cprofile":
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(path)
+    else:
+        raise ValueError(f"Unknown profiler {profiler!r}; expected one of {PROFILERS}")
+
+    cprint(f"Profile written to {path}", "green")
+    pstats.Stats(path).sort_stats("cumulative").print_stats(top)
@@ -0,0 +1,77 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from termcolor import cprint
+
+from config import PROMPT_CACHE_PATH, PROMPT_CACHE_MAX_ENTRIES
+
+
+def prompt_cache_key(reference_hash: str, lia_hash: str, model: str, prompt_version: str) -> str:
+    return hashlib.sha256("\x1f".join([reference_hash, lia_hash, model, prompt_version]).encode("utf-8")).hexdigest()
+
+
+class PromptCache:
+    """
+    Persistent map from prompt_cache_key(...) to the generated Seedream prompt,
+    bounded to `max_entries` with least-recently-used eviction.
+    """
+
+    EVICT_EVERY = 100
+
+    def __init__(self, path: str = PROMPT_CACHE_PATH, max_entries: int = PROMPT_CACHE_MAX_ENTRIES) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS prompts (
+                key TEXT PRIMARY KEY,
+                prompt TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        ''')
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_prompts_last_used ON prompts (last_used)")
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT prompt FROM prompts WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE prompts SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def put(self, key: str, prompt: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute('''
+                INSERT OR REPLACE INTO prompts (key, prompt, created_at, last_used) VALUES (?, ?, ?, ?)
+            ''', (key, prompt, now, now))
+            self._writes += 1
+            if self._writes % self.EVICT_EVERY == 0:
+                self._evict()
+
+    def _evict(self) -> None:
+        try:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM prompts").fetchone()
+            if count > self.max_entries:
+                self._conn.execute('''
+                    DELETE FROM prompts WHERE key IN (
+                        SELECT key FROM prompts ORDER BY last_used ASC LIMIT ?
+                    )
+                ''', (count - self.max_entries,))
+        except sqlite3.Error as e:
+            cprint(f"Error evicting prompt cache: {e}", "red")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -2,18 +2,107 @@
 
 import os
 from dotenv import load_dotenv
-import aiohttp
-import boto3
-from botocore.config import Config
 from termcolor import cprint
 load_dotenv()
 import mimetypes
-import json
 import asyncio
-from tqdm import tqdm
-import random
-import time
-from config import CACHE_DIR
+import hashlib
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property, partial
+from typing import AsyncIterable, AsyncIterator, BinaryIO, Callable, Iterable, Optional
+from config import (
+    CACHE_DIR,
+    R2_ENDPOINT_URL,
+    R2_IO_THREADS,
+    R2_MULTIPART_THRESHOLD,
+    R2_MULTIPART_CHUNKSIZE,
+    R2_MULTIPART_CONCURRENCY,
+    R2_STREAM_PART_SIZE,
+    R2_URL_EXPIRES_IN,
+)
+from .upload_cache import UploadCache, hash_file
+from .signer import UrlSigner
+from .singleflight import SingleFlight
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+_upload_cache: Optional[UploadCache] = None
+_s3_client = None
+_signer: Optional[UrlSigner] = None
+_r2_client: Optional["R2Client"] = None
+# concurrent uploads of the same bytes share one cache check and PUT
+_upload_flight = SingleFlight()
+
+
+def get_r2_executor() -> ThreadPoolExecutor:
+    """
+    Process-wide pool that all blocking boto3 calls run on, keeping them off the event loop.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=R2_IO_THREADS, thread_name_prefix="r2-io")
+        return _executor
+
+
+def get_upload_cache() -> UploadCache:
+    global _upload_cache
+    with _executor_lock:
+        if _upload_cache is None:
+            _upload_cache = UploadCache()
+        return _upload_cache
+
+
+def get_s3_client():
+    """
+    Process-wide boto3 client; boto3 clients are thread-safe and expensive to build.
+    """
+    global _s3_client
+    with _executor_lock:
+        if _s3_client is None:
+            # boto3 takes a noticeable part of a second to import; only pay for it when R2 is used
+            import boto3
+            from botocore.config import Config
+
+            _s3_client = boto3.client(
+                's3',
+                endpoint_url=R2_ENDPOINT_URL or f"https://{os.getenv('R2_ACCOUNT_ID')}.r2.cloudflarestorage.com",
+                aws_access_key_id=os.getenv('R2_ACCESS_KEY_ID'),
+                aws_secret_access_key=os.getenv('R2_SECRET_ACCESS_KEY'),
+                region_name='auto',
+                config=Config(
+                    signature_version='s3v4',
+                    # every executor thread plus its multipart parts needs a connection
+                    max_pool_connections=R2_IO_THREADS * R2_MULTIPART_CONCURRENCY,
+                )
+            )
+        return _s3_client
+
+
+def get_signer() -> UrlSigner:
+    """
+    Process-wide presigned URL signer for the R2 bucket.
+    """
+    global _signer
+    client = get_s3_client()
+    with _executor_lock:
+        if _signer is None:
+            _signer = UrlSigner(client, os.getenv('R2_BUCKET_NAME'))
+        return _signer
+
+
+def get_r2_client() -> "R2Client":
+    """
+    Process-wide R2Client for the configured bucket. Nothing is built until the first upload or signature.
+    """
+    global _r2_client
+    with _executor_lock:
+        if _r2_client is None:
+            _r2_client = R2Client()
+        return _r2_client
+
 
 class R2Client:
     def __init__(self, bucket_name: str = os.getenv('R2_BUCKET_NAME')):
@@ -23,93 +112,224 @@ class R2Client:
         self.r2_account_id = os.getenv('R2_ACCOUNT_ID')
         self.r2_access_key_id = os.getenv('R2_ACCESS_KEY_ID')
         self.r2_secret_access_key = os.getenv('R2_SECRET_ACCESS_KEY')
-        self.expires_in = 72000 
-        self.r2_client = boto3.client(
-            's3',
-            endpoint_url=f'https://{self.r2_account_id}.r2.cloudflarestorage.com',
-            aws_access_key_id=self.r2_access_key_id,
-            aws_secret_access_key=self.r2_secret_access_key,
-            region_name='auto',
-            config=Config(signature_version='s3v4')
+        self.expires_in = R2_URL_EXPIRES_IN
+
+    # the boto3 client, signer, transfer settings and upload cache are created on first use
+
+    @property
+    def r2_client(self):
+        return get_s3_client()
+
+    @cached_property
+    def signer(self) -> UrlSigner:
+        return get_signer() if self.bucket_name == os.getenv('R2_BUCKET_NAME') else UrlSigner(self.r2_client, self.bucket_name)
+
+    @cached_property
+    def transfer_config(self):
+        from boto3.s3.transfer import TransferConfig
+
+        return TransferConfig(
+            multipart_threshold=R2_MULTIPART_THRESHOLD,
+            multipart_chunksize=R2_MULTIPART_CHUNKSIZE,
+            max_concurrency=R2_MULTIPART_CONCURRENCY,
+            use_threads=True,
         )
-        self.cache_file = os.path.join(CACHE_DIR, 'r2_upload_cache.json')
-
-    def _load_cache(self)->dict:
-        if os.path.exists(self.cache_file):
-            try:
-                with open(self.cache_file, 'r') as f:
-                    return json.load(f)
-            except Exception as e:
-                cprint(f"Error loading cache: {e}", "red")
-                return {}
-        return {}
-    
-    def _save_cache(self, cache: dict):
-        try:
-            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
-            with open(self.cache_file, 'w') as f:
-                json.dump(cache, f, indent=2)
-        except Exception as e:
-            cprint(f"Error saving cache: {e}", "red")
-
-    def _is_cache_valid(self, cache_entry: dict)->bool:
-        if not cache_entry or 'timestamp' not in cache_entry or 'url' not in cache_entry:
-            return False
-        # get current time
-        current_time = time.time()
-        # when was the image uploaded?
-        upload_time = cache_entry['timestamp']
-        # when does it expire?
-        expires_in = cache_entry.get('expires_in', self.expires_in)
-        #  add a 5 minute buffer before expiration to be safe
-        buffer = 300
-        # check if time since uploaded is less than how long the image is supposed to be valid for
-        return (current_time - upload_time) < (expires_in - buffer)
- 
-    async def get_presigned_url(self, file_name: str) -> bytes:
+
+    @property
+    def upload_cache(self) -> UploadCache:
+        return get_upload_cache()
+
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_r2_executor(), partial(fn, *args, **kwargs))
+
+    def _presign(self, file_name: str) -> str:
+        return self.signer.sign(file_name)
+
+    async def get_presigned_url(self, file_name: str) -> str:
         try:
-            return self.r2_client.generate_presigned_url(
-                'get_object',
-                Params={'Bucket': self.bucket_name, 'Key': file_name},
-                ExpiresIn=self.expires_in
-            )
+            return self._presign(file_name)
         except Exception as e:
             cprint(f"Error downloading image: {e}", "red")
             raise Exception(str(e))
 
-    async def upload_image(self, file_path: str)->str:
+    def sign_many(self, object_keys: Iterable[Optional[str]]) -> dict[str, str]:
+        """
+        Presigned URLs for many keys at once, e.g. for a gallery or history page. Signing is local.
+        """
+        return self.signer.sign_many(object_keys)
+
+    def _object_exists(self, object_key: str) -> bool:
+        from botocore.exceptions import ClientError
+
         try:
-            file_name = os.path.basename(file_path)
-            cache = self._load_cache()
-            if file_name in cache and self._is_cache_valid(cache[file_name]):
-                return cache[file_name]['url']
-            file = open(file_path, "rb")
-            content_type = mimetypes.guess_type(file_path)[0]
-
-            self.r2_client.upload_fileobj(
-                    file,
-                    self.bucket_name,
-                    file_name,
-                    ExtraArgs={
-                        'ContentType': content_type
-                    }
-            )
-            presigned_url = self.r2_client.generate_presigned_url(
-                'get_object',
-                Params={'Bucket': self.bucket_name, 'Key': file_name},
-                ExpiresIn=self.expires_in
-            )
+            self.r2_client.head_object(Bucket=self.bucket_name, Key=object_key)
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    async def _upload_content(self, content_hash: str, extension: str, content_type: str, open_body: Callable[[], BinaryIO]) -> tuple[str, str]:
+        return await _upload_flight.do(
+            (self.bucket_name, content_hash),
+            lambda: self._run(self._upload_content_sync, content_hash, extension, content_type, open_body),
+        )
+
+    def _upload_content_sync(self, content_hash: str, extension: str, content_type: str, open_body: Callable[[], BinaryIO]) -> tuple[str, str]:
+        # objects are keyed by content, so files that share a basename never collide
+        entry = self.upload_cache.get(content_hash)
+        if entry and UploadCache.is_recently_verified(entry):
+            return entry['object_key'], self._presign(entry['object_key'])
+
+        object_key = entry['object_key'] if entry else f"uploads/{content_hash}{extension}"
+        # an old entry is only re-uploaded if the object has gone
+        if not (entry and self._object_exists(object_key)):
+            with open_body() as file:
+                self.r2_client.upload_fileobj(
+                        file,
+                        self.bucket_name,
+                        object_key,
+                        ExtraArgs={
+                            'ContentType': content_type
+                        },
+                        Config=self.transfer_config
+                )
+        self.upload_cache.put(content_hash, object_key)
+        return object_key, self._presign(object_key)
 
-            cache[file_name] = {
-                'url': presigned_url,
-                'timestamp': time.time(),
-                'expires_in': self.expires_in
-            }
-            self._save_cache(cache)
-            return presigned_url
+    async def upload_image_with_key(self, file_path: str) -> tuple[str, str]:
+        """
+        Upload (or reuse) a file and return its (object_key, presigned_url).
+        """
+        try:
+            content_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+            extension = os.path.splitext(file_path)[1].lower()
+            content_hash = await self._run(hash_file, file_path)
+            return await self._upload_content(content_hash, extension, content_type, lambda: open(file_path, "rb"))
         except Exception as e:
             cprint(f"Error uploading image: {e}", "red")
             raise Exception(str(e))
-   
 
-    
+    async def upload_bytes_with_key(self, data: bytes, content_type: str = 'image/jpeg') -> tuple[str, str]:
+        """
+        Upload (or reuse) in-memory image bytes unchanged and return their (object_key, presigned_url).
+        """
+        try:
+            extension = mimetypes.guess_extension(content_type) or ''
+            content_hash = (await self._run(hashlib.sha256, data)).hexdigest()
+            return await self._upload_content(content_hash, extension, content_type, lambda: io.BytesIO(data))
+        except Exception as e:
+            cprint(f"Error uploading image: {e}", "red")
+            raise Exception(str(e))
+
+    async def put_object(self, object_key: str, data: bytes, content_type: str = 'image/jpeg') -> str:
+        """
+        Write `data` to a fixed key (overwriting it) and return a presigned URL.
+        """
+        await self._run(
+            self.r2_client.put_object,
+            Bucket=self.bucket_name, Key=object_key, Body=data, ContentType=content_type
+        )
+        return self._presign(object_key)
+
+    async def upload_image(self, file_path: str)->str:
+        _, presigned_url = await self.upload_image_with_key(file_path)
+        return presigned_url
+
+    async def upload_stream(self, chunks: AsyncIterable[bytes], object_key: str, content_type: str = 'image/jpeg', part_size: int = R2_STREAM_PART_SIZE) -> str:
+        """
+        Upload an async stream of bytes to `object_key` without staging it on disk.
+
+        Chunks are gathered into parts of `part_size` (S3 needs at least 5 MB for
+        all but the last part). One part uploads while the next one fills, so
+        memory stays at about two parts. Bodies smaller than one part go out as a
+        single put_object.
+        """
+        part_size = max(part_size, 5 * 1024 * 1024)
+        buffer = bytearray()
+        upload_id = None
+        parts = []
+        in_flight: Optional[asyncio.Future] = None
+
+        async def flush(body: bytes) -> None:
+            nonlocal upload_id, in_flight
+            if upload_id is None:
+                created = await self._run(
+                    self.r2_client.create_multipart_upload,
+                    Bucket=self.bucket_name, Key=object_key, ContentType=content_type
+                )
+                upload_id = created['UploadId']
+            if in_flight is not None:
+                await in_flight
+            part_number = len(parts) + 1
+
+            async def upload_part() -> None:
+                response = await self._run(
+                    self.r2_client.upload_part,
+                    Bucket=self.bucket_name, Key=object_key, UploadId=upload_id,
+                    PartNumber=part_number, Body=body
+                )
+                parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+
+            in_flight = asyncio.ensure_future(upload_part())
+
+        try:
+            async for chunk in chunks:
+                buffer.extend(chunk)
+                if len(buffer) >= part_size:
+                    body = bytes(buffer[:part_size])
+                    del buffer[:part_size]
+                    await flush(body)
+            if upload_id is None:
+                await self._run(
+                    self.r2_client.put_object,
+                    Bucket=self.bucket_name, Key=object_key, Body=bytes(buffer), ContentType=content_type
+                )
+            else:
+                if buffer:
+                    await flush(bytes(buffer))
+                    buffer.clear()
+                await in_flight
+                await self._run(
+                    self.r2_client.complete_multipart_upload,
+                    Bucket=self.bucket_name, Key=object_key, UploadId=upload_id,
+                    MultipartUpload={'Parts': sorted(parts, key=lambda part: part['PartNumber'])}
+                )
+        except BaseException as e:
+            if in_flight is not None and not in_flight.done():
+                in_flight.cancel()
+            if upload_id is not None:
+                try:
+                    await self._run(
+                        self.r2_client.abort_multipart_upload,
+                        Bucket=self.bucket_name, Key=object_key, UploadId=upload_id
+                    )
+                except Exception as abort_error:
+                    cprint(f"Error aborting multipart upload {object_key}: {abort_error}", "red")
+            if isinstance(e, Exception):
+                cprint(f"Error streaming upload {object_key}: {e}", "red")
+            raise
+        return self._presign(object_key)
+
+    async def upload_many(self, file_paths: Iterable[str], concurrency: int = R2_IO_THREADS) -> AsyncIterator[tuple[str, Optional[str]]]:
+        """
+        Upload files concurrently and yield (file_path, url) in completion order.
+        Failed uploads yield a None url.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def upload(file_path: str) -> tuple[str, Optional[str]]:
+            async with semaphore:
+                try:
+                    return file_path, await self.upload_image(file_path)
+                except Exception:
+                    return file_path, None
+
+        tasks = [asyncio.create_task(upload(file_path)) for file_path in file_paths]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,166 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Optional
+
+from termcolor import cprint
+
+from config import (
+    GROK_RATE, GROK_BURST, GROK_CONCURRENCY,
+    WAVESPEED_SUBMIT_RATE, WAVESPEED_SUBMIT_BURST, WAVESPEED_SUBMIT_CONCURRENCY,
+    WAVESPEED_POLL_RATE, WAVESPEED_POLL_BURST, POLL_MAX_CONCURRENCY,
+    R2_RATE, R2_BURST, R2_CONCURRENCY,
+    WAVESPEED_DOWNLOAD_RATE, WAVESPEED_DOWNLOAD_CONCURRENCY,
+    RATE_LIMIT_MAX_RETRIES,
+)
+from .metrics import RETRIES_TOTAL, THROTTLED_TOTAL
+from .resilience import RETRY_BUDGET, CircuitBreaker, TransientError, backoff_delay, note_retry
+
+
+class RetryAfter(Exception):
+    """
+    Raised by a call wrapped in Lane.run when the upstream asked us to back off (HTTP 429).
+    """
+
+    def __init__(self, delay: float, message: str = "rate limited") -> None:
+        super().__init__(f"{message}, retry after {delay:.1f}s")
+        self.delay = delay
+
+
+def retry_after_seconds(headers, default: float = 1.0) -> float:
+    """
+    Parse a Retry-After header given either as seconds or as an HTTP date.
+    """
+    value = headers.get("Retry-After") if headers is not None else None
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """
+        Stop handing out tokens for `seconds`, e.g. after a Retry-After.
+        """
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                if self.rate <= 0:
+                    return
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class Lane:
+    """
+    Rate limit, concurrency cap and circuit breaker for one upstream.
+    """
+
+    def __init__(self, name: str, rate: float, burst: int, concurrency: int, max_retries: int = RATE_LIMIT_MAX_RETRIES) -> None:
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.breaker = CircuitBreaker(name)
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def pause(self, seconds: float) -> None:
+        cprint(f"{self.name}: backing off for {seconds:.1f}s", "yellow")
+        self.bucket.pause(seconds)
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self._semaphore:
+            await self.bucket.acquire()
+            yield
+
+    async def run(self, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """
+        Call `fn` inside a slot. RetryAfter pauses the lane and retries. TransientError
+        retries after a jittered backoff while the process-wide retry budget allows,
+        and repeated ones open the lane's circuit breaker.
+        """
+        attempts = 0
+        while True:
+            probe = await self.breaker.wait()
+            RETRY_BUDGET.record_call()
+            try:
+                async with self.slot():
+                    result = await fn(*args, **kwargs)
+            except RetryAfter as e:
+                # the upstream answered, so it is healthy, just busy
+                self.breaker.record_success()
+                THROTTLED_TOTAL.inc(self.name)
+                attempts += 1
+                if attempts > self.max_retries:
+                    raise
+                RETRIES_TOTAL.inc(self.name, "throttled")
+                note_retry()
+                self.pause(e.delay)
+                continue
+            except TransientError as e:
+                self.breaker.record_failure()
+                attempts += 1
+                if attempts > self.max_retries or not RETRY_BUDGET.try_spend():
+                    raise
+                RETRIES_TOTAL.inc(self.name, "transient")
+                note_retry()
+                delay = backoff_delay(attempts)
+                cprint(f"{self.name}: {e}; retry {attempts} in {delay:.1f}s", "yellow")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # neither healthy nor transient (e.g. a 4xx or cancellation); let another call probe
+                if probe:
+                    self.breaker.release_probe()
+                raise
+            self.breaker.record_success()
+            return result
+
+
+class ExecutionLimits:
+    """
+    One lane per upstream. Build from config with `from_config()` so limits can be set per deployment.
+    """
+
+    def __init__(self, grok: Lane, wavespeed_submit: Lane, wavespeed_poll: Lane, r2: Lane, wavespeed_download: Optional[Lane] = None) -> None:
+        self.grok = grok
+        self.wavespeed_submit = wavespeed_submit
+        self.wavespeed_poll = wavespeed_poll
+        self.r2 = r2
+        self.wavespeed_download = wavespeed_download or Lane("wavespeed_download", WAVESPEED_DOWNLOAD_RATE, 1, WAVESPEED_DOWNLOAD_CONCURRENCY)
+
+    @classmethod
+    def from_config(cls) -> "ExecutionLimits":
+        return cls(
+            grok=Lane("grok", GROK_RATE, GROK_BURST, GROK_CONCURRENCY),
+            wavespeed_submit=Lane("wavespeed_submit", WAVESPEED_SUBMIT_RATE, WAVESPEED_SUBMIT_BURST, WAVESPEED_SUBMIT_CONCURRENCY),
+            wavespeed_poll=Lane("wavespeed_poll", WAVESPEED_POLL_RATE, WAVESPEED_POLL_BURST, POLL_MAX_CONCURRENCY),
+            r2=Lane("r2", R2_RATE, R2_BURST, R2_CONCURRENCY),
+        )
@@ -0,0 +1,168 @@
+import asyncio
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator, Optional
+
+from termcolor import cprint
+
+from config import (
+    RETRY_BASE_DELAY, RETRY_MAX_DELAY,
+    RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_PER_SECOND, RETRY_BUDGET_MAX,
+    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT, CIRCUIT_MAX_RESET_TIMEOUT,
+)
+from .metrics import CIRCUIT_OPEN
+
+
+class TransientError(Exception):
+    """
+    Raised by a call wrapped in Lane.run when it failed in a way that may succeed
+    if repeated (5xx, dropped connection). Only raise it where repeating is safe.
+    """
+
+
+def backoff_delay(attempt: int, base: float = RETRY_BASE_DELAY, cap: float = RETRY_MAX_DELAY) -> float:
+    """
+    Full-jitter exponential backoff: uniform in [0, min(cap, base * 2**(attempt - 1))].
+    """
+    return random.uniform(0, min(cap, base * 2 ** max(0, attempt - 1)))
+
+
+class RetryBudget:
+    """
+    Caps retries process-wide so a failing upstream sees a bounded amount of
+    extra traffic. Every call earns `ratio` of a retry and `min_per_second`
+    retries accrue over time, up to `max_tokens`.
+    """
+
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, min_per_second: float = RETRY_BUDGET_MIN_PER_SECOND, max_tokens: float = RETRY_BUDGET_MAX) -> None:
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, amount: float) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.max_tokens, self._tokens + amount + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def record_call(self) -> None:
+        with self._lock:
+            self._refill(self.ratio)
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            self._refill(0)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+RETRY_BUDGET = RetryBudget()
+
+
+class CircuitBreaker:
+    """
+    Pauses calls to an upstream that keeps failing.
+
+    After `failure_threshold` consecutive failures the circuit opens and wait()
+    blocks callers for `reset_timeout` seconds. Then one probe call is let
+    through: success closes the circuit, failure opens it again for twice as long
+    (up to `max_reset_timeout`).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+        reset_timeout: float = CIRCUIT_RESET_TIMEOUT,
+        max_reset_timeout: float = CIRCUIT_MAX_RESET_TIMEOUT,
+    ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._failures = 0
+        self._open_until: Optional[float] = None
+        self._timeout = reset_timeout
+        self._probing = False
+        self._closed = asyncio.Event()
+        self._closed.set()
+
+    @property
+    def is_open(self) -> bool:
+        return self._open_until is not None
+
+    async def wait(self) -> bool:
+        """
+        Return when a call may go out: immediately while closed, otherwise after the
+        pause, as the single probe or once the probe has closed the circuit.
+        Returns True when the caller is the probe.
+        """
+        while self._open_until is not None:
+            remaining = self._open_until - time.monotonic()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+            elif not self._probing:
+                self._probing = True
+                return True
+            else:
+                try:
+                    await asyncio.wait_for(self._closed.wait(), self._timeout)
+                except asyncio.TimeoutError:
+                    # the probe never reported back (e.g. it was cancelled); allow another one
+                    self._probing = False
+        return False
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._probing = False
+        if self._open_until is not None:
+            cprint(f"{self.name}: upstream recovered, resuming", "green")
+            self._open_until = None
+            self._timeout = self.reset_timeout
+            CIRCUIT_OPEN.inc(self.name, amount=-1)
+            self._closed.set()
+
+    def release_probe(self) -> None:
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self._probing:
+            self._probing = False
+            self._timeout = min(self.max_reset_timeout, self._timeout * 2)
+        elif self._open_until is not None or self._failures < self.failure_threshold:
+            return
+        else:
+            CIRCUIT_OPEN.inc(self.name)
+        cprint(f"{self.name}: {self._failures} failures in a row, pausing calls for {self._timeout:.0f}s", "yellow")
+        self._open_until = time.monotonic() + self._timeout
+        self._closed.clear()
+
+
+# the object (e.g. a pipeline item) whose `retries` attribute counts retries made on its behalf
+_retry_owner: ContextVar[Optional[Any]] = ContextVar("retry_owner", default=None)
+
+
+@contextmanager
+def track_retries(owner: Any) -> Iterator[None]:
+    """
+    Count retries made by Lane.run inside this block (and tasks it starts) on `owner.retries`.
+    """
+    token = _retry_owner.set(owner)
+    try:
+        yield
+    finally:
+        _retry_owner.reset(token)
+
+
+def note_retry() -> None:
+    owner = _retry_owner.get()
+    if owner is not None and hasattr(owner, "retries"):
+        owner.retries += 1
@@ -0,0 +1,114 @@
+import asyncio
+import os
+import threading
+from fnmatch import fnmatch
+from typing import AsyncIterator, Iterator, Optional, Sequence
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# entries handed from the scanning thread to the event loop at a time
+SCAN_BATCH_SIZE = 256
+
+
+def _matches(relative_path: str, patterns: Optional[Sequence[str]]) -> bool:
+    return any(fnmatch(relative_path, pattern) for pattern in patterns or ())
+
+
+def iter_dataset(
+    root: str,
+    recursive: bool = False,
+    include: Optional[Sequence[str]] = None,
+    exclude: Optional[Sequence[str]] = None,
+    skip_paths: Sequence[str] = (),
+) -> Iterator[tuple[str, str, Optional[str]]]:
+    """
+    Lazily walk `root` with os.scandir and yield (relative_path, image_path, description_path)
+    for every target image. description_path is None when there is no matching .txt.
+
+    include/exclude are glob patterns matched against the path relative to
+    `root` (with '/' separators). Entries come in directory order, one
+    directory at a time, so memory does not grow with directory size.
+    """
+    skip = {os.path.realpath(path) for path in skip_paths}
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                relative_path = os.path.relpath(entry.path, root).replace(os.sep, "/")
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive and not _matches(relative_path, exclude):
+                        pending.append(entry.path)
+                    continue
+                if not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                if include and not _matches(relative_path, include):
+                    continue
+                if _matches(relative_path, exclude):
+                    continue
+                if os.path.realpath(entry.path) in skip:
+                    continue
+                description_path = os.path.splitext(entry.path)[0] + ".txt"
+                yield relative_path, entry.path, description_path if os.path.isfile(description_path) else None
+
+
+def _read_description(description_path: Optional[str]) -> Optional[str]:
+    if description_path is None:
+        return None
+    with open(description_path, "r") as f:
+        return f.read()
+
+
+def _next_batch(iterator: Iterator, size: int) -> list[tuple[str, str, Optional[str]]]:
+    batch = []
+    for relative_path, image_path, description_path in iterator:
+        batch.append((relative_path, image_path, _read_description(description_path), description_path is not None))
+        if len(batch) >= size:
+            break
+    return batch
+
+
+async def scan_dataset(
+    root: str,
+    recursive: bool = False,
+    include: Optional[Sequence[str]] = None,
+    exclude: Optional[Sequence[str]] = None,
+    skip_paths: Sequence[str] = (),
+    batch_size: int = SCAN_BATCH_SIZE,
+) -> AsyncIterator[tuple[str, str, Optional[str], bool]]:
+    """
+    Async version of iter_dataset that also reads descriptions. Yields
+    (relative_path, image_path, description, has_description). Directory
+    listing and file reads happen on a worker thread, a batch at a time.
+    """
+    iterator = iter_dataset(root, recursive, include, exclude, skip_paths)
+    # held by the worker thread while it advances the iterator; a cancelled to_thread call keeps running
+    lock = threading.Lock()
+    stopped = threading.Event()
+
+    def next_batch() -> list[tuple[str, str, Optional[str], bool]]:
+        with lock:
+            if stopped.is_set():
+                return []
+            batch = _next_batch(iterator, batch_size)
+            if stopped.is_set():
+                # the scan was cancelled while this batch was read
+                iterator.close()
+            return batch
+
+    try:
+        while True:
+            batch = await asyncio.to_thread(next_batch)
+            if not batch:
+                return
+            for item in batch:
+                yield item
+    finally:
+        # release the open directory handle if the consumer stops early; closing the
+        # iterator while the thread is inside next() would raise "generator already executing"
+        stopped.set()
+        if lock.acquire(blocking=False):
+            try:
+                iterator.close()
+            finally:
+                lock.release()
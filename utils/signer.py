@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+from config import R2_URL_EXPIRES_IN, R2_URL_MIN_REMAINING, SIGNED_URL_CACHE_SIZE
+
+
+class UrlSigner:
+    """
+    Presigns GET URLs for R2 object keys on demand.
+
+    Signing is a local HMAC with the shared boto3 client, so nothing goes over
+    the network. Signed URLs are kept in memory (least recently used evicted
+    beyond `max_entries`) and handed out again until fewer than
+    `min_remaining` seconds of their lifetime are left, so a link served to a
+    gallery stays usable for at least that long.
+    """
+
+    def __init__(
+        self,
+        client,
+        bucket_name: str,
+        expires_in: int = R2_URL_EXPIRES_IN,
+        min_remaining: int = R2_URL_MIN_REMAINING,
+        max_entries: int = SIGNED_URL_CACHE_SIZE,
+    ) -> None:
+        self.client = client
+        self.bucket_name = bucket_name
+        self.expires_in = expires_in
+        # never hand out a URL with less than this left, even if expires_in is short
+        self.min_remaining = min(min_remaining, expires_in // 2)
+        self.max_entries = max_entries
+        # object key -> (url, expires_at)
+        self._urls: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached(self, object_key: str, now: float) -> Optional[str]:
+        cached = self._urls.get(object_key)
+        if cached is None:
+            return None
+        url, expires_at = cached
+        if expires_at - now < self.min_remaining:
+            del self._urls[object_key]
+            return None
+        self._urls.move_to_end(object_key)
+        return url
+
+    def _sign(self, object_key: str, now: float) -> str:
+        url = self.client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self.bucket_name, 'Key': object_key},
+            ExpiresIn=self.expires_in,
+        )
+        self._urls[object_key] = (url, now + self.expires_in)
+        while len(self._urls) > self.max_entries:
+            self._urls.popitem(last=False)
+        return url
+
+    def sign(self, object_key: Optional[str]) -> Optional[str]:
+        if not object_key:
+            return None
+        now = time.time()
+        with self._lock:
+            return self._cached(object_key, now) or self._sign(object_key, now)
+
+    def sign_many(self, object_keys: Iterable[Optional[str]]) -> dict[str, str]:
+        """
+        Sign a batch of keys (e.g. a gallery or history page) under one lock acquisition.
+        Empty keys are skipped.
+        """
+        now = time.time()
+        urls = {}
+        with self._lock:
+            for object_key in object_keys:
+                if object_key and object_key not in urls:
+                    urls[object_key] = self._cached(object_key, now) or self._sign(object_key, now)
+        return urls
+
+    def invalidate(self, object_key: str) -> None:
+        with self._lock:
+            self._urls.pop(object_key, None)
@@ -0,0 +1,54 @@
+import asyncio
+import weakref
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class _Call:
+    __slots__ = ("future", "waiters")
+
+    def __init__(self, future: asyncio.Future) -> None:
+        self.future = future
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into one.
+
+    The first caller for a key starts the work; everyone else asking for that
+    key while it runs awaits the same result (or exception). Nothing is kept
+    once the call finishes, so this deduplicates without caching. In-flight
+    calls are tracked per event loop, so one instance can be shared
+    process-wide. A call whose waiters were all cancelled is cancelled too.
+    """
+
+    def __init__(self) -> None:
+        self._inflight: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[Hashable, _Call]]" = weakref.WeakKeyDictionary()
+
+    def _calls(self) -> dict:
+        loop = asyncio.get_running_loop()
+        calls = self._inflight.get(loop)
+        if calls is None:
+            calls = self._inflight[loop] = {}
+        return calls
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self._calls()
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        calls = self._calls()
+        call = calls.get(key)
+        if call is None:
+            call = calls[key] = _Call(asyncio.ensure_future(fn()))
+            call.future.add_done_callback(lambda _: calls.pop(key, None))
+        call.waiters += 1
+        try:
+            # shield so one waiter being cancelled doesn't cancel the shared call
+            return await asyncio.shield(call.future)
+        except asyncio.CancelledError:
+            # ...unless nobody else is waiting for it, which would leave it running orphaned
+            if call.waiters == 1:
+                call.future.cancel()
+            raise
+        finally:
+            call.waiters -= 1
@@ -0,0 +1,124 @@
+import asyncio
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Optional
+
+from termcolor import cprint
+
+from .cancellation import BatchCancelled, CancellationToken
+from .resilience import track_retries
+
+
+_DONE = object()
+
+
+class Stage:
+    """
+    One step of a streaming pipeline: `workers` coroutines apply `fn` to items
+    taken from the previous stage's queue.
+
+    `fn` mutates and returns the item. Items that carry an `error` skip the
+    remaining stages but still reach the output, so callers see every input.
+    Stages that `starts_work` (uploads, submissions) fail their items with
+    BatchCancelled once the batch is stopping; the others keep draining.
+    """
+
+    def __init__(self, name: str, fn: Callable[[Any], Awaitable[Any]], workers: int = 1, when: Optional[Callable[[Any], bool]] = None, starts_work: bool = False) -> None:
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.when = when
+        self.starts_work = starts_work
+
+
+async def _get_unless_cancelled(queue: asyncio.Queue, cancelled: Optional[asyncio.Future]) -> Any:
+    """
+    queue.get(), or _DONE as soon as `cancelled` completes.
+    """
+    if cancelled is None:
+        return await queue.get()
+    if cancelled.done():
+        return _DONE
+    getter = asyncio.ensure_future(queue.get())
+    try:
+        await asyncio.wait({getter, cancelled}, return_when=asyncio.FIRST_COMPLETED)
+    except BaseException:
+        getter.cancel()
+        raise
+    if getter.done():
+        return getter.result()
+    # cancel() only requests cancellation; the getter is not done until the loop runs it again
+    getter.cancel()
+    return _DONE
+
+
+async def run_stages(source: AsyncIterable[Any], stages: list[Stage], queue_size: int = 0, cancel_token: Optional[CancellationToken] = None) -> AsyncIterator[Any]:
+    """
+    Feed items from `source` through `stages`, each running concurrently with
+    its own worker pool, and yield items as they leave the last stage.
+
+    Once `cancel_token` is stopping, no more items are read from `source`.
+    Once it is cancelled, every stage is cancelled and the iteration ends,
+    without yielding the items that were still in flight.
+    """
+    queues = [asyncio.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    tasks: list[asyncio.Task] = []
+    cancelled = asyncio.ensure_future(cancel_token.wait_cancelled()) if cancel_token is not None else None
+
+    async def produce() -> None:
+        try:
+            async for item in source:
+                if cancel_token is not None and cancel_token.stopping:
+                    break
+                await queues[0].put(item)
+        finally:
+            await queues[0].put(_DONE)
+
+    async def work(stage: Stage, inbox: asyncio.Queue, outbox: asyncio.Queue) -> None:
+        while True:
+            item = await inbox.get()
+            if item is _DONE:
+                # let sibling workers see the sentinel too
+                await inbox.put(_DONE)
+                return
+            if getattr(item, "error", None) is None and stage.starts_work and cancel_token is not None and cancel_token.stopping:
+                item.error = BatchCancelled(cancel_token.reason)
+            elif getattr(item, "error", None) is None and (stage.when is None or stage.when(item)):
+                try:
+                    with track_retries(item):
+                        item = await stage.fn(item)
+                except asyncio.CancelledError:
+                    raise
+                except BatchCancelled as e:
+                    item.error = e
+                except Exception as e:
+                    cprint(f"{stage.name} failed: {e}", "red")
+                    item.error = e
+            await outbox.put(item)
+
+    async def run_stage(index: int, stage: Stage) -> None:
+        workers = [asyncio.create_task(work(stage, queues[index], queues[index + 1])) for _ in range(stage.workers)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+        await queues[index + 1].put(_DONE)
+
+    tasks.append(asyncio.create_task(produce()))
+    for index, stage in enumerate(stages):
+        tasks.append(asyncio.create_task(run_stage(index, stage)))
+
+    try:
+        while True:
+            item = await _get_unless_cancelled(queues[-1], cancelled)
+            if item is _DONE:
+                break
+            yield item
+        if cancelled is None or not cancelled.done():
+            # surface errors from the producer (e.g. a failing directory scan)
+            await asyncio.gather(*tasks)
+    finally:
+        if cancelled is not None:
+            cancelled.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
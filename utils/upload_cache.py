@@ -0,0 +1,121 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import BinaryIO, Optional, TypedDict
+
+from termcolor import cprint
+
+from config import UPLOAD_CACHE_PATH, UPLOAD_CACHE_MAX_ENTRIES, UPLOAD_CACHE_TTL, UPLOAD_CACHE_VERIFY_AFTER
+
+
+class UploadCacheEntry(TypedDict):
+    content_hash: str
+    object_key: str
+    # when the object was last known to exist in R2 (uploaded or HEAD-checked)
+    verified_at: float
+    last_used: float
+
+
+def hash_file(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    with open(file_path, "rb") as f:
+        return hash_fileobj(f, chunk_size)
+
+
+def hash_fileobj(fileobj: BinaryIO, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(chunk_size), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+class UploadCache:
+    """
+    Maps content hashes to the R2 objects holding those bytes. Only keys are
+    stored; URLs are signed on demand by the shared UrlSigner.
+
+    Lookups and writes hit the primary key, so they are O(1) regardless of
+    cache size, and one connection guarded by a lock makes it safe to use
+    from the R2 executor threads. Entries unused for `ttl` seconds are
+    dropped, and the least recently used entries go once `max_entries` is
+    exceeded.
+    """
+
+    # run eviction every N writes rather than on every put
+    EVICT_EVERY = 100
+
+    def __init__(self, path: str = UPLOAD_CACHE_PATH, max_entries: int = UPLOAD_CACHE_MAX_ENTRIES, ttl: float = UPLOAD_CACHE_TTL) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._writes = 0
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # earlier versions stored presigned URLs in an `uploads` table
+        self._conn.execute("DROP TABLE IF EXISTS uploads")
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS upload_objects (
+                content_hash TEXT PRIMARY KEY,
+                object_key TEXT NOT NULL,
+                verified_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        ''')
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_upload_objects_last_used ON upload_objects (last_used)")
+
+    def get(self, content_hash: str) -> Optional[UploadCacheEntry]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM upload_objects WHERE content_hash = ?", (content_hash,)).fetchone()
+            if row is None:
+                return None
+            if now - row["last_used"] > self.ttl:
+                self._conn.execute("DELETE FROM upload_objects WHERE content_hash = ?", (content_hash,))
+                return None
+            self._conn.execute("UPDATE upload_objects SET last_used = ? WHERE content_hash = ?", (now, content_hash))
+        return dict(row)
+
+    def put(self, content_hash: str, object_key: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute('''
+                INSERT OR REPLACE INTO upload_objects (content_hash, object_key, verified_at, last_used)
+                VALUES (?, ?, ?, ?)
+            ''', (content_hash, object_key, now, now))
+            self._writes += 1
+            if self._writes % self.EVICT_EVERY == 0:
+                self._evict(now)
+
+    def delete(self, content_hash: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM upload_objects WHERE content_hash = ?", (content_hash,))
+
+    @staticmethod
+    def is_recently_verified(entry: UploadCacheEntry, max_age: float = UPLOAD_CACHE_VERIFY_AFTER) -> bool:
+        """
+        True if the object was known to exist less than `max_age` seconds ago.
+        """
+        return (time.time() - entry["verified_at"]) < max_age
+
+    def _evict(self, now: float) -> None:
+        try:
+            self._conn.execute("DELETE FROM upload_objects WHERE last_used < ?", (now - self.ttl,))
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM upload_objects").fetchone()
+            if count > self.max_entries:
+                self._conn.execute('''
+                    DELETE FROM upload_objects WHERE content_hash IN (
+                        SELECT content_hash FROM upload_objects ORDER BY last_used ASC LIMIT ?
+                    )
+                ''', (count - self.max_entries,))
+        except sqlite3.Error as e:
+            cprint(f"Error evicting upload cache: {e}", "red")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,177 @@
+import asyncio
+import os
+import socket
+from typing import Optional
+from uuid import uuid4
+
+from termcolor import cprint
+
+from config import WORKER_CAPACITY, WORKER_LEASE_SECONDS, WORKER_CLAIM_INTERVAL
+from database.client import Job
+from database.job_store import JobStore
+from .cancellation import BatchCancelled
+from .image_generator import ImageProcessorPipeline, SubmitRejected, TargetItem
+from .metrics import JOBS_TOTAL
+from .poll_scheduler import PollFailed, PollTimeout
+from .resilience import track_retries
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+
+
+class JobWorker:
+    """
+    Claims queued jobs from a JobStore and runs them through a pipeline's
+    submit -> poll -> download steps, up to `capacity` at a time.
+
+    Leases are renewed every third of `lease_seconds` while a job runs. A job
+    whose lease was lost (e.g. this process stalled and another worker took it
+    over) is cancelled here. Jobs that fail are released for another attempt
+    until they reach the store's attempt limit (a poll that timed out resumes polling
+    under the next lease); jobs Wavespeed rejected or failed (SubmitRejected,
+    PollFailed) fail at once.
+
+    The pipeline's cancel_token shuts the worker down: once it is stopping,
+    nothing new is claimed and run() returns when the active jobs are done; once
+    it is cancelled, the active jobs are cancelled and released to the queue.
+    """
+
+    def __init__(
+        self,
+        store: JobStore,
+        pipeline: ImageProcessorPipeline,
+        worker_id: Optional[str] = None,
+        capacity: int = WORKER_CAPACITY,
+        lease_seconds: float = WORKER_LEASE_SECONDS,
+        claim_interval: float = WORKER_CLAIM_INTERVAL,
+    ) -> None:
+        self.store = store
+        self.pipeline = pipeline
+        self.worker_id = worker_id or default_worker_id()
+        self.capacity = max(1, capacity)
+        self.lease_seconds = lease_seconds
+        self.claim_interval = claim_interval
+        self.cancel_token = pipeline.cancel_token
+        self.counts = {"completed": 0, "failed": 0, "released": 0, "lost": 0}
+        # job id -> task running it
+        self._active: dict[str, asyncio.Task] = {}
+
+    async def run(self, exit_when_idle: bool = False) -> dict:
+        """
+        Claim and run jobs until cancelled, or until nothing is left to claim with `exit_when_idle`.
+        Returns the outcome counts.
+        """
+        cprint(f"Worker {self.worker_id} started (capacity {self.capacity})", "green")
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            while not self.cancel_token.cancelled:
+                claimed = []
+                free = self.capacity - len(self._active)
+                if free > 0 and not self.cancel_token.stopping:
+                    claimed = await self.store.claim(self.worker_id, free, self.lease_seconds)
+                    for job in claimed:
+                        self._active[job["id"]] = asyncio.create_task(self._run_job(job))
+                if not claimed and not self._active and (exit_when_idle or self.cancel_token.stopping):
+                    return self.counts
+                if self._active:
+                    await asyncio.wait(list(self._active.values()), timeout=self.claim_interval, return_when=asyncio.FIRST_COMPLETED)
+                else:
+                    await asyncio.sleep(self.claim_interval)
+            return self.counts
+        finally:
+            unfinished = dict(self._active)
+            heartbeat.cancel()
+            for task in unfinished.values():
+                task.cancel()
+            await asyncio.gather(heartbeat, *unfinished.values(), return_exceptions=True)
+            # unfinished jobs go back to the queue instead of waiting for their leases to expire
+            for job_id in unfinished:
+                await self.store.release(self.worker_id, job_id, {})
+            self._active.clear()
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            job_ids = list(self._active)
+            try:
+                held = await self.store.heartbeat(self.worker_id, job_ids, self.lease_seconds)
+            except Exception as e:
+                cprint(f"Heartbeat failed: {e}", "red")
+                continue
+            for job_id in job_ids:
+                task = self._active.get(job_id)
+                if job_id not in held and task is not None:
+                    cprint(f"Lost the lease on job {job_id}; another worker owns it now", "yellow")
+                    self.counts["lost"] += 1
+                    del self._active[job_id]
+                    task.cancel()
+
+    @staticmethod
+    def _item(job: Job) -> TargetItem:
+        return TargetItem(
+            index=0,
+            file_name=job["target_image_key"],
+            image_path=None,
+            description=job.get("prompt"),
+            image_key=job.get("target_object_key"),
+            size=job.get("size"),
+            fingerprint=job.get("fingerprint"),
+            job_id=job["id"],
+            prediction_url=job.get("wavespeed_result_url"),
+        )
+
+    async def _run_job(self, job: Job) -> None:
+        item = self._item(job)
+        try:
+            lia_image = None
+            if item.prediction_url is None:
+                signer = self.pipeline.r2_client.signer
+                item.image_url = signer.sign(item.image_key)
+                lia_image = signer.sign(job["lia_object_key"])
+            with track_retries(item):
+                await self.pipeline.run_job(item, lia_image, on_submitted=self._checkpoint)
+            spans = {f"{span}_seconds": seconds for span, seconds in item.timings.items()}
+            await self.store.complete(item.job_id, {
+                "wavespeed_result_url": item.prediction_url,
+                "r2_image_key": item.r2_image_key,
+                "thumbnail_key": item.thumbnail_key,
+                "preview_key": item.preview_key,
+                "status": "completed",
+                "retries": item.retries,
+                **spans,
+            })
+            self.counts["completed"] += 1
+            JOBS_TOTAL.inc("completed")
+            cprint(f"Finished {item.file_name} (job {item.job_id})", "green")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if isinstance(e, BatchCancelled):
+                # stopped before it was submitted; hand it back without using up an attempt
+                await self.store.release(self.worker_id, item.job_id, {"attempts": max(0, (job.get("attempts") or 1) - 1)})
+                self.counts["released"] += 1
+                return
+            cprint(f"Job {item.job_id} failed: {e}", "red")
+            if isinstance(e, (PollFailed, SubmitRejected)) or (job.get("attempts") or 0) >= self.store.max_attempts:
+                status = "timeout" if isinstance(e, PollTimeout) else "failed"
+                await self.store.complete(item.job_id, {"wavespeed_result_url": item.prediction_url, "status": status, "retries": item.retries})
+                self.counts["failed"] += 1
+                JOBS_TOTAL.inc("failed")
+            else:
+                released: Job = {"wavespeed_result_url": item.prediction_url}
+                if isinstance(e, PollTimeout):
+                    # the scheduler marked the row 'timeout', which is not claimable; the next lease resumes polling
+                    released["status"] = "submitted"
+                await self.store.release(self.worker_id, item.job_id, released)
+                self.counts["released"] += 1
+        finally:
+            if self._active.get(item.job_id) is asyncio.current_task():
+                del self._active[item.job_id]
+
+    async def _checkpoint(self, item: TargetItem) -> None:
+        # a worker that dies after this point leaves a job that resumes polling instead of paying again
+        await self.store.update(self.worker_id, item.job_id, {
+            "wavespeed_result_url": item.prediction_url,
+            "status": "submitted",
+        })